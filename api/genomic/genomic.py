@@ -14,6 +14,7 @@ from api.system.system import digby_protected
 from db.genomic_db import RefSeq, Feature, Sequence, SampleSequence, Gene, SequenceFeature
 from db.genomic_airr_model import Sample, Study, Patient, SeqProtocol, TissuePro, DataPro, Base
 from db.genomic_api_query_filters import genomic_sequence_filters, genomic_sample_filters
+from db.feature_index import FeatureIndex
 
 import json
 from datetime import datetime
@@ -33,6 +34,8 @@ GENOMIC_SAMPLE_PATH = os.path.join(app.config['STATIC_PATH'], 'study_data/Genomi
 
 ns = api.namespace('genomic', description='Genomic data and annotations')
 
+feature_index = FeatureIndex()
+
 
 def get_genomic_species():
     return list(genomic_dbs.keys())
@@ -503,7 +506,7 @@ class FeaturePosAPI(Resource):
         if db is None:
             raise BadRequest('Bad species or dataset name')
 
-        ref_seq = db.session.query(RefSeq).filter(RefSeq.name == ref_seq_name).one_or_none()
+        ref_seq = db.session.query(RefSeq.id, RefSeq.length).filter(RefSeq.name == ref_seq_name).one_or_none()
 
         if ref_seq is None:
             raise BadRequest('Bad ref_seq name')
@@ -511,21 +514,42 @@ class FeaturePosAPI(Resource):
         if feature_string.upper() == ref_seq_name.upper():
             return [{'chromosome': ref_seq_name, 'start': 1, 'end': ref_seq.length}]
 
-        features = db.session.query(Feature).join(RefSeq).filter(RefSeq.id == ref_seq.id).filter(Feature.name.contains(feature_string)).all()
+        features = feature_index.get(species, dataset, db.created, db.session, ref_seq.id).named(feature_string)
 
         if features:
-            start = 99999999
-            end = 0
-
-            for feature in features:
-                start = min(start, feature.start)
-                end = max(end, feature.end)
+            start = min(feature['start'] for feature in features)
+            end = max(feature['end'] for feature in features)
 
             return[{'chromosome': ref_seq_name, 'start': start, 'end': end}]
         else:
             return []
 
 
+@ns.route('/features/<string:species>/<string:dataset>/<string:ref_seq_name>')
+@api.response(404, 'Reference sequence not found.')
+class FeaturesAPI(Resource):
+    @digby_protected()
+    @api.expect(range_arguments, validate=True)
+    def get(self, species, dataset, ref_seq_name):
+        """ Returns the features on the reference sequence that overlap the range start..end, in order of start """
+        args = range_arguments.parse_args(request)
+
+        db = get_genomic_db(species, dataset)
+
+        if db is None:
+            raise BadRequest('Bad species or dataset name')
+
+        ref_seq = db.session.query(RefSeq.id).filter(RefSeq.name == ref_seq_name).one_or_none()
+
+        if ref_seq is None:
+            raise BadRequest('Bad ref_seq name')
+
+        if args['end'] < args['start']:
+            raise BadRequest('end must not be less than start')
+
+        return feature_index.get(species, dataset, db.created, db.session, ref_seq.id).overlapping(args['start'], args['end'])
+
+
 @ns.route('/subjects/<string:species>/<string:genomic_datasets>')
 @api.response(404, 'Reference sequence not found.')
 class SubjectsAPI(Resource):
@@ -2,7 +2,7 @@
 
 from werkzeug.exceptions import BadRequest
 from api.reports.reports import run_rscript, send_report
-from api.reports.report_utils import make_output_file, chunk_list
+from api.reports.report_utils import make_output_file, chunk_list, distinct_patient_counts
 from app import vdjbase_dbs, genomic_dbs
 from db.vdjbase_model import AllelesSample, Gene, Allele
 from db.vdjbase_airr_model import Sample, Patient
@@ -26,19 +26,19 @@ def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_sa
         rep_samples_by_dataset[rep_sample['dataset']].append(rep_sample['sample_name'])
 
     # Format we need to produce is [gene_name, [allele names], [allele appearances], gene appearances]
-    # Start with a dict indexed by gene, then convert to appropriately sorted list
-    counts = {}
+    # Start with the distinct (gene, allele, patient) appearances, then count and convert to an appropriately sorted list
+    appearances = []
+    gene_orders = {}
 
     for dataset in rep_samples_by_dataset.keys():
         session = vdjbase_dbs[species][dataset].session
-        appearances = []
 
         for sample_chunk in chunk_list(rep_samples_by_dataset[dataset], SAMPLE_CHUNKS):
             sample_list = session.query(Sample.sample_name, Sample.genotype, Sample.patient_id).filter(Sample.sample_name.in_(sample_chunk)).all()
             sample_list, wanted_genes = apply_rep_filter_params(params, sample_list, session)
             sample_list = [s[0] for s in sample_list]
 
-            app_query = session.query(AllelesSample.patient_id, Patient.patient_name, Gene.name, Allele.name, Sample.sample_name, Gene.locus_order, Gene.alpha_order)\
+            app_query = session.query(Gene.name, Allele.name, Patient.patient_name, Gene.locus_order, Gene.alpha_order)\
                                 .filter(Sample.id == AllelesSample.sample_id)\
                                 .filter(Allele.id == AllelesSample.allele_id)\
                                 .filter(Gene.id == Allele.gene_id)\
@@ -52,22 +52,7 @@ def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_sa
             if params['ambiguous_alleles'] == 'Exclude':
                 app_query = app_query.filter(Allele.is_single_allele == 1)
 
-            appearances.extend(app_query.all())
-
-        for app in appearances:
-            _, patient_name, gene, allele, sample, locus_order, alpha_order = app
-            allele = allele.split('*', 1)[1].upper()
-            if gene not in counts:
-                if params['sort_order'] == 'Alphabetic':
-                    counts[gene] = [{}, [], alpha_order]
-                else:
-                    counts[gene] = [{}, [], locus_order]
-            if allele not in counts[gene][0]:
-                counts[gene][0][allele] = []
-            if patient_name not in counts[gene][0][allele]:
-                counts[gene][0][allele].append(patient_name)
-            if patient_name not in counts[gene][1]:
-                counts[gene][1].append(patient_name)
+            add_appearances(app_query.distinct().all(), appearances, gene_orders, params)
 
     gen_samples_by_dataset = {}
     for gen_sample in genomic_samples:
@@ -77,16 +62,16 @@ def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_sa
 
     for dataset in gen_samples_by_dataset.keys():
         session = genomic_dbs[species][dataset].session
-        appearances = []
 
         for sample_chunk in chunk_list(gen_samples_by_dataset[dataset], SAMPLE_CHUNKS):
             sample_list = session.query(GenomicSample.sample_name).filter(GenomicSample.sample_name.in_(sample_chunk)).all()
             sample_list, wanted_genes = apply_rep_filter_params(params, sample_list, session)
             sample_list = [s[0] for s in sample_list]
 
-            app_query = session.query(GenomicSample.sample_name,
-                                      GenomicGene.name,
+            # genomic samples are counted as patients
+            app_query = session.query(GenomicGene.name,
                                       GenomicSequence.name,
+                                      GenomicSample.sample_name,
                                       GenomicGene.locus_order,
                                       GenomicGene.alpha_order)\
                 .filter(GenomicSample.id == GenomicSampleSequence.sample_id) \
@@ -102,28 +87,15 @@ def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_sa
             if not params['f_pseudo_genes']:
                 app_query = app_query.filter(GenomicSequence.functional == 'Functional')
 
-            appearances.extend(app_query.all())
-
-        for app in appearances:
-            patient_name, gene, allele, locus_order, alpha_order = app
-            allele = allele.split('*', 1)[1].upper()
-            if gene not in counts:
-                if params['sort_order'] == 'Alphabetic':
-                    counts[gene] = [{}, [], alpha_order]
-                else:
-                    counts[gene] = [{}, [], locus_order]
-            if allele not in counts[gene][0]:
-                counts[gene][0][allele] = []
-            if patient_name not in counts[gene][0][allele]:
-                counts[gene][0][allele].append(patient_name)
-            if patient_name not in counts[gene][1]:
-                counts[gene][1].append(patient_name)
+            add_appearances(app_query.distinct().all(), appearances, gene_orders, params)
+
+    allele_counts, gene_counts = distinct_patient_counts(appearances)
 
     single_alleles = []
     multi_alleles = []
 
-    for gene, (alleles, total, order) in counts.items():
-        row = [gene, sorted(list(alleles.keys())), [len(alleles[a]) for a in sorted(alleles.keys())], len(total), order]
+    for gene, alleles in allele_counts.items():
+        row = [gene, sorted(list(alleles.keys())), [alleles[a] for a in sorted(alleles.keys())], gene_counts[gene], gene_orders[gene]]
         if len(alleles) > 1:
             multi_alleles.append(row)
         else:
@@ -167,6 +139,15 @@ def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_sa
         raise BadRequest('No output from report')
 
 
+# rows: (gene, allele name, patient name, locus order, alpha order)
+
+def add_appearances(rows, appearances, gene_orders, params):
+    for gene, allele, patient_name, locus_order, alpha_order in rows:
+        appearances.append((gene, allele, patient_name))
+        if gene not in gene_orders:
+            gene_orders[gene] = alpha_order if params['sort_order'] == 'Alphabetic' else locus_order
+
+
 def write_gene(book, gene):
     sheet = book.add_sheet(gene[0].replace("/","-"))
 
@@ -2,7 +2,7 @@
 
 from werkzeug.exceptions import BadRequest
 from api.reports.reports import send_report
-from api.reports.report_utils import make_output_file, chunk_list
+from api.reports.report_utils import make_output_file, chunk_list, distinct_patient_counts
 from app import vdjbase_dbs, genomic_dbs
 from db.vdjbase_model import AllelesSample, Gene, Allele
 from db.vdjbase_airr_model import Sample, Patient
@@ -51,11 +51,11 @@ def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_sa
                 else:
                         gene_order[gene.name] = gene.locus_order
 
-    rep_counts = {}
+    # (gene, allele, patient) appearances in each type of dataset, counted by distinct patient below
+    appearances = []
 
     for dataset in rep_samples_by_dataset.keys():
         session = vdjbase_dbs[species][dataset].session
-        appearances = []
 
         for sample_chunk in chunk_list(rep_samples_by_dataset[dataset], SAMPLE_CHUNKS):
             sample_list = session.query(Sample.sample_name).filter(Sample.sample_name.in_(sample_chunk)).all()
@@ -63,7 +63,7 @@ def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_sa
             all_wanted_genes.extend(wanted_genes)
             sample_list = [s[0] for s in sample_list]
 
-            app_query = session.query(AllelesSample.patient_id, Gene.name, Allele.name, Sample.sample_name, Patient.patient_name)\
+            app_query = session.query(Gene.name, Allele.name, Patient.patient_name)\
                                 .filter(Sample.id == AllelesSample.sample_id)\
                                 .filter(Allele.id == AllelesSample.allele_id)\
                                 .filter(Gene.id == Allele.gene_id)\
@@ -77,19 +77,9 @@ def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_sa
             if params['ambiguous_alleles'] == 'Exclude':
                 app_query = app_query.filter(Allele.is_single_allele == 1)
 
-            appearances.extend(app_query.all())
+            appearances.extend(app_query.distinct().all())
 
-        for app in appearances:
-            pid, gene, allele, sample, patient_name = app
-            allele = allele.split('*', 1)[1].upper()
-            if gene not in rep_counts:
-                rep_counts[gene] = [{}, []]
-            if allele not in rep_counts[gene][0]:
-                rep_counts[gene][0][allele] = []
-            if patient_name not in rep_counts[gene][0][allele]:
-                rep_counts[gene][0][allele].append(patient_name)
-            if patient_name not in rep_counts[gene][1]:
-                rep_counts[gene][1].append(patient_name)
+    rep_counts, _ = distinct_patient_counts(appearances)
 
     gen_samples_by_dataset = {}
     for gen_sample in genomic_samples:
@@ -126,11 +116,10 @@ def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_sa
                 else:
                     gene_order[gene.name] = gene.locus_order
 
-    gen_counts = {}
+    appearances = []
 
     for dataset in gen_samples_by_dataset.keys():
         session = genomic_dbs[species][dataset].session
-        appearances = []
 
         for sample_chunk in chunk_list(gen_samples_by_dataset[dataset], SAMPLE_CHUNKS):
             sample_list = session.query(GenomicSample.sample_name).filter(GenomicSample.sample_name.in_(sample_chunk)).all()
@@ -138,10 +127,10 @@ def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_sa
             all_wanted_genes.extend(wanted_genes)
             sample_list = [s[0] for s in sample_list]
 
-            app_query = session.query(GenomicSample.id,
-                                      GenomicSample.sample_name,
+            # genomic samples are counted as patients
+            app_query = session.query(GenomicGene.name,
                                       GenomicSequence.name,
-                                      GenomicGene.name) \
+                                      GenomicSample.sample_name) \
                 .filter(GenomicSample.id == GenomicSampleSequence.sample_id) \
                 .filter(GenomicSequence.id == GenomicSampleSequence.sequence_id) \
                 .filter(GenomicSequence.type.in_(['V-REGION', 'D-REGION', 'J-REGION'])) \
@@ -155,25 +144,12 @@ def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_sa
             if not params['f_pseudo_genes']:
                 app_query = app_query.filter(GenomicSequence.functional == 'Functional')
 
-            appearances.extend(app_query.all())
+            appearances.extend(app_query.distinct().all())
 
-        for app in appearances:
-            _, patient_name, allele, gene = app
-            allele = allele.split('*', 1)[1].upper()
-
-            if gene not in gen_counts:
-                gen_counts[gene] = [{}, [], {}, {}]
-            if allele not in gen_counts[gene][0]:
-                gen_counts[gene][0][allele] = []
-                gen_counts[gene][2][allele] = []
-                gen_counts[gene][3][allele] = []
-            if patient_name not in gen_counts[gene][0][allele]:
-                gen_counts[gene][0][allele].append(patient_name)
-            if patient_name not in gen_counts[gene][1]:
-                gen_counts[gene][1].append(patient_name)
+    gen_counts, _ = distinct_patient_counts(appearances)
 
     imgt_counts = {}
-    all_wanted_genes = list(set(all_wanted_genes))
+    all_wanted_genes = set(all_wanted_genes)
 
     for ref in imgt_refs.keys():
         ref = ref.upper()
@@ -182,9 +158,9 @@ def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_sa
 
         if gene in all_wanted_genes:
             if gene not in imgt_counts:
-                imgt_counts[gene] = [{}, [1]]
-            if allele not in imgt_counts[gene][0] and allele != 'DEL':
-                imgt_counts[gene][0][allele] = [1]
+                imgt_counts[gene] = {}
+            if allele != 'DEL':
+                imgt_counts[gene][allele] = 1
 
     headers = ['Allele', 'IMGT', 'AIRR-Seq', 'Genomic']
 
@@ -200,7 +176,7 @@ def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_sa
 
         for counts in [imgt_counts, rep_counts, gen_counts]:
             if gene in counts:
-                for allele in counts[gene][0].keys():
+                for allele in counts[gene].keys():
                     if '_' in allele:
                         if allele not in novel_alleles:
                             novel_alleles.append(allele)
@@ -216,9 +192,7 @@ def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_sa
         def allele_count(gene, allele, counts):
             if gene not in counts:
                 return 0
-            if allele not in counts[gene][0]:
-                return 0
-            return len(counts[gene][0][allele])
+            return counts[gene].get(allele, 0)
 
 
         for allele in ref_alleles:
@@ -2,10 +2,10 @@
 
 from werkzeug.exceptions import BadRequest
 from api.reports.reports import run_rscript, send_report
-from api.reports.report_utils import make_output_file, collate_samples, chunk_list, collate_gen_samples
+from api.reports.report_utils import make_output_file, write_report_input, collate_samples, chunk_list, collate_gen_samples
 
 from app import vdjbase_dbs, genomic_dbs
-from db.vdjbase_model import AllelesSample, Gene, Allele, AllelesPattern
+from db.vdjbase_model import AllelesSample, Gene, Allele
 from db.genomic_db import Sequence as GenomicSequence, SampleSequence as GenomicSampleSequence, Gene as GenomicGene
 from db.genomic_airr_model import Sample as GenomicSample
 
@@ -88,20 +88,9 @@ def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_sa
                 gene_allele_names.append(allele_name)
                 i += 1
 
-            gene_allele_names = set(gene_allele_names)
-
-            # If we have both an unambiguous allele and an ambiguous allele containing that unambiguous one,
-            # drop the unambiguous one because it is already counted
+            # Ambiguous alleles are counted alongside the unambiguous alleles they contain
 
-            if(params['ambiguous_alleles'] != 'Exclude'):
-                patterns = session.query(AllelesPattern.pattern_id)\
-                    .filter(AllelesPattern.allele_in_p_id.in_(gene_allele_names))\
-                    .filter(AllelesPattern.pattern_id.in_(gene_allele_names))\
-                    .all()
-
-                if patterns is not None and len(patterns) >0:
-                    patterns = set([pattern[0] for pattern in patterns])
-                    gene_allele_names = gene_allele_names - patterns
+            gene_allele_names = set(gene_allele_names)
 
             if gene_name not in gene_allele_counts:
                 gene_allele_counts[gene_name] = gene_allele_names
@@ -165,9 +154,8 @@ def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_sa
         listed_allele_count.append((gene, len(alleles)))
 
     labels = ['GENE', 'COUNT']
-    input_path = make_output_file('tab')
     df = pd.DataFrame(listed_allele_count, columns=labels)
-    df.to_csv(input_path, sep='\t', index=False)
+    input_path = write_report_input(df)
     output_path = make_output_file('html')
 
     cmd_line = ["-i", input_path,
@@ -5,9 +5,31 @@ from db.genomic_airr_model import Sample as GenomicSample
 from db.vdjbase_model import Gene, Allele, AllelesSample
 from db.vdjbase_airr_model import Sample
 from receptor_utils.simple_bio_seq import read_csv
+from api.reports.report_utils import chunk_list
 
 import pandas as pd
 
+SAMPLE_CHUNKS = 400
+
+GENOTYPE_COLUMNS = ['subject', 'gene', 'alleles', 'counts', 'total', 'note', 'kh', 'kd', 'kt', 'kq', 'k_diff',
+                    'GENOTYPED_ALLELES', 'Freq_by_Clone', 'Freq_by_Seq']
+
+# values of the fake rows that stand for genes missing from a genotype
+UNKNOWN_GENE = {
+    'alleles': 'Unk',
+    'counts': '',
+    'total': 0,
+    'note': '',
+    'kh': '1',
+    'kd': '1',
+    'kt': '1',
+    'kq': '1',
+    'k_diff': 0,
+    'GENOTYPED_ALLELES': 'Unk',
+    'Freq_by_Clone': '',
+    'Freq_by_Seq': '',
+}
+
 def fake_genotype(subject, genes):
     genotype = []
     for gene_name, gene_details in genes.items():
@@ -37,6 +59,22 @@ def fake_gene(gene_details, gene_name, subject):
     return rec
 
 
+# The name of an allele in a genotype: the part after the '*'
+
+def genotype_allele_name(allele):
+    if '*' in allele:
+        return allele.split('*')[1]
+    elif '.' in allele:         # cirelli format
+        if allele[-2:-1] == '.' and allele[-1].isalpha():
+            return '01_' + allele[-1]
+        elif '_' in allele.replace('LJI.Rh_', ''):
+            return '01_' + allele.replace('LJI.Rh_', '').split('_')[-1]
+        else:
+            return '01'
+    else:
+        return allele    # don't expect this to happen
+
+
 def process_genomic_genotype(sample_name, wanted_genes, session, functional, fully_haplotyped):
     allele_query = session.query(GenomicSample.sample_name, GenomicSequence.name, GenomicGene.name, GenomicSampleSequence.haplotype)\
         .filter(GenomicSample.sample_name == sample_name) \
@@ -58,17 +96,7 @@ def process_genomic_genotype(sample_name, wanted_genes, session, functional, ful
         if gene not in genes:
             genes[gene] = {'alleles': [], 'count': [], 'fc': [], 'fs': [], 'haplotypes': []}
 
-        if '*' in allele:
-            allele_name = allele.split('*')[1]
-        elif '.' in allele:         # cirelli format
-            if allele[-2:-1] == '.' and allele[-1].isalpha():
-                allele_name = '01_' + allele[-1]
-            elif '_' in allele.replace('LJI.Rh_', ''):
-                allele_name = '01_' + allele.replace('LJI.Rh_', '').split('_')[-1]
-            else:
-                allele_name = '01'
-        else:
-            allele_name = allele    # don't expect this to happen
+        allele_name = genotype_allele_name(allele)
 
         if allele_name not in genes[gene]['alleles']:
             genes[gene]['alleles'].append(allele_name)
@@ -112,17 +140,7 @@ def process_repseq_genotype(sample_name, wanted_genes, session, functional):
         if gene not in genes:
             genes[gene] = {'alleles': [], 'count': [], 'fc': [], 'fs': []}
 
-        if '*' in allele:
-            allele_name = allele.split('*')[1]
-        elif '.' in allele:         # cirelli format
-            if allele[-2:-1] == '.' and allele[-1].isalpha():
-                allele_name = '01_' + allele[-1]
-            elif '_' in allele.replace('LJI.Rh_', ''):
-                allele_name = '01_' + allele.replace('LJI.Rh_', '').split('_')[-1]
-            else:
-                allele_name = '01'
-        else:
-            allele_name = allele    # don't expect this to happen
+        allele_name = genotype_allele_name(allele)
 
         if allele_name not in genes[gene]['alleles']:
             genes[gene]['alleles'].append(allele_name)
@@ -136,3 +154,76 @@ def process_repseq_genotype(sample_name, wanted_genes, session, functional):
 
     geno_list = fake_genotype(sample_name, genes)
     return pd.DataFrame(geno_list)
+
+
+# Genotypes of a list of samples in a single query per chunk of samples, as one DataFrame with the columns of
+# process_repseq_genotype. Rows are grouped by sample, in the order of the query
+
+def process_repseq_genotypes(sample_names, wanted_genes, session, functional):
+    rows = []
+
+    for sample_chunk in chunk_list(list(sample_names), SAMPLE_CHUNKS):
+        query = session.query(Sample.sample_name, Gene.name, Allele.name, AllelesSample.count, AllelesSample.freq_by_clone,
+                              AllelesSample.freq_by_seq, AllelesSample.kdiff, AllelesSample.total_count) \
+            .filter(Sample.sample_name.in_(sample_chunk)) \
+            .join(AllelesSample, AllelesSample.sample_id == Sample.id) \
+            .join(Allele, AllelesSample.allele_id == Allele.id) \
+            .join(Gene, Allele.gene_id == Gene.id)
+
+        if len(wanted_genes) > 0:
+            query = query.filter(Gene.name.in_(wanted_genes))
+
+        if functional:
+            query = query.filter(Gene.pseudo_gene == False)
+
+        rows.extend(query.all())
+
+    if not rows:
+        return pd.DataFrame(columns=GENOTYPE_COLUMNS)
+
+    # object dtype, so that values are converted to strings as process_repseq_genotype converts them
+    alleles = pd.DataFrame(rows, columns=['subject', 'gene', 'allele', 'count', 'fc', 'fs', 'kdiff', 'total'], dtype=object)
+    alleles['allele'] = alleles['allele'].map({name: genotype_allele_name(name) for name in alleles['allele'].unique()})
+
+    for col in ['count', 'fc', 'fs', 'kdiff', 'total']:
+        alleles[col] = alleles[col].map(str)
+
+    repeats = alleles.duplicated(['subject', 'gene', 'allele'])
+    for allele_name in alleles.loc[repeats, 'allele']:
+        print(f"Allele {allele_name} seen multiply in genotype")
+    alleles = alleles[~repeats]
+
+    grouped = alleles.groupby(['subject', 'gene'], sort=False)
+    genotypes = pd.DataFrame({
+        'alleles': grouped['allele'].agg(','.join),
+        'counts': grouped['count'].agg(','.join),
+        'total': grouped['total'].last(),
+        'k_diff': grouped['kdiff'].last(),
+        'Freq_by_Clone': grouped['fc'].agg(';'.join),
+        'Freq_by_Seq': grouped['fs'].agg(';'.join),
+    }).reset_index()
+
+    genotypes['GENOTYPED_ALLELES'] = genotypes['alleles']
+    for col in ['note', 'kh', 'kd', 'kt', 'kq']:
+        genotypes[col] = UNKNOWN_GENE[col]
+
+    return genotypes[GENOTYPE_COLUMNS]
+
+
+# Add a fake 'Unk' row for each of the genes that is missing from each subject's genotype, and sort each genotype by gene
+# genotypes: a DataFrame of genotype rows. If a subject has more than one row for a gene, the last is kept
+# Returns rows grouped by subject, in the order of subjects
+
+def add_missing_genes(genotypes, subjects, genes):
+    subjects = list(dict.fromkeys(subjects))        # sample names can be repeated across datasets
+    genotypes = pd.concat([pd.DataFrame(columns=GENOTYPE_COLUMNS), genotypes], ignore_index=True)
+    genotypes = genotypes.drop_duplicates(['subject', 'gene'], keep='last').set_index(['subject', 'gene'])
+
+    index = genotypes.index.union(pd.MultiIndex.from_product([subjects, sorted(genes)], names=['subject', 'gene']))
+    genotypes = genotypes.reindex(index).fillna(UNKNOWN_GENE).reset_index()
+
+    genotypes['subject'] = pd.Categorical(genotypes['subject'], categories=subjects, ordered=True)
+    genotypes = genotypes.sort_values(by=['subject', 'gene'], kind='stable')
+    genotypes['subject'] = genotypes['subject'].astype(object)
+
+    return genotypes[GENOTYPE_COLUMNS].reset_index(drop=True)
@@ -2,9 +2,10 @@
 
 from werkzeug.exceptions import BadRequest
 
-from api.reports.report_utils import make_output_file, trans_df, collate_samples, chunk_list, find_primer_translations, translate_primer_alleles, translate_primer_genes
+from api.reports.report_utils import make_output_file, write_report_input, trans_df, collate_samples, chunk_list, dataset_primer_translations, translate_haplotype
 from api.reports.reports import run_rscript, send_report
-from app import vdjbase_dbs
+from db.dataset_cache import DatasetCache, DataFrameFormat
+from app import app, vdjbase_dbs
 from db.vdjbase_model import HaplotypesFile, SamplesHaplotype
 from db.vdjbase_airr_model import Sample
 import os
@@ -14,6 +15,9 @@ import pandas as pd
 HEATMAP_HAPLOTYPE_SCRIPT = "haplotype_heatmap.R"
 SAMPLE_CHUNKS = 400
 
+# parsed and translated haplotypes of each dataset, by haplotyping gene, with a 'file' column naming each row's file
+haplotype_cache = DatasetCache('haplotypes', os.path.join(app.config['OUTPUT_PATH'], 'haplotypes'), DataFrameFormat())
+
 
 def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_samples, params):
     if len(rep_samples) == 0:
@@ -25,16 +29,17 @@ def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_sa
     html = (format == 'html')
 
     chain, samples_by_dataset = collate_samples(rep_samples)
-    haplotypes = pd.DataFrame()
+    haplotypes = []
 
     for dataset in samples_by_dataset.keys():
         session = vdjbase_dbs[species][dataset].session
-        primer_trans, gene_subs = find_primer_translations(session)
 
         haplos = []
+        wanted_genes = set()
         for sample_chunk in chunk_list(samples_by_dataset[dataset], SAMPLE_CHUNKS):
             sample_list = session.query(Sample.sample_name, Sample.genotype, Sample.patient_id).filter(Sample.sample_name.in_(sample_chunk)).all()
-            sample_list, wanted_genes = apply_rep_filter_params(params, sample_list, session)
+            sample_list, chunk_wanted_genes = apply_rep_filter_params(params, sample_list, session)
+            wanted_genes |= set(chunk_wanted_genes)
             sample_list = [s[0] for s in sample_list]
             haplo_query = session.query(Sample.sample_name, HaplotypesFile.file)\
                 .filter(Sample.sample_name.in_(sample_list))\
@@ -43,32 +48,32 @@ def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_sa
                 .filter(HaplotypesFile.by_gene == params['haplo_gene'])
             haplos.extend(haplo_query.all())
 
-        for name, filename in haplos:
-            sample_path = os.path.join(VDJBASE_SAMPLE_PATH, species, dataset, filename.replace('samples/', ''))
-
-            if not os.path.isfile(sample_path):
-                raise BadRequest('Haplotype file %s is missing.' % (sample_path))
+        if not haplos:
+            continue
 
-            haplotype = pd.read_csv(sample_path, sep='\t', dtype=str)
-            haplotype = trans_df(haplotype)
-            haplotype['subject'] = name if len(samples_by_dataset) == 1 else dataset + '_' + name
+        dataset_haplotypes = haplotype_cache.get((species, dataset, params['haplo_gene']), vdjbase_dbs[species][dataset].created,
+                                                 lambda: read_dataset_haplotypes(species, dataset, params['haplo_gene']))
 
-            # translate pipeline allele names to VDJbase allele names
+        cached_files = set(dataset_haplotypes['file'])
+        for name, filename in haplos:
+            sample_path = haplotype_file_path(species, dataset, filename)
+            if filename not in cached_files and not os.path.isfile(sample_path):
+                raise BadRequest('Haplotype file %s is missing.' % (sample_path))
 
-            col_names = list(haplotype.columns.values)
-            for i in (2, 3, 4):
-                haplotype[col_names[i]] = [translate_primer_alleles(x, y, primer_trans) for x, y in zip(haplotype['gene'], haplotype[col_names[i]])]
+        selected = pd.DataFrame(haplos, columns=['sample_name', 'file'])
+        haplotype = selected.merge(dataset_haplotypes, on='file', how='inner')
+        haplotype['subject'] = haplotype['sample_name'] if len(samples_by_dataset) == 1 else dataset + '_' + haplotype['sample_name']
+        haplotype = haplotype[haplotype.gene.isin(wanted_genes)]
 
-            haplotype['gene'] = [translate_primer_genes(x, gene_subs) for x in haplotype['gene']]
-            haplotype = haplotype[haplotype.gene.isin(wanted_genes)]
+        columns = [c for c in dataset_haplotypes.columns if c != 'file']
+        haplotypes.append(haplotype[columns + ['subject'] if 'subject' not in columns else columns])
 
-            haplotypes = pd.concat([haplotypes, haplotype], keys=None, ignore_index=True)[haplotype.columns.tolist()]
+    haplotypes = pd.concat(haplotypes, ignore_index=True) if haplotypes else pd.DataFrame()
 
     if len(haplotypes) == 0:
         raise BadRequest('No records matching the filter criteria were found.')
 
-    haplo_path = make_output_file('tsv')
-    haplotypes.to_csv(haplo_path, sep='\t', index=False)
+    haplo_path = write_report_input(haplotypes)
     attachment_filename = '%s_haplotype_heatmap.pdf' % species
 
     if not params['f_kdiff'] or params['f_kdiff'] == '':
@@ -90,3 +95,31 @@ def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_sa
         raise BadRequest('No output from report')
 
 
+def haplotype_file_path(species, dataset, filename):
+    return os.path.join(VDJBASE_SAMPLE_PATH, species, dataset, filename.replace('samples/', ''))
+
+
+# Read all haplotype files of a dataset for the given haplotyping gene, translating pipeline allele names to VDJbase
+# allele names. Files that are missing are skipped
+
+def read_dataset_haplotypes(species, dataset, by_gene):
+    session = vdjbase_dbs[species][dataset].session
+    primer_trans, gene_subs = dataset_primer_translations(species, dataset)
+
+    filenames = session.query(HaplotypesFile.file).filter(HaplotypesFile.by_gene == by_gene).distinct().all()
+
+    haplotypes = []
+    for (filename,) in filenames:
+        sample_path = haplotype_file_path(species, dataset, filename)
+
+        if not os.path.isfile(sample_path):
+            continue
+
+        haplotype = trans_df(pd.read_csv(sample_path, sep='\t', dtype=str))
+        haplotype['file'] = filename
+        haplotypes.append(haplotype)
+
+    if not haplotypes:
+        return pd.DataFrame(columns=['gene', 'file'])
+
+    return translate_haplotype(pd.concat(haplotypes, ignore_index=True), primer_trans, gene_subs)
@@ -2,9 +2,9 @@
 
 from werkzeug.exceptions import BadRequest
 from api.reports.reports import run_rscript, send_report
-from api.reports.report_utils import make_output_file, collate_samples, chunk_list
+from api.reports.report_utils import make_output_file, write_report_input, collate_samples, chunk_list, load_allele_patterns, drop_contained_patterns
 from app import vdjbase_dbs
-from db.vdjbase_model import AllelesSample, Gene, Allele, AllelesPattern
+from db.vdjbase_model import AllelesSample, Gene, Allele
 from db.vdjbase_airr_model import Patient, Sample
 import os
 from api.vdjbase.vdjbase import apply_rep_filter_params
@@ -58,6 +58,9 @@ def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_sa
 
             allele_sample_recs.extend(query.all())
 
+        if params['ambiguous_alleles'] != 'Exclude':
+            patterns = load_allele_patterns(session, set([rec[0] for rec in allele_sample_recs]))
+
         # As the result is indexed, run over each gene in turn, count the number of alleles found in each patient, update h_counts accordingly
 
         i = 0
@@ -83,18 +86,8 @@ def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_sa
 
                 patient_allele_ids = set(patient_allele_ids)
 
-                # If we have both an unambiguous allele and an ambiguous allele containing that unambiguous one,
-                # drop the unambiguous one because it is already counted
-
                 if params['ambiguous_alleles'] != 'Exclude':
-                    patterns = session.query(AllelesPattern.pattern_id)\
-                        .filter(AllelesPattern.allele_in_p_id.in_(patient_allele_ids))\
-                        .filter(AllelesPattern.pattern_id.in_(patient_allele_ids))\
-                        .all()
-
-                    if patterns is not None and len(patterns) >0:
-                        patterns = set([pattern[0] for pattern in patterns])
-                        patient_allele_ids = patient_allele_ids - patterns
+                    patient_allele_ids = drop_contained_patterns(patient_allele_ids, patterns)
 
                 if len(patient_allele_ids) > 1:
                     h_counts[1] += 1
@@ -106,10 +99,9 @@ def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_sa
             else:
                 gene_hetrozygous_dis[target_gene] = (target_gene, gene_hetrozygous_dis[target_gene][1] + h_counts[0], gene_hetrozygous_dis[target_gene][2] + h_counts[1])
 
-    haplo_path = make_output_file('tab')
     labels = ['GENE', 'HM', 'HT']
     df = pd.DataFrame(gene_hetrozygous_dis.values(), columns=labels)
-    df.to_csv(haplo_path, sep='\t', index=False)
+    haplo_path = write_report_input(df)
     output_path = make_output_file('html')
 
     cmd_line = ["-i", haplo_path,
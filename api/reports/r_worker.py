@@ -0,0 +1,203 @@
+# Pool of long-lived R processes that run report scripts (see R_scripts/r_worker.R)
+#
+# Each worker has the packages used by the scripts loaded, so that a report does not pay R's start-up and loading
+# costs. A worker is checked with a ping before each job, and is replaced after max_jobs jobs, so that anything
+# a script leaves behind does not accumulate. Celery runs one task at a time in each worker process, so the pool
+# belongs to the process that creates it.
+#
+# Output from R is read on a thread of its own, so that it is passed on as it arrives, the pipe never fills, and a
+# script that runs for too long can be stopped: R processes run in a process group of their own, which is killed.
+
+import json
+import os
+import queue
+import signal
+import subprocess
+import threading
+import time
+
+RESPONSE_MARKER = '@@R_WORKER_RESPONSE@@ '
+WORKER_SCRIPT = 'r_worker.R'
+STARTUP_TIMEOUT = 120           # seconds allowed for a worker to load its packages, or answer a ping
+
+
+class RWorkerError(Exception):
+    pass
+
+
+class RScriptTimeout(Exception):
+    pass
+
+
+# Reads lines from a stream on a thread of its own, so that they can be waited for with a deadline
+
+class LineReader():
+    def __init__(self, stream):
+        self.lines = queue.Queue()
+        self.thread = threading.Thread(target=self._read, args=(stream,), daemon=True)
+        self.thread.start()
+
+    def _read(self, stream):
+        for line in stream:
+            self.lines.put(line)
+        self.lines.put(None)
+
+    # Return the next line, or None at the end of the stream. Raises RScriptTimeout if the deadline
+    # (a time.monotonic() value) passes first
+
+    def readline(self, deadline=None):
+        try:
+            return self.lines.get(timeout=None if deadline is None else max(0, deadline - time.monotonic()))
+        except queue.Empty:
+            raise RScriptTimeout()
+
+
+def start_r_process(cmd_line, cwd, stdin=None):
+    return subprocess.Popen(cmd_line, cwd=cwd, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            text=True, bufsize=1, start_new_session=True)
+
+
+def kill_process_group(proc):
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+        proc.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        proc.wait()
+    except ProcessLookupError:
+        proc.wait()
+
+
+# Run a command, passing each line of its output (stdout and stderr combined) to output(line)
+# Returns the exit code. If the command runs for longer than timeout seconds, it is killed and RScriptTimeout raised
+
+def run_r_process(cmd_line, cwd, output, timeout=None):
+    proc = start_r_process(cmd_line, cwd)
+    reader = LineReader(proc.stdout)
+    deadline = time.monotonic() + timeout if timeout else None
+
+    try:
+        while (line := reader.readline(deadline)) is not None:
+            output(line)
+    except RScriptTimeout:
+        kill_process_group(proc)
+        raise
+
+    return proc.wait()
+
+
+class RWorker():
+    def __init__(self, script_path):
+        self.jobs = 0
+        self.proc = start_r_process(['Rscript', os.path.join(script_path, WORKER_SCRIPT)], script_path, stdin=subprocess.PIPE)
+        self.reader = LineReader(self.proc.stdout)
+
+    # Send a request and return the response. output(line) is called with each line the worker prints on the way
+    # If there is no response within timeout seconds, the worker is killed and RScriptTimeout raised
+
+    def request(self, request, output=None, timeout=None):
+        try:
+            self.proc.stdin.write(json.dumps(request) + '\n')
+            self.proc.stdin.flush()
+        except OSError as e:
+            raise RWorkerError('R worker is not accepting requests: %s' % e)
+
+        deadline = time.monotonic() + timeout if timeout else None
+
+        try:
+            while (line := self.reader.readline(deadline)) is not None:
+                # the marker can follow output that the script left without a closing newline
+                if RESPONSE_MARKER in line:
+                    script_output, response = line.split(RESPONSE_MARKER, 1)
+                    if script_output and output is not None:
+                        output(script_output)
+                    return json.loads(response)
+                if output is not None:
+                    output(line)
+        except RScriptTimeout:
+            kill_process_group(self.proc)
+            raise
+
+        raise RWorkerError('R worker exited with code %s' % self.proc.wait())
+
+    def healthy(self):
+        if self.proc.poll() is not None:
+            return False
+        try:
+            return self.request({'ping': True}, timeout=STARTUP_TIMEOUT).get('status') == 'ok'
+        except (RWorkerError, RScriptTimeout, ValueError):
+            return False
+
+    def stop(self):
+        try:
+            self.proc.stdin.close()
+            self.proc.wait(timeout=5)
+        except Exception:
+            kill_process_group(self.proc)
+
+
+class RWorkerPool():
+    def __init__(self, script_path, size=1, max_jobs=20):
+        self.script_path = script_path
+        self.max_jobs = max_jobs
+        self.idle = []
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(size)
+
+    # Run a script with the given arguments. Returns the worker's response: {'status': 'ok'} or
+    # {'status': 'error', 'error': <message>}. Raises RWorkerError if no worker could run the script, or
+    # RScriptTimeout if the script did not finish within timeout seconds
+
+    def run(self, script, args, cwd, output=None, timeout=None):
+        with self.slots:
+            worker = self._acquire()
+
+            try:
+                response = worker.request({'script': script, 'args': args, 'cwd': cwd}, output, timeout)
+            except Exception:
+                worker.stop()
+                raise
+
+            worker.jobs += 1
+
+            if worker.jobs >= self.max_jobs:
+                worker.stop()
+            else:
+                with self.lock:
+                    self.idle.append(worker)
+
+            return response
+
+    def _acquire(self):
+        while True:
+            with self.lock:
+                worker = self.idle.pop() if self.idle else None
+
+            if worker is None:
+                break
+
+            if worker.healthy():
+                return worker
+
+            worker.stop()
+
+        try:
+            worker = RWorker(self.script_path)
+        except OSError as e:
+            raise RWorkerError('Unable to start R worker: %s' % e)
+
+        if not worker.healthy():
+            worker.stop()
+            raise RWorkerError('R worker failed to start')
+
+        return worker
+
+    def close(self):
+        with self.lock:
+            workers, self.idle = self.idle, []
+
+        for worker in workers:
+            worker.stop()
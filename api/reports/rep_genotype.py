@@ -6,7 +6,7 @@ from werkzeug.exceptions import BadRequest
 
 from app import vdjbase_dbs, genomic_dbs
 from api.reports.reports import run_rscript, send_report
-from api.reports.report_utils import make_output_file, collate_samples, collate_gen_samples
+from api.reports.report_utils import make_output_file, write_report_input, collate_samples, collate_gen_samples
 from db.vdjbase_airr_model import Sample
 from db.genomic_airr_model import Sample as GenomicSample
 from api.vdjbase.vdjbase import apply_rep_filter_params, get_multiple_order_file
@@ -82,9 +82,8 @@ def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_sa
 
         genotypes[subject_name] = pd.concat([genotype, pd.DataFrame(fakes)], ignore_index=True)
 
-    geno_path = make_output_file('tsv')
     genotypes = pd.concat(genotypes)
-    genotypes.to_csv(geno_path, sep='\t')
+    geno_path = write_report_input(genotypes, index=True)
 
     if format == 'pdf':
         attachment_filename = '%s_sampled_genotype.pdf' % (species)
@@ -3,10 +3,10 @@
 from werkzeug.exceptions import BadRequest
 
 
-from api.reports.rep_genotype import fake_gene, process_genomic_genotype, process_repseq_genotype
+from api.reports.genotypes import process_genomic_genotype, process_repseq_genotypes, add_missing_genes
 from api.reports.report_utils import collate_samples, chunk_list, collate_gen_samples
 from api.reports.reports import run_rscript, send_report
-from api.reports.report_utils import make_output_file
+from api.reports.report_utils import make_output_file, write_report_input
 from app import vdjbase_dbs, genomic_dbs
 from db.genomic_airr_model import Sample as GenomicSample
 
@@ -25,7 +25,8 @@ def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_sa
     html = (format == 'html')
     chain, rep_samples_by_dataset = collate_samples(rep_samples)
     g_chain, gen_samples_by_dataset = collate_gen_samples(genomic_samples)
-    genotypes = {}
+    genotypes = []
+    subjects = []
     all_wanted_genes = set()
     fully_haplotyped = 'Only' in params['geno_hap']
 
@@ -43,10 +44,9 @@ def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_sa
 
         if len(wanted_genes) > 0:
             all_wanted_genes |= set(wanted_genes)
-            for (name, genotype, patient_id) in sample_list:
-                session = vdjbase_dbs[species][dataset].session
-                genotype = process_repseq_genotype(name, all_wanted_genes, session, False)
-                genotypes[name] = genotype
+            sample_names = [name for (name, genotype, patient_id) in sample_list]
+            genotypes.append(process_repseq_genotypes(sample_names, all_wanted_genes, session, False))
+            subjects.extend(sample_names)
 
     for dataset in gen_samples_by_dataset.keys():
         session = genomic_dbs[species][dataset].session
@@ -66,30 +66,15 @@ def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_sa
         if len(wanted_genes) > 0:
             for (sample_name) in sample_list:
                 genotype = process_genomic_genotype(sample_name, all_wanted_genes, session, not params['f_pseudo_genes'], fully_haplotyped)
-                genotypes[sample_name] = genotype
+                genotypes.append(genotype)
+                subjects.append(sample_name)
 
-    if len(genotypes) == 0:
+    if len(subjects) == 0:
         raise BadRequest('No records matching the filter criteria were found.')
 
-    # add fakes to each genotype for missing genes
-
-    for subject_name, genotype in genotypes.items():
-        contained_genes = genotype['gene'].tolist() if len(genotype) > 0 else []
-
-        fakes = []
-        for gene in all_wanted_genes:
-            if gene not in contained_genes:
-                fakes.append(fake_gene({'alleles': ['Unk'], 'count': [], 'fc': [], 'fs': [], 'total_count': 0, 'kdiff': 0}, gene, subject_name))
-
-        genotypes[subject_name] = pd.concat([genotype, pd.DataFrame(fakes)], ignore_index=True)
-
-    # sort rows in each genotype by gene
-    for genotype in genotypes.values():
-        genotype.sort_values(by=['gene'], inplace=True)
-
-    geno_path = make_output_file('tsv')
-    genotypes = pd.concat(genotypes.values())
-    genotypes.to_csv(geno_path, sep='\t')
+    # add fakes to each genotype for missing genes, and sort rows in each genotype by gene
+    genotypes = add_missing_genes(pd.concat(genotypes, ignore_index=True), subjects, all_wanted_genes)
+    geno_path = write_report_input(genotypes, index=True)
 
     if format == 'pdf':
         attachment_filename = '%s_genotype.pdf' % species
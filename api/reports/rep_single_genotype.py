@@ -4,7 +4,7 @@ import os
 from werkzeug.exceptions import BadRequest
 from api.reports.genotypes import process_repseq_genotype, process_genomic_genotype
 from api.reports.reports import run_rscript, send_report
-from api.reports.report_utils import make_output_file
+from api.reports.report_utils import make_output_file, write_report_input
 from app import vdjbase_dbs, genomic_dbs
 from api.vdjbase.vdjbase import get_order_file
 
@@ -34,8 +34,7 @@ def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_sa
     if len(genotype) == 0:
         raise BadRequest('Genotype data for sample %s/%s is not available' % (sample['dataset'], sample['sample_name']))
 
-    sample_path = make_output_file('tsv')
-    genotype.to_csv(sample_path, sep='\t', index=False)
+    sample_path = write_report_input(genotype)
 
     locus_order = ('sort_order' in params and params['sort_order'] == 'Locus')
     gene_order_file = get_order_file(species, sample['dataset'], locus_order=locus_order)
@@ -0,0 +1,215 @@
+# Cache of report results
+#
+# A report's result is recorded against a hash of the request (report name, format, species, datasets, samples and
+# params) and of the creation date of each dataset involved, so that a repeat of the request can be answered with
+# the existing output file rather than by running the report again. Records are held as small JSON files, and are
+# ignored once the output file they point to has been removed from OUTPUT_PATH.
+#
+# Identical requests that arrive while a report is running are attached to the running task, rather than queueing
+# another: the id of the task running each request is held in the Celery result backend's Redis, for as long as
+# the task can run.
+#
+# Report output files in OUTPUT_PATH (those named by make_output_file) are evicted when they are older than
+# REPORT_CACHE_MAX_AGE (seconds since last use), and, oldest first, while they take up more than
+# REPORT_CACHE_MAX_SIZE (bytes). Other files in OUTPUT_PATH, such as the API's own caches, are left alone.
+
+import hashlib
+import json
+import os
+import re
+import time
+
+from celery import states
+from celery.utils import uuid
+
+from api.reports.report_utils import is_output_file
+from app import app, vdjbase_dbs, genomic_dbs
+from extensions import celery
+
+
+REPORT_CACHE_DIR = 'report_cache'
+IN_FLIGHT_PREFIX = 'digby_report_in_flight_'
+IN_FLIGHT_TIMEOUT = 660         # seconds: a little longer than run_report's time limit
+
+
+def report_cache_key(report_name, format, species, genomic_datasets, genomic_samples, rep_datasets, rep_samples, params):
+    # genomic and AIRR-seq datasets can share names (IGH, IGK, ...), so their dates are kept apart
+    created = {'genomic': {}, 'airrseq': {}}
+    for kind, dbs, datasets in (('genomic', genomic_dbs, genomic_datasets), ('airrseq', vdjbase_dbs, rep_datasets)):
+        for dataset in datasets or []:
+            if species in dbs and dataset in dbs[species]:
+                created[kind][dataset] = dbs[species][dataset].created
+
+    request = {
+        'report_name': report_name,
+        'format': format,
+        'species': species,
+        'genomic_datasets': genomic_datasets,
+        'genomic_samples': genomic_samples,
+        'rep_datasets': rep_datasets,
+        'rep_samples': rep_samples,
+        'params': params,
+        'created': created,
+    }
+
+    return hashlib.sha256(json.dumps(request, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def is_report_cache_key(key):
+    return re.fullmatch('[0-9a-f]{64}', key) is not None
+
+
+# Return the recorded result for a request, or None if there is none, or its output file has gone
+
+def cached_report(key):
+    if not is_report_cache_key(key):
+        return None
+
+    record_filename = _record_filename(key)
+
+    if not os.path.isfile(record_filename):
+        return None
+
+    try:
+        with open(record_filename, 'r') as fi:
+            result = json.load(fi)
+
+        output_filename = os.path.join(app.config['OUTPUT_PATH'], os.path.basename(result['url']))
+        if os.path.isfile(output_filename):
+            os.utime(output_filename)       # record the use, for eviction by age
+            os.utime(record_filename)
+            return result
+    except Exception as e:
+        print('Error reading report cache record %s: %s' % (record_filename, e))
+
+    _remove(record_filename)
+    return None
+
+
+# Record the result of a successful report
+
+def save_report_result(key, result):
+    if not isinstance(result, dict) or result.get('status') != 'ok' or not result.get('url'):
+        return
+
+    record_filename = _record_filename(key)
+
+    try:
+        os.makedirs(os.path.dirname(record_filename), exist_ok=True)
+        temp_filename = '%s.%d' % (record_filename, os.getpid())
+        with open(temp_filename, 'w') as fo:
+            json.dump(result, fo)
+        os.replace(temp_filename, record_filename)
+    except Exception as e:
+        print('Error saving report cache record %s: %s' % (record_filename, e))
+
+    evict_report_outputs()
+
+
+# Return the id of the task running an identical request, or start the report with a new task and return its id
+# start(task_id) should queue the task
+
+def start_report_job(key, start):
+    client = _redis_client()
+
+    if client is None:
+        return start(uuid())
+
+    in_flight_key = IN_FLIGHT_PREFIX + key
+
+    while True:
+        task_id = uuid()
+        if client.set(in_flight_key, task_id, nx=True, ex=IN_FLIGHT_TIMEOUT):
+            try:
+                return start(task_id)
+            except Exception:
+                # the task was never queued: release the request, so that identical requests do not wait on it
+                finish_report_job(key, task_id)
+                raise
+
+        running_id = client.get(in_flight_key)
+
+        if running_id is None:
+            continue        # the running task finished while we looked: try again
+
+        running_id = running_id.decode('utf-8')
+
+        if celery.AsyncResult(running_id).state not in states.READY_STATES:
+            return running_id
+
+        # the task finished without releasing the request (e.g. the worker was killed)
+        client.delete(in_flight_key)
+
+
+# Called by a task when it has finished running a request
+
+def finish_report_job(key, task_id):
+    client = _redis_client()
+
+    if client is None:
+        return
+
+    in_flight_key = IN_FLIGHT_PREFIX + key
+    running_id = client.get(in_flight_key)
+
+    if running_id is not None and running_id.decode('utf-8') == task_id:
+        client.delete(in_flight_key)
+
+
+def _redis_client():
+    return getattr(celery.backend, 'client', None)
+
+
+# Remove report outputs that are older than the maximum age, then the oldest until under the maximum size
+
+def evict_report_outputs():
+    max_age = app.config.get('REPORT_CACHE_MAX_AGE', 7 * 24 * 60 * 60)
+    max_size = app.config.get('REPORT_CACHE_MAX_SIZE', 5 * 1024 * 1024 * 1024)
+    now = time.time()
+
+    files = []
+    total_size = 0
+
+    with os.scandir(app.config['OUTPUT_PATH']) as entries:
+        for entry in entries:
+            try:
+                if not entry.is_file() or not is_output_file(entry.name):
+                    continue
+                st = entry.stat()
+            except OSError:
+                continue
+
+            if now - st.st_mtime > max_age:
+                _remove(entry.path)
+            else:
+                files.append((st.st_mtime, st.st_size, entry.path))
+                total_size += st.st_size
+
+    if total_size > max_size:
+        for mtime, size, path in sorted(files):
+            _remove(path)
+            total_size -= size
+            if total_size <= max_size:
+                break
+
+    # records of evicted outputs are otherwise only removed when next looked up
+    record_dir = os.path.join(app.config['OUTPUT_PATH'], REPORT_CACHE_DIR)
+    if os.path.isdir(record_dir):
+        with os.scandir(record_dir) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file() and now - entry.stat().st_mtime > max_age:
+                        _remove(entry.path)
+                except OSError:
+                    continue
+
+
+def _record_filename(key):
+    return os.path.join(app.config['OUTPUT_PATH'], REPORT_CACHE_DIR, key + '.json')
+
+
+def _remove(filename):
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
@@ -2,15 +2,23 @@
 # Functions to help report processing
 #
 
+import math
 import os.path
+import re
 import pandas as pd
 from werkzeug.exceptions import BadRequest
 import csv
 import tempfile
-from db.vdjbase_model import Allele
+from db.dataset_cache import DatasetCache
+from db.vdjbase_model import Allele, AllelesPattern, Gene
 import itertools
 
-from app import app
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+from app import app, vdjbase_dbs
 
 
 """ for the future """
@@ -69,6 +77,17 @@ trans_cols = {
 
 
 def check_tab_file(filename, dtype=None):
+    df = read_tab_file(filename, dtype)
+
+    filename = make_output_file(os.path.splitext(filename)[1].replace('.', ''))
+    df.to_csv(filename, sep='\t', index=True, na_rep='NA', quoting=csv.QUOTE_NONNUMERIC, index_label=False)
+
+    return filename
+
+
+# Read a tab file into a DataFrame, with correctly capitalised columns
+
+def read_tab_file(filename, dtype=None):
     if not os.path.isfile(filename):
         raise BadRequest('File %s is missing.' % filename)
 
@@ -77,12 +96,8 @@ def check_tab_file(filename, dtype=None):
     else:
         df = pd.read_csv(filename, sep='\t')
 
-    df = trans_df(df)
+    return trans_df(df)
 
-    filename = make_output_file(os.path.splitext(filename)[1].replace('.', ''))
-    df.to_csv(filename, sep='\t', index=True, na_rep='NA', quoting=csv.QUOTE_NONNUMERIC, index_label=False)
-
-    return filename
 
 def trans_df(df):
     renames = list(set(df.columns.values) & set(trans_cols.keys()))
@@ -94,14 +109,59 @@ def trans_df(df):
     return df
 
 
+OUTPUT_FILE_PREFIX = 'tmp'
+
+
+# True if a file name in the output directory is one made by make_output_file (the prefix, then tempfile's eight
+# random characters, then the format)
+def is_output_file(filename):
+    return re.fullmatch(OUTPUT_FILE_PREFIX + r'[a-z0-9_]{8}\.\w+', filename) is not None
+
+
 # Make a unique file in the output directory
 def make_output_file(format):
-    with tempfile.NamedTemporaryFile(suffix='.' + format, dir=app.config['OUTPUT_PATH'], delete=False) as fo:
+    with tempfile.NamedTemporaryFile(prefix=OUTPUT_FILE_PREFIX, suffix='.' + format, dir=app.config['OUTPUT_PATH'], delete=False) as fo:
         output_path = fo.name
         fo.close()
     return output_path
 
 
+# Write a DataFrame to be read by an R script (with read_report_input(), in R_scripts/report_input.R)
+# The file is tab-separated unless REPORT_INPUT_FORMAT is set to 'feather', in which case it is written in
+# Arrow/Feather format, provided that pyarrow is installed (the R arrow package must then be installed as well).
+# Text columns are written as to_csv() would write them, so that R sees the same values either way. Returns the
+# file's path
+
+def write_report_input(df, index=False, na_rep=''):
+    if pyarrow is None or app.config.get('REPORT_INPUT_FORMAT', 'tsv') != 'feather':
+        output_path = make_output_file('tsv')
+        df.to_csv(output_path, sep='\t', index=index, na_rep=na_rep)
+        return output_path
+
+    if index:
+        # name unnamed index columns as R names the unlabelled columns of a tab file: X, X.1, ...
+        index_labels = [name if name else 'X' if i == 0 else 'X.%d' % i for i, name in enumerate(df.index.names)]
+        df = df.reset_index()
+        df.columns = index_labels + list(df.columns[len(index_labels):])
+    else:
+        df = df.reset_index(drop=True)
+
+    df = df.copy()
+    df.columns = [str(c) for c in df.columns]
+
+    for col in df.columns:
+        if df[col].dtype == object:
+            df[col] = [(None if na_rep == 'NA' else na_rep) if is_na(v) else str(v) for v in df[col]]
+
+    output_path = make_output_file('feather')
+    df.to_feather(output_path)
+    return output_path
+
+
+def is_na(v):
+    return v is None or (isinstance(v, float) and math.isnan(v))
+
+
 # Collate samples from different datasets and determine chain
 
 def collate_samples(rep_samples):
@@ -138,6 +198,57 @@ def collate_gen_samples(gen_samples):
     return chain, samples_by_dataset
 
 
+# Count the distinct patients in which each allele, and each gene, appears
+# rows: (gene, allele name, patient name). Alleles are identified by the upper-cased part of the name after the '*'
+# Returns {gene: {allele: count}} and {gene: count}, with genes in the order in which they first appear
+
+def distinct_patient_counts(rows):
+    df = pd.DataFrame(rows, columns=['gene', 'allele', 'patient'])
+    df['allele'] = df['allele'].str.split('*', n=1).str[1].str.upper()
+    df = df.drop_duplicates()
+
+    allele_counts = {}
+    for (gene, allele), count in df.groupby(['gene', 'allele'], sort=False)['patient'].nunique().items():
+        if gene not in allele_counts:
+            allele_counts[gene] = {}
+        allele_counts[gene][allele] = int(count)
+
+    gene_counts = {gene: int(count) for gene, count in df.groupby('gene', sort=False)['patient'].nunique().items()}
+
+    return allele_counts, gene_counts
+
+
+# Load the allele patterns of the given genes: returns {allele id: set of ids of the ambiguous alleles (patterns) containing it}
+
+def load_allele_patterns(session, gene_names):
+    patterns = {}
+
+    for gene_chunk in chunk_list(list(gene_names), 400):
+        rows = session.query(AllelesPattern.allele_in_p_id, AllelesPattern.pattern_id)\
+            .join(Allele, Allele.id == AllelesPattern.allele_in_p_id)\
+            .join(Gene, Gene.id == Allele.gene_id)\
+            .filter(Gene.name.in_(gene_chunk))\
+            .all()
+
+        for allele_id, pattern_id in rows:
+            if allele_id not in patterns:
+                patterns[allele_id] = set()
+            patterns[allele_id].add(pattern_id)
+
+    return patterns
+
+
+# If a set of alleles contains both an unambiguous allele and an ambiguous allele containing that unambiguous one,
+# drop the ambiguous one, because the allele is already counted. patterns is as returned by load_allele_patterns
+
+def drop_contained_patterns(allele_ids, patterns):
+    contained = set()
+    for allele_id in allele_ids:
+        if allele_id in patterns:
+            contained |= patterns[allele_id] & allele_ids
+    return allele_ids - contained
+
+
 # split a list into chunks of length n
 
 def chunk_list(lst, n):
@@ -185,6 +296,34 @@ def find_primer_translations(session):
     return trans, gene_subs
 
 
+# find_primer_translations for a dataset, memoised until the dataset is rebuilt
+
+primer_translations = DatasetCache('primer_translations')
+
+
+def dataset_primer_translations(species, dataset):
+    content = vdjbase_dbs[species][dataset]
+    return primer_translations.get((species, dataset), content.created, lambda: find_primer_translations(content.session))
+
+
+# Translate pipeline allele and gene names in a haplotype DataFrame to VDJbase names, as translate_primer_alleles
+# and translate_primer_genes do for each row. The allele columns are the third, fourth and fifth columns
+
+def translate_haplotype(haplotype, primer_trans, gene_subs):
+    haplotype = haplotype.reset_index(drop=True)
+    short_names = {pn: name.split('*')[1] for pn, name in primer_trans.items() if name is not None and '*' in name}
+    genes = haplotype['gene'].astype(str)
+
+    for col in haplotype.columns.values[2:5]:
+        alleles = haplotype[col].where(haplotype[col].map(lambda x: isinstance(x, str)), '').str.replace(' ', '', regex=False)
+        alleles = alleles.str.split(',').explode()
+        translated = (genes.reindex(alleles.index) + '*' + alleles).map(short_names).fillna(alleles)
+        haplotype[col] = translated.groupby(level=0).agg(','.join)
+
+    haplotype['gene'] = haplotype['gene'].map(lambda x: gene_subs.get(x, x))
+    return haplotype
+
+
 def translate_primer_alleles(gene, alleles, primer_trans):
     ret = []
     if alleles is not None and isinstance(alleles, str) and len(alleles) > 0:
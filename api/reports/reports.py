@@ -14,16 +14,18 @@ from api.genomic.genomic import find_genomic_filter_params, find_genomic_samples
 from api.vdjbase.vdjbase import find_vdjbase_samples, find_rep_filter_params
 from app import app
 import importlib
-import subprocess
 import os
 import traceback
 from json.decoder import JSONDecodeError
 import tempfile
 from extensions import run_report
+from api.reports.report_cache import report_cache_key, cached_report, start_report_job
+from api.reports.r_worker import RWorkerPool, RWorkerError, RScriptTimeout, run_r_process
 from celery import current_task
 import flask_cors
 
 SYSDATA = os.path.join(app.config['R_SCRIPT_PATH'], 'sysdata.rda')
+R_PROGRESS_MARKER = 'PROGRESS:'
 
 ns = api.namespace('reports', description='Reports that can be run on subsets of genomic and repseq data')
 report_defs = None
@@ -186,8 +188,21 @@ class ReportsRunApi(Resource):
             # When working with Celery, remember that the code for reports (run() and its dependencies) must be
             # saved *and Celery restarted* for changes to take effect
 
-            result = run_report.delay(report_name, args.format, args.species, genomic_datasets, genomic_samples, rep_datasets, rep_samples, params)
-            return {'id': result.id, 'status': 'queued'}
+            # Return the output of an identical earlier request, if we still have it
+
+            cache_key = report_cache_key(report_name, args.format, args.species, genomic_datasets, genomic_samples, rep_datasets, rep_samples, params)
+            cached_result = cached_report(cache_key)
+
+            if cached_result is not None:
+                return {'id': cache_key, 'status': 'SUCCESS', 'results': cached_result}
+
+            # Attach to the task already running an identical request, if there is one
+
+            job_id = start_report_job(cache_key, lambda task_id: run_report.apply_async(
+                (report_name, args.format, args.species, genomic_datasets, genomic_samples, rep_datasets, rep_samples, params, cache_key),
+                task_id=task_id).id)
+
+            return {'id': job_id, 'status': 'queued'}
         except JSONDecodeError:
             print('Exception encountered processing JSON-encoded field: %s' % traceback.format_exc())
             app.logger.error('Exception encountered processing JSON-encoded field: %s' % traceback.format_exc())
@@ -207,6 +222,11 @@ class ReportsRunApi(Resource):
 class ReportsStatus(Resource):
     @digby_protected()
     def get(self, job_id):
+        cached_result = cached_report(job_id)
+
+        if cached_result is not None:
+            return {'id': job_id, 'status': 'SUCCESS', 'results': cached_result}, {'Cache-Control': 'no-store, no-cache, must-revalidate, post-check=0, pre-check=0'}
+
         res = celery.AsyncResult(job_id)
         status = res.status
 
@@ -232,19 +252,51 @@ class ReportsStatus(Resource):
 
 
 # R Script Runner
+# Scripts are run in a long-lived R worker if one is available (R_WORKER_POOL_SIZE > 0), otherwise with Rscript
+
+r_worker_pool = None
+r_worker_pool_pid = None
+
+
+def get_r_worker_pool():
+    global r_worker_pool, r_worker_pool_pid
+
+    # Celery forks its worker processes: each needs its own R workers
+    if r_worker_pool is None or r_worker_pool_pid != os.getpid():
+        r_worker_pool = RWorkerPool(app.config['R_SCRIPT_PATH'], app.config.get('R_WORKER_POOL_SIZE', 1), app.config.get('R_WORKER_MAX_JOBS', 20))
+        r_worker_pool_pid = os.getpid()
+
+    return r_worker_pool
+
+
 def run_rscript(script, args, cwd=app.config['R_SCRIPT_PATH']):
     current_task.update_state(state='PENDING', meta={'stage': 'running report'})
-    cmd_line = ['Rscript', os.path.join(app.config['R_SCRIPT_PATH'], script)]
-    cmd_line.extend(args)
-    print("Running Rscript: '%s'\n" % ' '.join(cmd_line))
-    proc = subprocess.Popen(cmd_line, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    proc.wait()
-    (stdout, stderr) = proc.communicate()
+    timeout = app.config.get('R_SCRIPT_TIMEOUT', 540)
 
-    print(stdout.decode("utf-8"))
-
-    if proc.returncode != 0:
-        msg = str(stderr.decode("utf-8"))
+    try:
+        if app.config.get('R_WORKER_POOL_SIZE', 1) > 0:
+            print("Running R script in worker: '%s %s'\n" % (script, ' '.join(args)))
+            try:
+                response = get_r_worker_pool().run(os.path.join(app.config['R_SCRIPT_PATH'], script), args, cwd, output=r_output, timeout=timeout)
+            except RWorkerError as e:
+                print('R worker unavailable, running Rscript instead: %s' % e)
+            else:
+                if response['status'] != 'ok':
+                    print("Got error in R script:\n" + response['error'])
+                    raise BadRequest('Error running report: Error: %s' % response['error'])
+                return True
+
+        cmd_line = ['Rscript', os.path.join(app.config['R_SCRIPT_PATH'], script)]
+        cmd_line.extend(args)
+        print("Running Rscript: '%s'\n" % ' '.join(cmd_line))
+        output = []
+        returncode = run_r_process(cmd_line, cwd, lambda line: (output.append(line), r_output(line)), timeout=timeout)
+    except RScriptTimeout:
+        print("Rscript %s timed out after %d seconds" % (script, timeout))
+        raise BadRequest('Error running report: the report did not complete within %d seconds' % timeout)
+
+    if returncode != 0:
+        msg = ''.join(output)
         if "Execution halted" in msg:
             print("Got error in Rscript:\n" + msg)
             msg = msg.split('\n')
@@ -257,6 +309,15 @@ def run_rscript(script, args, cwd=app.config['R_SCRIPT_PATH']):
     return True
 
 
+# Echo a line of output from R, reporting any progress marker (a line starting PROGRESS:) in the task state
+
+def r_output(line):
+    print(line, end='')
+
+    if line.startswith(R_PROGRESS_MARKER):
+        current_task.update_state(state='PENDING', meta={'stage': 'running report', 'progress': line[len(R_PROGRESS_MARKER):].strip()})
+
+
 # Send a report - the file should be in OUTPUT_PATH
 def send_report(filename, format, attachment_filename=None):
     return {'status': 'ok', 'filename': attachment_filename, 'url': app.config['OUTPUT_REPORT_LINK'] + os.path.basename(filename)}
@@ -11,11 +11,24 @@ from db.genomic_db import Sequence as GenomicSequence, SampleSequence as Genomic
 
 from db.vdjbase_airr_model import Patient, Sample
 from api.vdjbase.vdjbase import apply_rep_filter_params
-from Bio import pairwise2
+from db.dataset_cache import DatasetCache
+from db.kmer_index import KmerIndex, KMER_LENGTH, kmer_codes
+from Bio.Align import PairwiseAligner
 from receptor_utils import simple_bio_seq as simple
+import numpy as np
 
 SAMPLE_CHUNKS = 400
 
+# Sequences are reported if their global alignment score is at least IDENTITY * the length of the target
+IDENTITY = 0.9
+MATCH_SCORE = 1
+MISMATCH_SCORE = -0.5
+OPEN_GAP_SCORE = -0.5
+EXTEND_GAP_SCORE = -0.1
+
+# k-mer index of all the sequences of each dataset, keyed by (species, dataset, 'AIRR-seq' or 'Genomic')
+sequence_indexes = DatasetCache('sequence_search')
+
 def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_samples, params):
     if format not in ["html", "xls"]:
         raise BadRequest('Invalid format requested')
@@ -27,10 +40,12 @@ def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_sa
     g_chain, gen_samples_by_dataset = collate_gen_samples(genomic_samples)
 
     seqs_to_search = {}
+    indexes = []
 
     for dataset in rep_samples_by_dataset.keys():
         session = vdjbase_dbs[species][dataset].session
-        allele_recs = []
+        indexes.append(airr_seq_index(species, dataset))
+        allele_recs = {}
 
         for sample_chunk in chunk_list(rep_samples_by_dataset[dataset], SAMPLE_CHUNKS):
             sample_list = session.query(Sample.sample_name, Sample.genotype, Sample.patient_id).filter(Sample.sample_name.in_(sample_chunk)).all()
@@ -54,10 +69,9 @@ def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_sa
                 query = query.filter(Allele.is_single_allele == 1)
 
             for allele in query.all():
-                if allele not in allele_recs:
-                    allele_recs.append(allele)
+                allele_recs[allele.id] = allele
 
-        for allele in allele_recs:
+        for allele in allele_recs.values():
             seq = allele.seq.replace('.', '')
             if seq not in seqs_to_search:
                 seqs_to_search[seq] = {}
@@ -73,7 +87,8 @@ def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_sa
 
     for dataset in gen_samples_by_dataset.keys():
         session = genomic_dbs[species][dataset].session
-        sequence_recs = []
+        indexes.append(genomic_seq_index(species, dataset))
+        sequence_recs = {}
 
         for sample_chunk in chunk_list(gen_samples_by_dataset[dataset], SAMPLE_CHUNKS):
             sample_list = session.query(GenomicSample.sample_name).filter(GenomicSample.sample_name.in_(sample_chunk)).all()
@@ -95,10 +110,9 @@ def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_sa
                 query = query.filter(GenomicSequence.functional == 'Functional')
 
             for sequence in query.all():
-                if sequence not in sequence_recs:
-                    sequence_recs.append(sequence)
+                sequence_recs[sequence.id] = sequence
 
-        for sequence in sequence_recs:
+        for sequence in sequence_recs.values():
             seq = sequence.sequence.lower()
             if seq not in seqs_to_search:
                 seqs_to_search[seq] = {}
@@ -113,12 +127,32 @@ def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_sa
             })
 
     target_seq = params['sequence'].lower().replace('.', '').replace('\n', '')
-    target_score = len(target_seq) * 0.9
+    target_score = len(target_seq) * IDENTITY
+    target_codes = kmer_codes(target_seq)
+    aligner = make_aligner()
+    results = []
+
+    # Only sequences that could reach the target score are aligned. For html output, the alignment that gives the
+    # score is kept for display
+
+    candidates = set()
+    for index in indexes:
+        candidates |= shortlist(index, len(target_seq), target_codes, target_score)
 
-    for seq in seqs_to_search.keys():
-        seqs_to_search[seq]['score'] = pairwise2.align.globalms(target_seq, seq, 1, -0.5, -0.5, -0.1, score_only=True)
+    for seq, result in seqs_to_search.items():
+        if seq not in candidates:
+            continue
 
-    results = [x for x in seqs_to_search.values() if x['score'] >= target_score]
+        if format == 'html':
+            alignments = aligner.align(target_seq, seq)
+            result['score'] = alignments.score
+        else:
+            result['score'] = aligner.score(target_seq, seq)
+
+        if result['score'] >= target_score:
+            if format == 'html':
+                result['alignment'] = alignments[0]
+            results.append(result)
 
     if results:
         results = sorted(results, key=lambda x: x['score'], reverse=True)
@@ -138,12 +172,7 @@ def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_sa
         doc += '</code></pre><br>'
 
         for result in results:
-            alignment = pairwise2.align.globalms(target_seq, result['sequence'], 1, -0.5, -0.5, -0.1, one_alignment_only=True)
-            pretty = pairwise2.format_alignment(*alignment[0])
-
-            pretty = pretty.replace('\r', '')
-            pretty = pretty.split('\n')
-            rep = pretty[:-2]
+            rep = format_alignment(target_seq, result['sequence'], result['alignment'].aligned)
 
             maxlen = max([len(x) for x in rep])
             for i in range(len(rep)):
@@ -156,7 +185,7 @@ def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_sa
                 headers.append(f"{ds['type']} {ds['dataset']} {ds['allele_name']} ({ds['appearances']} appearances)")
 
             headers = '; '.join(headers)
-            doc += f'<pre><code>\n\n{headers}\n{pretty[-2]}\n{rep}<code></pre>'
+            doc += f'<pre><code>\n\n{headers}\n  Score={result["score"]:g}\n{rep}<code></pre>'
 
         if not results:
             doc += '<div>No results found with >= 90% sequence identity.</div>'
@@ -199,3 +228,99 @@ def run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_sa
         simple.write_csv(output_path, doc)
 
     return send_report(output_path, format, 'sequence_search.csv')
+
+
+def make_aligner():
+    aligner = PairwiseAligner()
+    aligner.mode = 'global'
+    aligner.match_score = MATCH_SCORE
+    aligner.mismatch_score = MISMATCH_SCORE
+    aligner.open_gap_score = OPEN_GAP_SCORE
+    aligner.extend_gap_score = EXTEND_GAP_SCORE
+    return aligner
+
+
+# Indexes of the sequences that a search of a dataset may report, whatever the samples and filters selected.
+# Sequences are normalised as they are in run()
+
+def airr_seq_index(species, dataset):
+    session = vdjbase_dbs[species][dataset].session
+    return sequence_indexes.get((species, dataset, 'AIRR-seq'), vdjbase_dbs[species][dataset].created,
+                                lambda: KmerIndex(set(seq.replace('.', '') for (seq,) in session.query(Allele.seq).all() if seq)))
+
+
+def genomic_seq_index(species, dataset):
+    session = genomic_dbs[species][dataset].session
+    query = session.query(GenomicSequence.sequence).filter(GenomicSequence.type.in_(['V-REGION', 'D-REGION', 'J-REGION']))
+    return sequence_indexes.get((species, dataset, 'Genomic'), genomic_dbs[species][dataset].created,
+                                lambda: KmerIndex(set(seq.lower() for (seq,) in query.all() if seq)))
+
+
+# The sequences in an index that could align with the target with at least min_score: those that pass the bounds on
+# length and on the number of k-mers shared with the target
+
+def shortlist(index, target_length, target_codes, min_score):
+    passed = max_score_for_lengths(target_length, index.lengths) >= min_score
+    passed &= index.shared_kmer_counts(target_codes) >= min_kmers_for_score(target_length, index.lengths, target_codes, min_score)
+    return set(index.sequences[i] for i in np.nonzero(passed)[0])
+
+
+# Upper bound on the score of a global alignment between sequences of the given lengths: all bases of the shorter
+# sequence matched, and the difference in length taken up by a single gap. seq_length may be an array
+
+def max_score_for_lengths(target_length, seq_length):
+    score = np.minimum(target_length, seq_length) * MATCH_SCORE
+    return score + np.where(target_length != seq_length, OPEN_GAP_SCORE + EXTEND_GAP_SCORE * (np.abs(target_length - seq_length) - 1), 0)
+
+
+# Lower bound on the number of the target's k-mer positions whose k-mer a sequence must contain, for an alignment with
+# it to reach min_score (the q-gram lemma, with errors weighted by their cost in score). Each k-mer of the target that
+# is aligned without a mismatch or gap is also a k-mer of the sequence. Relative to a full match of the target, score
+# is lost by:
+#   - a mismatch, which breaks up to KMER_LENGTH k-mers
+#   - a gap in the sequence (bases deleted from the target), which breaks up to KMER_LENGTH - 1 + its length
+#   - a gap in the target (bases inserted), which breaks up to KMER_LENGTH - 1
+# Insertions are cheap, but the bases inserted, less those deleted, are the difference in length, so only that many
+# insertions are possible without paying for deletions as well. The most k-mers broken per unit of score lost, for
+# those insertions and then for everything else, bounds the number broken in all. k-mers of the target that contain
+# anything other than a, c, g or t are not counted. seq_length may be an array
+
+def min_kmers_for_score(target_length, seq_length, target_codes, min_score):
+    lost_score = target_length * MATCH_SCORE - min_score
+    insertion_cost = -OPEN_GAP_SCORE
+    deletion_cost = MATCH_SCORE - OPEN_GAP_SCORE
+    extension_cost = MATCH_SCORE - EXTEND_GAP_SCORE
+
+    broken_per_score = max(KMER_LENGTH / (MATCH_SCORE - MISMATCH_SCORE),
+                           KMER_LENGTH / deletion_cost,
+                           (2 * KMER_LENGTH - 1) / (deletion_cost + insertion_cost),
+                           KMER_LENGTH / (extension_cost + insertion_cost))
+
+    free_insertions = np.clip(seq_length - target_length, 0, lost_score / insertion_cost)
+    max_broken = lost_score * broken_per_score \
+        + free_insertions * max(0, (KMER_LENGTH - 1) - insertion_cost * broken_per_score)
+
+    return len(target_codes) - np.count_nonzero(target_codes < 0) - max_broken
+
+
+# Format an alignment as pairwise2.format_alignment does: the two sequences, with a line between them marking
+# matches with '|' and mismatches with '.'. aligned is the aligned blocks of the alignment, as (start, end)
+# pairs for each sequence
+
+def format_alignment(target, seq, aligned):
+    target_parts = []
+    seq_parts = []
+    t_pos = s_pos = 0
+
+    for (t_start, t_end), (s_start, s_end) in list(zip(*aligned)) + [((len(target), len(target)), (len(seq), len(seq)))]:
+        target_parts.append(target[t_pos:t_start] + '-' * (s_start - s_pos))
+        seq_parts.append('-' * (t_start - t_pos) + seq[s_pos:s_start])
+        target_parts.append(target[t_start:t_end])
+        seq_parts.append(seq[s_start:s_end])
+        t_pos, s_pos = t_end, s_end
+
+    target_line = ''.join(target_parts)
+    seq_line = ''.join(seq_parts)
+    match_line = ''.join(' ' if '-' in (a, b) else '|' if a == b else '.' for a, b in zip(target_line, seq_line))
+
+    return [target_line, match_line, seq_line]
@@ -4,24 +4,30 @@ import datetime
 import decimal
 import os.path
 from os.path import isfile
+import itertools
 import json
 from math import ceil
 import pickle
+import threading
 
-from flask import request
+from flask import request, Response
 from flask_restx import Resource, reqparse
 
 from api.reports.report_utils import make_output_file
 from api.restx import api
-from sqlalchemy import inspect, func, or_
+from sqlalchemy import inspect, func, or_, literal
 from sqlalchemy import null as sa_null
 from sqlalchemy_filters import apply_filters
 from werkzeug.exceptions import BadRequest
 from db.filter_list import apply_filter_to_list
+from db.query_paging import paged_query, sort_expressions
+from db.facet_index import FacetIndex
+from db.dataset_cache import DatasetCache
 from api.system.system import digby_protected
 
 from app import vdjbase_dbs, app, genomic_dbs
 from db.vdjbase_api_query_filters import sample_info_filters, sequence_filters
+from db.vdjbase_genotypes import HAPLOTYPE_MANIFEST
 from db.vdjbase_model import HaplotypesFile, SamplesHaplotype, Allele, AllelesSample, Gene, AlleleConfidenceReport, HaplotypeEvidence
 from db.vdjbase_airr_model import GenoDetection, SeqProtocol, Study, TissuePro, Patient, Sample, DataPro
 from db.genomic_db import Gene as GenomicGene
@@ -30,6 +36,10 @@ from api.reports.genotypes import process_repseq_genotype
 
 VDJBASE_SAMPLE_PATH = os.path.join(app.config['STATIC_PATH'], 'study_data/VDJbase/samples')
 
+facet_index = FacetIndex(os.path.join(app.config['OUTPUT_PATH'], 'facets'))
+genotype_store = DatasetCache('genotypes', os.path.join(app.config['OUTPUT_PATH'], 'genotypes'))
+allele_details_cache = DatasetCache('allele_details')
+
 
 # Return SqlAlchemy row as a dict, using correct column names
 def object_as_dict(obj):
@@ -393,9 +403,8 @@ class SamplesApi(Resource):
         attribute_query.append(Sample.id)
 
         filter = json.loads(args['filter']) if args['filter'] else []
-        ret = find_vdjbase_samples(attribute_query, species, dataset.split(','), filter)
-
-        total_size = len(ret)
+        facet_filter = json.loads(args['filter']) if args['filter'] else []
+        queries = vdjbase_sample_queries(attribute_query, species, dataset.split(','), filter)
 
         uniques = {}
 
@@ -412,22 +421,18 @@ class SamplesApi(Resource):
             for dataset in uniques['dataset']:
                 uniques['names_by_dataset'][dataset] = []
 
-        for s in ret:
-            for f in required_cols:
-                if sample_info_filters[f]['field'] is not None and 'no_uniques' not in sample_info_filters[f]:
-                    el = s[f]
-                    if isinstance(el, (datetime.datetime, datetime.date)):
-                        el = el.date().isoformat()
-                    elif isinstance(el, bool):
-                        if f in rep_sample_bool_values:
-                            el = rep_sample_bool_values[f][0 if el else 1]
-                    if (not isinstance(el, str) or len(el) > 0) and el not in uniques[f]:
-                        uniques[f].append(el)
-                    if (sample_info_filters[f]['field'].type.python_type is str) and len(el) == 0 and '(blank)' not in uniques[f]:
-                        uniques[f].append('(blank)')
-
-            if filter_applied:
-                uniques['names_by_dataset'][s['dataset']].append(s['sample_name'])
+        facet_cols = [f for f in required_cols if sample_info_filters[f]['field'] is not None and 'no_uniques' not in sample_info_filters[f]]
+        if filter_applied:
+            facet_cols.append('names_by_dataset')
+
+        for dset, query in queries:
+            facets = facet_index.get(species, dset, vdjbase_dbs[species][dset].created, 'samples', facet_filter, facet_cols,
+                                     lambda cols, query=query: find_vdjbase_sample_facets(query, cols))
+            for f in facet_cols:
+                if f == 'names_by_dataset':
+                    uniques['names_by_dataset'][dset] = facets[f]
+                else:
+                    merge_facet_values(uniques[f], facets[f])
 
         def name_sort_key(name):
             name = name.split('_')
@@ -465,22 +470,20 @@ class SamplesApi(Resource):
             uniques['haplotypes'] = list(set(uniques['haplotypes']))
 
         sort_specs = json.loads(args['sort_by']) if ('sort_by' in args and args['sort_by'] != None) else []
-        if len(sort_specs) == 0:
-            sort_specs = [{'field': 'name', 'order': 'asc'}]
 
-        for spec in sort_specs:
+        # Successive sort specs were originally applied as successive stable sorts, so the last spec is the primary key
+
+        sql_sort_specs = []
+        for spec in reversed(sort_specs):
             f = spec['field']
-            if f in sample_info_filters.keys():
-                if 'sort' in sample_info_filters[f] and sample_info_filters[f]['sort'] == 'underscore':
-                    ret = sorted(ret, key=lambda x: name_sort_key(x[f]), reverse=(spec['order'] == 'desc'))
-                elif 'sort' in sample_info_filters[f] and sample_info_filters[f]['sort'] == 'numeric':
-                    ret = sorted(ret, key=lambda x: num_sort_key(x[f]), reverse=(spec['order'] == 'desc'))
-                else:
-                    ret = sorted(ret, key=lambda x: ((x[f] is None or x[f] == ''), x[f]), reverse=(spec['order'] == 'desc'))
+            if f == 'dataset':
+                sql_sort_specs.append((lambda dset: [literal(dset)], spec['order'] == 'desc'))
+            elif f in required_cols and sample_info_filters[f]['field'] is not None:
+                sort_mode = sample_info_filters[f]['sort'] if 'sort' in sample_info_filters[f] else None
+                sql_sort_specs.append((lambda dset, col=sample_info_filters[f]['field'], sort_mode=sort_mode: sort_expressions(col, sort_mode), spec['order'] == 'desc'))
 
-        if args['page_size']:
-            first = (args['page_number']) * args['page_size']
-            ret = ret[first:first + args['page_size']]
+        rows, total_size = paged_query(queries, sql_sort_specs, Sample.id, args['page_number'], args['page_size'])
+        ret = [format_vdjbase_sample_row(r, r['dataset']) for r in rows]
 
         for rec in ret:
             for k, v in rec.items():
@@ -490,6 +493,8 @@ class SamplesApi(Resource):
                     rec[k] = '%0.2f' % v
 
         if 'genotypes' in required_cols:
+            igsnper_paths = find_sample_igsnper_paths(species, ret)
+
             for r in ret:
                 r['genotypes'] = {}
                 r['genotypes']['analysis'] = json.dumps({'species': species, 'repSeqs': [r['dataset']], 'name': r['sample_name'], 'sort_order': 'Locus'})
@@ -502,31 +507,31 @@ class SamplesApi(Resource):
                 del r['genotype_stats']
                 del r['genotype_report']
 
-                session = vdjbase_dbs[species][r['dataset']].session
-                igsnper_path = session.query(Sample.igsnper_plot_path, Sample.genotype_report).filter(Sample.sample_name == r['sample_name']).one_or_none()
+                igsnper_path = igsnper_paths.get((r['dataset'], r['sample_name']))
 
-                if igsnper_path is not None and igsnper_path[0] is not None:
-                    r['genotypes']['igsnper'] = '/'.join(['static/study_data/VDJbase/samples', species, r['dataset'], igsnper_path[0]])
+                if igsnper_path is not None:
+                    r['genotypes']['igsnper'] = '/'.join(['static/study_data/VDJbase/samples', species, r['dataset'], igsnper_path])
                 else:
                     r['genotypes']['igsnper'] = ''
 
 
         if 'haplotypes' in required_cols:
+            haplotype_files = find_sample_haplotype_files(species, ret)
+            manifests = {}
+
             for r in ret:
-                session = vdjbase_dbs[species][r['dataset']].session
-                haplotypes = session.query(Sample.sample_name, func.group_concat(HaplotypesFile.by_gene_s), func.group_concat(HaplotypesFile.file))
-                h = haplotypes.filter(Sample.sample_name == r['sample_name'])\
-                    .join(SamplesHaplotype, SamplesHaplotype.samples_id == Sample.id)\
-                    .join(HaplotypesFile, HaplotypesFile.id == SamplesHaplotype.haplotypes_file_id)\
-                    .one_or_none()
-                if h is not None and h[1] is not None:
+                h = haplotype_files.get((r['dataset'], r['sample_name']))
+                if h:
+                    if r['dataset'] not in manifests:
+                        manifests[r['dataset']] = haplotype_file_manifest(species, r['dataset'])
+                    manifest = manifests[r['dataset']]
+
                     r['haplotypes'] = {}
                     r['haplotypes']['path'] = app.config['BACKEND_LINK']
-                    for (hap, filename) in zip(h[1].split(','), h[2].split(',')):
+                    for (hap, filename) in h:
                         filename = filename.replace('samples/', '')
-                        fp = os.path.join(VDJBASE_SAMPLE_PATH, species, r['dataset'], filename)
                         sp = '/'.join(['static/study_data/VDJbase/samples', species, r['dataset'], filename])
-                        if isfile(fp):
+                        if filename in manifest:
                             r['haplotypes'][hap] = {}
                             r['haplotypes'][hap]['analysis'] = json.dumps({'species': species, 'repSeqs': [r['dataset']], 'name': r['sample_name'], 'hap_gene': hap, 'sort_order' : 'Locus'})
                             r['haplotypes'][hap]['rabhit'] = sp
@@ -541,7 +546,110 @@ class SamplesApi(Resource):
             'pages': ceil((total_size*1.0)/args['page_size']) if args['page_size'] else 1
         }, 200
 
+# Batched lookups of the genotype and haplotype links for a page of samples, one query per dataset
+# Return dicts keyed by (dataset, sample_name)
+
+SAMPLE_NAME_CHUNK = 500
+
+
+def sample_names_by_dataset(rows):
+    names = {}
+    for r in rows:
+        if r['dataset'] not in names:
+            names[r['dataset']] = []
+        names[r['dataset']].append(r['sample_name'])
+    return names
+
+
+def find_sample_igsnper_paths(species, rows):
+    paths = {}
+
+    for dset, names in sample_names_by_dataset(rows).items():
+        session = vdjbase_dbs[species][dset].session
+        for i in range(0, len(names), SAMPLE_NAME_CHUNK):
+            res = session.query(Sample.sample_name, Sample.igsnper_plot_path)\
+                .filter(Sample.sample_name.in_(names[i:i + SAMPLE_NAME_CHUNK]))\
+                .all()
+            for sample_name, igsnper_plot_path in res:
+                if igsnper_plot_path is not None:
+                    paths[(dset, sample_name)] = igsnper_plot_path
+
+    return paths
+
+
+def find_sample_haplotype_files(species, rows):
+    files = {}
+
+    for dset, names in sample_names_by_dataset(rows).items():
+        session = vdjbase_dbs[species][dset].session
+        for i in range(0, len(names), SAMPLE_NAME_CHUNK):
+            res = session.query(Sample.sample_name, HaplotypesFile.by_gene_s, HaplotypesFile.file)\
+                .join(SamplesHaplotype, SamplesHaplotype.samples_id == Sample.id)\
+                .join(HaplotypesFile, HaplotypesFile.id == SamplesHaplotype.haplotypes_file_id)\
+                .filter(Sample.sample_name.in_(names[i:i + SAMPLE_NAME_CHUNK]))\
+                .order_by(SamplesHaplotype.id)\
+                .all()
+            for sample_name, hap, filename in res:
+                if (dset, sample_name) not in files:
+                    files[(dset, sample_name)] = []
+                files[(dset, sample_name)].append((hap, filename))
+
+    return files
+
+
+# The set of haplotype files (relative to the dataset's sample directory) that are present on disk.
+# The manifest is written into the sample directory when the database is built (write_haplotype_manifest). If it
+# is missing, or was written for a different build, the set is found by a single scan of the haplotype files and
+# held in memory: the manifest file is only written by the build.
+
+haplotype_manifests = DatasetCache('haplotype_manifests')
+
+
+def haplotype_file_manifest(species, dataset):
+    return haplotype_manifests.get((species, dataset), vdjbase_dbs[species][dataset].created,
+                                   lambda: read_haplotype_file_manifest(species, dataset))
+
+
+def read_haplotype_file_manifest(species, dataset):
+    created = vdjbase_dbs[species][dataset].created
+    created = created.isoformat() if created else ''
+
+    sample_dir = os.path.join(VDJBASE_SAMPLE_PATH, species, dataset)
+    manifest_file = os.path.join(sample_dir, HAPLOTYPE_MANIFEST)
+
+    if isfile(manifest_file):
+        try:
+            with open(manifest_file, 'r') as fi:
+                contents = json.load(fi)
+            if contents['created_on'] == created:
+                return set(contents['files'])
+        except Exception as e:
+            app.logger.error(f"Error loading haplotype manifest {manifest_file}: {e}")
+
+    session = vdjbase_dbs[species][dataset].session
+    manifest = set()
+    for (filename,) in session.query(HaplotypesFile.file).all():
+        if filename:
+            filename = filename.replace('samples/', '')
+            if isfile(os.path.join(sample_dir, filename)):
+                manifest.add(filename)
+
+    return manifest
+
+
 def find_vdjbase_samples(attribute_query, species, datasets, filter):
+    ret = []
+
+    for dset, query in vdjbase_sample_queries(attribute_query, species, datasets, filter):
+        for r in query.all():
+            ret.append(format_vdjbase_sample_row(r._asdict(), dset))
+
+    return ret
+
+
+# Build the filtered sample query for each selected dataset. Returns a list of (dataset, query)
+
+def vdjbase_sample_queries(attribute_query, species, datasets, filter):
     hap_filters = None
     allele_filters = None
     dataset_filters = []
@@ -580,11 +688,11 @@ def find_vdjbase_samples(attribute_query, species, datasets, filter):
 
         except Exception as e:
             raise BadRequest(f'Bad filter string: {f}: {e}')
-    ret = []
-
     if len(dataset_filters) > 0:
         apply_filter_to_list(datasets, dataset_filters)
 
+    queries = []
+
     for dset in datasets:
         session = vdjbase_dbs[species][dset].session
 
@@ -609,19 +717,65 @@ def find_vdjbase_samples(attribute_query, species, datasets, filter):
                 allele_samples = []
             query = query.filter(Sample.sample_name.in_([s[0] for s in allele_samples]))
 
-        res = query.all()
+        queries.append((dset, query))
 
-        for r in res:
-            s = r._asdict()
-            for k, v in s.items():
-                if isinstance(v, (datetime.datetime, datetime.date)):
-                    s[k] = v.date().isoformat()
-                if v is None:
-                    s[k] = ''
-            s['dataset'] = dset
-            s['id'] = '%s.%d' % (dset, s['id'])
-            ret.append(s)
-    return ret
+    return queries
+
+
+def format_vdjbase_sample_row(s, dset):
+    for k, v in s.items():
+        if isinstance(v, (datetime.datetime, datetime.date)):
+            s[k] = v.date().isoformat()
+        if v is None:
+            s[k] = ''
+    s['dataset'] = dset
+    s['id'] = '%s.%d' % (dset, s['id'])
+    return s
+
+
+# Distinct values of the requested columns in a filtered sample query, as shown in the uniques of SamplesApi
+
+def find_vdjbase_sample_facets(query, cols):
+    facets = {}
+
+    for f in cols:
+        values = []
+        seen = set()
+
+        if f == 'names_by_dataset':
+            facets[f] = [r[0] for r in query.with_entities(Sample.sample_name).order_by(Sample.id).all()]
+            continue
+
+        for (el,) in query.with_entities(sample_info_filters[f]['field']).distinct().all():
+            if el is None:
+                el = ''
+            elif isinstance(el, datetime.datetime):
+                el = el.date().isoformat()
+            elif isinstance(el, datetime.date):
+                el = el.isoformat()
+            elif isinstance(el, bool):
+                if f in rep_sample_bool_values:
+                    el = rep_sample_bool_values[f][0 if el else 1]
+            if (not isinstance(el, str) or len(el) > 0) and el not in seen:
+                values.append(el)
+                seen.add(el)
+            if (sample_info_filters[f]['field'].type.python_type is str) and len(el) == 0 and '(blank)' not in seen:
+                values.append('(blank)')
+                seen.add('(blank)')
+
+        facets[f] = values
+
+    return facets
+
+
+# Add facet values from one dataset to those already collected, preserving order
+
+def merge_facet_values(values, new_values):
+    seen = set(values)
+    for el in new_values:
+        if el not in seen:
+            values.append(el)
+            seen.add(el)
 
 
 rep_sequence_bool_values = {
@@ -658,6 +812,7 @@ class SequencesApi(Resource):
             required_cols.append('igsnper_plot_path')
 
         datasets = dataset.split(',')
+        facet_filter = json.loads(args['filter']) if args['filter'] else []
         ret = find_vdjbase_sequences(species, datasets, required_cols, json.loads(args['filter']) if args['filter'] else [])
         total_size = len(ret)
 
@@ -665,21 +820,19 @@ class SequencesApi(Resource):
         for f in required_cols:
             uniques[f] = []
 
+        facet_cols = [f for f in required_cols if sequence_filters[f]['field'] is not None and 'no_uniques' not in sequence_filters[f]]
+
+        rows_by_dataset = {}
         for s in ret:
-            for f in required_cols:
-                if sequence_filters[f]['field'] is not None and 'no_uniques' not in sequence_filters[f]:
-                    el = s[f]
-                    if isinstance(el, (datetime.datetime, datetime.date)):        # convert and add to uniques. Can't convert the returned records until we sort
-                        el = el.date().isoformat()
-                    elif isinstance(el, decimal.Decimal):
-                        el = '%0.2f' % el
-                    elif isinstance(el, bool):
-                        if f in rep_sequence_bool_values:
-                            el = rep_sequence_bool_values[f][0 if el else 1]
-                    if (not isinstance(el, str) or len(el) > 0) and el not in uniques[f]:
-                        uniques[f].append(el)
-                    if isinstance(el, str) and len(el) == 0 and '(blank)' not in uniques[f]:
-                        uniques[f].append('(blank)')
+            if s['dataset'] not in rows_by_dataset:
+                rows_by_dataset[s['dataset']] = []
+            rows_by_dataset[s['dataset']].append(s)
+
+        for dset, rows in rows_by_dataset.items():
+            facets = facet_index.get(species, dset, vdjbase_dbs[species][dset].created, 'sequences', facet_filter, facet_cols,
+                                     lambda cols, rows=rows: find_vdjbase_sequence_facets(rows, cols))
+            for f in facet_cols:
+                merge_facet_values(uniques[f], facets[f])
 
         uniques['dataset'] = dataset.split(',')
 
@@ -753,6 +906,36 @@ class SequencesApi(Resource):
         }
 
 
+# Distinct values of the requested columns in a dataset's sequence rows, as shown in the uniques of SequencesApi
+
+def find_vdjbase_sequence_facets(rows, cols):
+    facets = {}
+
+    for f in cols:
+        values = []
+        seen = set()
+
+        for s in rows:
+            el = s[f]
+            if isinstance(el, (datetime.datetime, datetime.date)):
+                el = el.date().isoformat()
+            elif isinstance(el, decimal.Decimal):
+                el = '%0.2f' % el
+            elif isinstance(el, bool):
+                if f in rep_sequence_bool_values:
+                    el = rep_sequence_bool_values[f][0 if el else 1]
+            if (not isinstance(el, str) or len(el) > 0) and el not in seen:
+                values.append(el)
+                seen.add(el)
+            if isinstance(el, str) and len(el) == 0 and '(blank)' not in seen:
+                values.append('(blank)')
+                seen.add('(blank)')
+
+        facets[f] = values
+
+    return facets
+
+
 def find_vdjbase_sequences(species, datasets, required_cols, seq_filter):
     sample_id_filter = None
     filter_spec = []
@@ -891,53 +1074,49 @@ class AllSubjectsGenotypeApi(Resource):
 
         if species not in vdjbase_dbs:
             return None, 404
-          
-        cache_filename = f"{app.config['OUTPUT_PATH']}/airrseq_all_subjects_genotype_{species}.pickle"
-        if os.path.isfile(cache_filename):
-            # check that the file is newer than the last revision dates of the databases
-            last_revision_time = max([genomic_dbs[species][dataset].created for dataset in genomic_dbs[species].keys()])
-            if datetime.datetime.fromtimestamp(os.path.getmtime(cache_filename)) > last_revision_time:
-                try:
-                    with open(cache_filename, 'rb') as f:
-                        return pickle.load(f), 200
-                except Exception as e:
-                    app.logger.error(f"Error loading cache file {cache_filename}: {e}")
-                    os.remove(cache_filename)
-            else:
-                os.remove(cache_filename)
 
-        all_subjects = []
-        for dataset in vdjbase_dbs[species].keys():
-            session = vdjbase_dbs[species][dataset].session
-            subjects = session.query(Patient.patient_name).all()
-            all_subjects.extend(subjects)
-
-        all_subjects = sorted(list(set([s[0] for s in all_subjects])))
-
-        genotype_sets = []
-
-        for subject_name in all_subjects:
-            genotypes = []
-            for dataset in vdjbase_dbs[species].keys():
-                genotype = single_genotype(species, dataset, subject_name)
-                if genotype:
-                    genotypes.append(genotype)
-            if genotypes:
-                genotype_sets.append({
-                    'subject_name': subject_name,
-                    'GenotypeSet': {
-                        'receptor_genotype_set_id': 'Genomic_genotype_set_' + subject_name,
-                        'genotype_class_list': genotypes
-                    }
-                })
-
-        if not genotype_sets:
+        genotype_sets = subject_genotype_sets(species)
+        first = next(genotype_sets, None)
+
+        if first is None:
             return None, 404
 
-        with open(cache_filename, 'wb') as f:
-            pickle.dump(genotype_sets, f, pickle.HIGHEST_PROTOCOL)
+        return Response(stream_json_list(itertools.chain([first], genotype_sets)), mimetype='application/json')
+
 
-        return genotype_sets, 200
+# Genotype sets of all subjects of a species, in subject name order
+
+def all_subjects_genotype_sets(species):
+    return list(subject_genotype_sets(species))
+
+
+# Generate the genotype sets of all subjects of a species one at a time, in subject name order
+
+def subject_genotype_sets(species):
+    dataset_genotypes = [subject_genotypes(species, dataset) for dataset in vdjbase_dbs[species].keys()]
+    all_subjects = sorted(set([subject_name for genotypes in dataset_genotypes for subject_name in genotypes.keys()]))
+
+    for subject_name in all_subjects:
+        genotypes = [genotypes[subject_name] for genotypes in dataset_genotypes if subject_name in genotypes]
+        yield {
+            'subject_name': subject_name,
+            'GenotypeSet': {
+                'receptor_genotype_set_id': 'Genomic_genotype_set_' + subject_name,
+                'genotype_class_list': genotypes
+            }
+        }
+
+
+# Serialise an iterable to a JSON list, one element at a time as the elements are generated, so that neither the
+# elements nor the document are ever held in full
+
+def stream_json_list(items):
+    yield '['
+    for i, item in enumerate(items):
+        if i:
+            yield ','
+        yield json.dumps(item)
+    yield ']\n'
 
 
 @ns.route('/genotype/<string:species>/<string:subject_name>')
@@ -970,15 +1149,95 @@ class GenotypeApi(Resource):
         return ret, 400
 
 
+# Return the genotype of a subject in a dataset, or None if the subject is not in the dataset
+# If the dataset's genotypes are not in the store, only this subject's genotype is computed, and the store is filled
+# in the background
+
 def single_genotype(species, dataset, subject_name):
+    created = vdjbase_dbs[species][dataset].created
+    genotypes = genotype_store.lookup((species, dataset), created)
+
+    if genotypes is not None:
+        return genotypes.get(subject_name)
+
+    fill_genotype_store(species, dataset)
+
     session = vdjbase_dbs[species][dataset].session
-    samples = session.query(Sample).join(Patient, Sample.patient_id == Patient.id).filter(Patient.patient_name == subject_name).all()
+    sample = session.query(Sample)\
+        .join(Patient, Sample.patient_id == Patient.id)\
+        .filter(Patient.patient_name == subject_name)\
+        .order_by(Sample.id)\
+        .first()
 
-    if len(samples) == 0:
+    if sample is None:
         return None
 
-    sample = samples[0]     # TODO more intelligent way to select sample??
+    alleles = allele_details_cache.get((species, dataset), created, lambda: allele_details(session))
+    return sample_genotype(sample, dataset, alleles, session)
+
+
+# Return {subject_name: genotype} for all subjects in a dataset, from the genotype store
+
+def subject_genotypes(species, dataset):
+    return genotype_store.get((species, dataset), vdjbase_dbs[species][dataset].created,
+                              lambda: dataset_genotypes(vdjbase_dbs[species][dataset].session, dataset))
+
+
+genotypes_filling = set()
+genotypes_filling_lock = threading.Lock()
+
+
+# Compute the genotypes of all subjects in a dataset on a background thread, unless this is already under way
+
+def fill_genotype_store(species, dataset):
+    with genotypes_filling_lock:
+        if (species, dataset) in genotypes_filling:
+            return
+        genotypes_filling.add((species, dataset))
+
+    threading.Thread(target=_fill_genotype_store, args=(species, dataset), daemon=True).start()
+
+
+def _fill_genotype_store(species, dataset):
+    try:
+        subject_genotypes(species, dataset)
+    except Exception as e:
+        print('Error computing genotypes for %s %s: %s' % (species, dataset, e))
+    finally:
+        vdjbase_dbs[species][dataset].release_session()
+        with genotypes_filling_lock:
+            genotypes_filling.discard((species, dataset))
+
+
+# Return {allele name: (sequence, novel)} for all alleles in a dataset
+
+def allele_details(session):
+    alleles = {}
+    for name, seq, novel in session.query(Allele.name, Allele.seq, Allele.novel).all():
+        alleles[name] = (seq, novel)
+    return alleles
+
+
+# Compute the MiAIRR genotypes of all subjects in a dataset
+
+def dataset_genotypes(session, dataset):
+    alleles = allele_details(session)
+
+    samples = session.query(Patient.patient_name, Sample)\
+        .join(Patient, Sample.patient_id == Patient.id)\
+        .order_by(Sample.id)\
+        .all()
+
+    genotypes = {}
+
+    for subject_name, sample in samples:
+        if subject_name not in genotypes:       # TODO more intelligent way to select sample??
+            genotypes[subject_name] = sample_genotype(sample, dataset, alleles, session)
+
+    return genotypes
+
 
+def sample_genotype(sample, dataset, alleles, session):
     genotype = process_repseq_genotype(sample.sample_name, [], session, False)
     germline_set = {
         'V': sample.geno_detection.aligner_reference_v,
@@ -998,9 +1257,8 @@ def single_genotype(species, dataset, subject_name):
             deleted.append({'label': row.gene, 'germline_set_ref': germline_set[gene_type], 'phasing': 0})
         for allele in row.GENOTYPED_ALLELES.split(','):
             allele_name = row.gene + '*' + allele
-            res = session.query(Allele.seq, Allele.novel).filter(Allele.name == allele_name).one_or_none()
-            if res:
-                seq, novel = res
+            if allele_name in alleles:
+                seq, novel = alleles[allele_name]
 
                 if novel:
                     undocumented.append({'allele_name': allele_name, 'germline_set_ref': germline_set[gene_type], 'sequence': seq, 'phasing': 0})
@@ -218,8 +218,8 @@ def get_all_subjects_genotype(type, species):
         genotype_list = genotype_list.get(species)
 
     elif type == "airrseq":
-        genotype_list = vdjbase.AllSubjectsGenotypeApi(Resource)
-        genotype_list = genotype_list.get(species)
+        # the repseq endpoint streams its response, so fetch the genotype sets directly
+        genotype_list = (vdjbase.all_subjects_genotype_sets(species), 200) if species in vdjbase.vdjbase_dbs else (None, 404)
     
     if not genotype_list or not genotype_list[0]:
         error_response = ErrorResponse(message="Subject not found")
@@ -14,7 +14,7 @@ from flask_security.utils import hash_password
 from flask_swagger_ui import get_swaggerui_blueprint
 from extensions import celery
 
-from db.vdjbase_db import study_data_db_init
+from db.vdjbase_db import study_data_db_init, release_sessions
 
 sql_db = None
 
@@ -64,6 +64,14 @@ custom_logging.init_logging(app, mail)
 vdjbase_dbs = study_data_db_init(os.path.join(app.config['STATIC_PATH'], 'study_data/VDJbase/db'))
 genomic_dbs = study_data_db_init(os.path.join(app.config['STATIC_PATH'], 'study_data/Genomic/db'))
 
+
+# Each request or celery task gets its own session on the study databases: return them to the pool when done.
+# Celery tasks run inside an app context (see extensions.FlaskCelery), so this covers them too
+
+@app.teardown_appcontext
+def release_study_data_sessions(exception=None):
+    release_sessions(vdjbase_dbs, genomic_dbs)
+
 admin_obj = Admin(app, template_mode='bootstrap3')
 
 from security.useradmin import *
@@ -43,7 +43,7 @@ def build_ref_seq_gff(session, dataset_dir, ref_seq, name_prefix):
 def all_imgt_and_novel_v_region_alignment(dataset_dir, name_prefix, ref_seq, session):
     with open(os.path.join(dataset_dir, 'samples', name_prefix + '_imgt.sam'), 'w') as fo:
         fo.write('@HD\tVN:1.3\tSO:coordinate\n')
-        fo.write('@SQ\tSN:%s\tLN:%d\n' % (ref_seq.name, len(ref_seq.sequence)))
+        fo.write('@SQ\tSN:%s\tLN:%d\n' % (ref_seq.name, ref_seq.length))
 
         features = session.query(Feature).filter(Feature.refseq == ref_seq).filter(Feature.attribute.like('%REGION%')).order_by(Feature.start).all()
 
@@ -99,7 +99,7 @@ def all_imgt_and_novel_v_region_alignment(dataset_dir, name_prefix, ref_seq, ses
 def unphased_feature_alignment(dataset_dir, name_prefix, ref_seq, session):
     with open(os.path.join(dataset_dir, 'samples', name_prefix + '.sam'), 'w') as fo:
         fo.write('@HD\tVN:1.3\tSO:coordinate\n')
-        fo.write('@SQ\tSN:%s\tLN:%d\n' % (ref_seq.name, len(ref_seq.sequence)))
+        fo.write('@SQ\tSN:%s\tLN:%d\n' % (ref_seq.name, ref_seq.length))
 
         features = session.query(Feature).filter(Feature.refseq == ref_seq).order_by(Feature.start, Feature.name).all()
         for feature in features:
@@ -116,7 +116,7 @@ def unphased_feature_alignment(dataset_dir, name_prefix, ref_seq, session):
 def phased_feature_alignment(dataset_dir, name_prefix, ref_seq, session):
     with open(os.path.join(dataset_dir, 'samples', name_prefix + '.sam'), 'w') as fo:
         fo.write('@HD\tVN:1.3\tSO:coordinate\n')
-        fo.write('@SQ\tSN:%s\tLN:%d\n' % (ref_seq.name, len(ref_seq.sequence)))
+        fo.write('@SQ\tSN:%s\tLN:%d\n' % (ref_seq.name, ref_seq.length))
 
         features = session.query(Feature).filter(and_(Feature.refseq == ref_seq, Feature.feature_type == 'gene_sequence')).order_by(Feature.start, Feature.name).all()
 
@@ -0,0 +1,165 @@
+# Caches of values derived from the contents of a dataset
+#
+# Each value is held against a key starting (species, dataset), together with the dataset's creation date
+# (Details.created_on), and is discarded when the dataset is rebuilt with a different creation date. If the cache
+# has a directory, values are also saved there, so that they survive restarts and are shared between processes.
+
+import glob
+import hashlib
+import os
+import pickle
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+DIGEST_LENGTH = 16
+
+
+# How values are saved in the cache directory: pickled or, for DataFrames, as Parquet if pyarrow is installed
+
+class PickleFormat():
+    extension = '.pickle'
+
+    def write(self, value, filename):
+        with open(filename, 'wb') as fo:
+            pickle.dump(value, fo, pickle.HIGHEST_PROTOCOL)
+
+    def read(self, filename):
+        with open(filename, 'rb') as fi:
+            return pickle.load(fi)
+
+
+class DataFrameFormat():
+    extension = '.parquet' if pyarrow is not None else '.pickle'
+
+    def write(self, value, filename):
+        if pyarrow is not None:
+            value.to_parquet(filename, index=False)
+        else:
+            value.to_pickle(filename)
+
+    def read(self, filename):
+        if pyarrow is not None:
+            return pd.read_parquet(filename)
+        else:
+            return pd.read_pickle(filename)
+
+
+class DatasetCache():
+    def __init__(self, name, cache_dir=None, file_format=None, max_entries=None):
+        self.name = name
+        self.cache_dir = cache_dir
+        self.file_format = file_format if file_format is not None else PickleFormat()
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.build_locks = {}
+
+    # Return the value held for key, calling compute() to create it if it is not held
+    # Each value is computed once, even if several requests for it arrive together
+
+    def get(self, key, created, compute):
+        value = self.lookup(key, created)
+        if value is not None:
+            return value
+
+        with self.lock:
+            if key not in self.build_locks:
+                self.build_locks[key] = threading.Lock()
+            build_lock = self.build_locks[key]
+
+        with build_lock:
+            value = self.lookup(key, created)
+            if value is None:
+                value = compute()
+                self.put(key, created, value)
+
+        return value
+
+    # Return the value held for key, in memory or in the cache directory, or None if it is not held
+
+    def lookup(self, key, created):
+        with self.lock:
+            if key in self.entries:
+                entry_created, value = self.entries[key]
+                if entry_created == created:
+                    self.entries.move_to_end(key)
+                    return value
+                del self.entries[key]
+
+        value = self._load(key, created)
+        if value is not None:
+            self._remember(key, created, value)
+
+        return value
+
+    def put(self, key, created, value):
+        self._remember(key, created, value)
+        self._save(key, created, value)
+
+    def _remember(self, key, created, value):
+        with self.lock:
+            self.entries[key] = (created, value)
+            self.entries.move_to_end(key)
+            while self.max_entries is not None and len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def _load(self, key, created):
+        if self.cache_dir is None:
+            return None
+
+        cache_filename = self._cache_filename(key, created)
+        if os.path.isfile(cache_filename):
+            try:
+                return self.file_format.read(cache_filename)
+            except Exception as e:
+                print('Error loading %s cache file %s: %s' % (self.name, cache_filename, e))
+            remove_file(cache_filename)
+
+        return None
+
+    def _save(self, key, created, value):
+        if self.cache_dir is None:
+            return
+
+        cache_filename = self._cache_filename(key, created)
+
+        # remove files saved against earlier versions of the dataset
+        for filename in glob.glob(glob.escape(self._cache_prefix(key)) + '_' + '?' * DIGEST_LENGTH + self.file_format.extension):
+            remove_file(filename)
+
+        temp_filename = None
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            temp_filename = '%s.%d.%d' % (cache_filename, os.getpid(), threading.get_ident())
+            self.file_format.write(value, temp_filename)
+            os.replace(temp_filename, cache_filename)
+        except Exception as e:
+            print('Error saving %s cache file %s: %s' % (self.name, cache_filename, e))
+            if temp_filename is not None:
+                remove_file(temp_filename)
+
+    # Files are named for the species and dataset, with digests of the whole key and of the creation date
+
+    def _cache_prefix(self, key):
+        return os.path.join(self.cache_dir, '%s_%s_%s_%s' % (self.name, key[0], key[1], digest(key)))
+
+    def _cache_filename(self, key, created):
+        return self._cache_prefix(key) + '_' + digest(created) + self.file_format.extension
+
+
+def digest(value):
+    return hashlib.sha256(str(value).encode('utf-8')).hexdigest()[:DIGEST_LENGTH]
+
+
+def remove_file(filename):
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
@@ -0,0 +1,36 @@
+# Cache of facet values ('uniques') for the sample and sequence tables
+#
+# Facet values are held per (species, dataset, table, filter), and per column, so that a request for
+# different columns under the same filter only computes the columns it has not seen before.
+# Entries for the unfiltered tables are held in a DatasetCache and pickled to disk. There is no end to the filters
+# that users may apply, so entries for filtered tables are only held in memory, limited to the most recently used.
+
+import hashlib
+import json
+
+from db.dataset_cache import DatasetCache
+
+
+class FacetIndex():
+    def __init__(self, cache_dir, max_entries=256):
+        self.unfiltered = DatasetCache('facets', cache_dir)
+        self.filtered = DatasetCache('facets', max_entries=max_entries)
+
+    # Return {col: [values]} for the requested columns of a single dataset
+    # compute(cols) is called for any columns that are not held, and should return {col: [values]} for them
+
+    def get(self, species, dataset, created, table, filter, cols, compute):
+        key = (species, dataset, table, filter_hash(filter))
+        cache = self.filtered if filter else self.unfiltered
+        entry = dict(cache.lookup(key, created) or {})
+
+        missing = [col for col in cols if col not in entry]
+        if missing:
+            entry.update(compute(missing))
+            cache.put(key, created, entry)
+
+        return {col: entry[col] for col in cols}
+
+
+def filter_hash(filter):
+    return hashlib.sha256(json.dumps(filter, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:32]
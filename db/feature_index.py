@@ -0,0 +1,78 @@
+# In-memory index of the features of each genomic dataset, by position and by name
+#
+# The features of a dataset are read on first use and held per reference sequence, sorted by start, so that the
+# features overlapping a range are found by bisection rather than by a scan of the table. Names are indexed by
+# trigram, so that a search for a substring (case-insensitive, as LIKE is in SQLite) need only check names that
+# contain all of its trigrams. Indexes are held in a DatasetCache.
+
+import numpy as np
+
+from db.dataset_cache import DatasetCache
+from db.genomic_db import Feature
+
+FEATURE_FIELDS = ['id', 'name', 'feature_level', 'feature_type', 'feature', 'start', 'end', 'strand', 'attribute', 'parent_id']
+
+
+class RefSeqFeatures():
+    def __init__(self, features):
+        features = sorted(features, key=lambda f: (f['start'], f['end']))
+        self.features = features
+        self.starts = np.array([f['start'] for f in features], dtype=np.int64)
+        self.ends = np.array([f['end'] for f in features], dtype=np.int64)
+        self.max_length = max(0, int((self.ends - self.starts).max())) if features else 0
+
+        self.names = [(f['name'] or '').lower() for f in features]
+        self.trigrams = {}
+        for i, name in enumerate(self.names):
+            for trigram in set(trigrams(name)):
+                if trigram not in self.trigrams:
+                    self.trigrams[trigram] = []
+                self.trigrams[trigram].append(i)
+
+    # Features overlapping start..end (inclusive), in order of start
+    def overlapping(self, start, end):
+        # a feature overlapping the range cannot start more than max_length before it
+        lo = np.searchsorted(self.starts, start - self.max_length, side='left')
+        hi = np.searchsorted(self.starts, end, side='right')
+        hits = np.nonzero(self.ends[lo:hi] >= start)[0] + lo
+        return [self.features[i] for i in hits]
+
+    # Features whose name contains the string (case-insensitive)
+    def named(self, name_string):
+        name_string = name_string.lower()
+        candidates = range(len(self.names))
+
+        for trigram in set(trigrams(name_string)):
+            if trigram not in self.trigrams:
+                return []
+            if len(self.trigrams[trigram]) < len(candidates):
+                candidates = self.trigrams[trigram]
+
+        return [self.features[i] for i in candidates if name_string in self.names[i]]
+
+
+class FeatureIndex():
+    def __init__(self):
+        self.cache = DatasetCache('features')
+
+    # Return the index of the features on a reference sequence, as RefSeqFeatures (empty if it has none)
+
+    def get(self, species, dataset, created, session, refseq_id):
+        by_refseq = self.cache.get((species, dataset), created, lambda: build_index(session))
+        return by_refseq.get(refseq_id, RefSeqFeatures([]))
+
+
+def build_index(session):
+    columns = [getattr(Feature, field) for field in FEATURE_FIELDS]
+    by_refseq = {}
+
+    for row in session.query(Feature.refseq_id, *columns).filter(Feature.start.isnot(None), Feature.end.isnot(None)).all():
+        if row[0] not in by_refseq:
+            by_refseq[row[0]] = []
+        by_refseq[row[0]].append(dict(zip(FEATURE_FIELDS, row[1:])))
+
+    return {refseq_id: RefSeqFeatures(features) for refseq_id, features in by_refseq.items()}
+
+
+def trigrams(s):
+    return [s[i:i + 3] for i in range(len(s) - 2)]
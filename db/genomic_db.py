@@ -1,7 +1,8 @@
 from sqlalchemy import Boolean, Column, DECIMAL, DateTime, ForeignKey, Index, Integer, String, Table, Text, func, BigInteger, Float
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, deferred, object_session
 from sqlalchemy.ext.declarative import declarative_base
 from db.db_propertymixin import Details_Mixin
+from db.sequence_store import sequence_file_path, get_indexed_fasta
 
 Base = declarative_base()
 metadata = Base.metadata
@@ -15,7 +16,7 @@ class RefSeq(Base):
     __tablename__ = 'ref_seq'
     id = Column(Integer, primary_key=True)
     name = Column(String(100))
-    sequence = Column(Text(10000000))
+    sequence = deferred(Column(Text(10000000)))      # held in ref_seq.fasta: see get_subsequence
     length = Column(Integer)
     chromosome = Column(String(10))
     start = Column(BigInteger)
@@ -24,6 +25,10 @@ class RefSeq(Base):
     sense = Column(String(1))
     samples = relationship("Sample", backref='ref_seq')
 
+    # Bases start..end (1-based, inclusive) of the sequence
+    def get_subsequence(self, start, end):
+        return get_subsequence(self, 'ref_seq', self.name, start, end)
+
 
 # The association proxy extension is used for many-many relationships: see
 # https://docs.sqlalchemy.org/en/13/orm/basic_relationships.html
@@ -105,13 +110,17 @@ class Assembly(Base):
     identifier = Column(String(100))
     reference = Column(String(500))
     sequence_file = Column(String(500))
-    sequence = Column(Text(10000000))
+    sequence = deferred(Column(Text(10000000)))      # held in assembly.fasta: see get_subsequence
     patient_id = Column(Integer, ForeignKey('patient.id'))
     patient = relationship("Patient", backref='assemblies')
     chromosome = Column(String(10))
     start = Column(BigInteger)
     end = Column(BigInteger)
 
+    # Bases start..end (1-based, inclusive) of the sequence
+    def get_subsequence(self, start, end):
+        return get_subsequence(self, 'assembly', self.identifier, start, end)
+
 
 class Gene(Base):
     __tablename__ = 'gene'
@@ -125,4 +134,19 @@ class Gene(Base):
     sequences = relationship('Sequence', backref='gene')
 
 
+# Read a slice of a RefSeq or Assembly sequence from the dataset's sequence file, falling back to the sequence
+# column for databases built before the sequences were moved out
+# If the sequence is in neither (e.g. the sequence file was not deployed with the database), an error is logged and
+# an empty string returned
+
+def get_subsequence(record, table, name, start, end):
+    path = sequence_file_path(object_session(record), table)
+    reader = get_indexed_fasta(path)
+    subsequence = reader.fetch(name, start, end) if reader is not None else None
+
+    if subsequence is None:
+        if not record.sequence:
+            print('Error: sequence %s is not in %s or in the %s table' % (name, path, table))
+        subsequence = (record.sequence or '')[max(start, 1) - 1:max(end, 0)]
 
+    return subsequence
@@ -4,8 +4,10 @@ from receptor_utils import simple_bio_seq as simple
 from receptor_utils import novel_allele_name
 from db.genomic_db import RefSeq, Feature, SampleSequence, Sequence, Details, Assembly, Gene
 from db.genomic_airr_model import Sample, Study, Patient, SeqProtocol, TissuePro, DataPro
-from sqlalchemy import and_
+from sqlalchemy import and_, func, distinct
+from sqlalchemy.orm import object_session
 from db.genomic_ref import find_type
+from db.sequence_store import add_sequence, sequence_file_path
 import datetime
 from hashlib import sha256
 
@@ -46,6 +48,7 @@ def save_genomic_dataset_details(session, species, locus, commit_id, branch):
 
 def save_genomic_ref_seq(session, name, ref_sequence, reference, chromosome, start, end, sense):
     ref_seq = RefSeq(name=name, sequence='', length=len(ref_sequence), reference=reference, chromosome=chromosome, start=start, end=end, sense=sense)
+    add_sequence(sequence_file_path(session, 'ref_seq'), name, ref_sequence)
     session.add(ref_seq)
     return ref_seq
 
@@ -94,7 +97,8 @@ def save_genomic_sample(session, identifier, patient, name_in_study, reference_a
 
 
 def save_genomic_assembly(identifier, reference, sequence_file, sequence, chromosome, start, end, patient):
-    assembly = Assembly(identifier=identifier, reference=reference, sequence_file=sequence_file, sequence=sequence, chromosome=chromosome, start=start, end=end)
+    assembly = Assembly(identifier=identifier, reference=reference, sequence_file=sequence_file, sequence='', chromosome=chromosome, start=start, end=end)
+    add_sequence(sequence_file_path(object_session(patient), 'assembly'), identifier, sequence)
     patient.assemblies.append(assembly)
     return assembly
 
@@ -309,25 +313,34 @@ def find_feature_by_name(session, feature_type, name, ref_seq):
 
 # Once all samples are onboard, calculate the number of subjects that each sequence appears in
 def calculate_appearances(session):
-    seqs = session.query(Sequence).all()
-    for seq in seqs:
-        subject_count = session.query(Patient) \
-            .join(Sample, Sample.patient_id == Patient.id) \
-            .join(SampleSequence, SampleSequence.sample_id == Sample.id) \
-            .join(Sequence, Sequence.id == SampleSequence.sequence_id) \
-            .filter(Sequence.id == seq.id) \
-            .distinct().count()
-        seq.appearances = subject_count
+    subject_counts = dict(
+        session.query(SampleSequence.sequence_id, func.count(distinct(Patient.id)))
+        .join(Sample, Sample.id == SampleSequence.sample_id)
+        .join(Patient, Patient.id == Sample.patient_id)
+        .group_by(SampleSequence.sequence_id)
+        .all()
+    )
+
+    session.bulk_update_mappings(Sequence, [{'id': seq_id, 'appearances': subject_counts.get(seq_id, 0)}
+                                            for (seq_id,) in session.query(Sequence.id).all()])
 
 
 # Calculate the sample with the highest coverage for each sequence
 def calculate_max_cov_sample(session):
-    seqs = session.query(Sequence).all()
-    for seq in seqs:
-        ss = session.query(SampleSequence).filter(SampleSequence.sequence_id == seq.id).order_by(SampleSequence.fully_spanning_matches.desc()).first()
-
-        if ss is not None:
-            seq.max_coverage = ss.fully_spanning_matches
-            seq.max_coverage_sample_id = ss.sample_id
-            if ss.fully_spanning_matches:
-                    seq.max_coverage_sample_name = ss.sample.sample_name
+    ranked = session.query(SampleSequence.sequence_id,
+                           SampleSequence.sample_id,
+                           SampleSequence.fully_spanning_matches,
+                           Sample.sample_name,
+                           func.row_number().over(partition_by=SampleSequence.sequence_id,
+                                                  order_by=(SampleSequence.fully_spanning_matches.desc(), SampleSequence.sample_id)).label('rank'))\
+        .join(Sample, Sample.id == SampleSequence.sample_id)\
+        .subquery()
+
+    updates = []
+    for seq_id, sample_id, fully_spanning_matches, sample_name, _ in session.query(ranked).filter(ranked.c.rank == 1).all():
+        update = {'id': seq_id, 'max_coverage': fully_spanning_matches, 'max_coverage_sample_id': sample_id}
+        if fully_spanning_matches:
+            update['max_coverage_sample_name'] = sample_name
+        updates.append(update)
+
+    session.bulk_update_mappings(Sequence, updates)
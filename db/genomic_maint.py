@@ -14,9 +14,10 @@ from db.genomic_ref import update_genomic_ref, read_gene_order
 from db.genomic_airr_model import Sample, Study, Patient, SeqProtocol, TissuePro, DataPro
 from db.genomic_db import Base, RefSeq
 from db.genomic_db_functions import save_genomic_dataset_details, save_genomic_ref_seq, calculate_appearances, calculate_max_cov_sample
-from db.igenotyper import process_igenotyper_record, add_gene_level_features
+from db.igenotyper import process_igenotyper_record, add_gene_level_features, ImportRegistry
 from db.bed_file import read_bed_files
 from db.source_details import db_source_details
+from db.sequence_store import remove_sequence_files
 
 
 Session = sessionmaker()
@@ -67,8 +68,21 @@ def create_dataset(species, dataset):
                 add_gene_level_features(session, ref, reference_features)
 
         session.commit()
-        for study_name, study in study_data['Studies'].items():
-            process_study(dataset_dir, reference_features, session, study, study_name, reference_set_version)
+
+        # look sequences and features up from memory during the import. The registry holds ORM instances across the
+        # commit made after each sample, so these are not expired (and reloaded) on commit while it is in use
+        session.info['igenotyper_registry'] = ImportRegistry(session)
+        session.expire_on_commit = False
+        try:
+            for study_name, study in study_data['Studies'].items():
+                process_study(dataset_dir, reference_features, session, study, study_name, reference_set_version)
+        finally:
+            session.expire_on_commit = True
+            del session.info['igenotyper_registry']
+
+        # once all studies are onboard, calculate appearances and coverage across the dataset
+        calculate_appearances(session)
+        calculate_max_cov_sample(session)
 
     except ImportException as e:
         print(e)
@@ -96,6 +110,7 @@ def create_database(dataset_dir):
     db_file = os.path.join(dataset_dir, 'db.sqlite3')
     if os.path.isfile(db_file):
         os.remove(db_file)
+    remove_sequence_files(dataset_dir)
     engine = create_engine('sqlite:///' + db_file, echo=False, poolclass=NullPool)
     Base.metadata.create_all(engine)
     db_connection = engine.connect()
@@ -190,9 +205,6 @@ def process_study(dataset_dir, reference_features, session, study, study_name, r
         process_igenotyper_record(session, dataset_dir, sample_obj, study['annotation_file'], reference_features, bam_path)
         
     session.commit()
-    calculate_appearances(session)
-    calculate_max_cov_sample(session)
-    session.commit()
 
 
 def create_subject(session, study_obj, subject_name, row):
@@ -5,11 +5,11 @@ import shutil
 import csv
 import glob
 
-from receptor_utils.simple_bio_seq import write_csv
+from sqlalchemy.orm.exc import MultipleResultsFound
 
-from db.genomic_db import Feature, SampleSequence
-from db.genomic_db_functions import save_novel_allele, add_feature_to_ref, find_feature_by_name, \
-    find_sequence_by_sequence, save_genomic_sequence, link_sequence_to_feature, update_sample_sequence_link, find_allele_by_name
+from db.genomic_db import Feature, SampleSequence, Sequence, Gene
+from db.genomic_db_functions import save_novel_allele, add_feature_to_ref, save_genomic_sequence, link_sequence_to_feature, \
+    update_sample_sequence_link
 
 
 class GeneParsingException(Exception):
@@ -19,9 +19,65 @@ class GeneParsingException(Exception):
 annotation_records = {}
 
 
-def read_csv(filename):
-    with open(filename, 'r') as fi:
-        return list(csv.DictReader(fi))
+# An annotation file, read once, with its rows grouped by (project, subject, sample). The text of each row is kept
+# alongside the parsed row, so that a sample's rows can be written to a file of their own as they were read
+
+class AnnotationFile():
+    def __init__(self, filename):
+        self.filename = filename
+        self.row_count = 0
+        self.rows = {}
+        self.lines = {}
+
+        with open(filename, 'r', newline='') as fi:
+            recorder = LineRecorder(fi)
+            reader = csv.DictReader(recorder)
+            reader.fieldnames       # read the header
+            self.header = recorder.take()
+
+            for row in reader:
+                key = (row['project'], str(row['subject']), str(row['sample_name']))
+                if key not in self.rows:
+                    self.rows[key] = []
+                    self.lines[key] = []
+                self.rows[key].append(row)
+                self.lines[key].append(recorder.take())
+                self.row_count += 1
+
+    def sample_rows(self, project, subject, sample_name):
+        return self.rows.get((project, str(subject), str(sample_name)), [])
+
+    # Write the rows of a sample to a file of their own, or copy the file if they are all it contains
+    def write_sample_file(self, project, subject, sample_name, filename):
+        key = (project, str(subject), str(sample_name))
+
+        if len(self.rows.get(key, [])) == self.row_count:
+            shutil.copy(self.filename, filename)
+        else:
+            with open(filename, 'w', newline='') as fo:
+                fo.write(self.header)
+                fo.writelines(self.lines.get(key, []))
+
+
+# Iterates over the lines of a file, keeping those read since the last call to take()
+
+class LineRecorder():
+    def __init__(self, fi):
+        self.fi = fi
+        self.lines = []
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = next(self.fi)
+        self.lines.append(line)
+        return line
+
+    def take(self):
+        text = ''.join(self.lines)
+        self.lines = []
+        return text
 
 
 def to_int(row, field):
@@ -46,6 +102,68 @@ def to_float(row, field):
         return 0
     
 
+# In-memory index of the sequences and allele-level features in the database, used during import in place of
+# find_allele_by_name, find_sequence_by_sequence and find_feature_by_name, and of a count of features to mint
+# feature ids. It is read from the database when the import starts, and attached to the session for its duration (as
+# session.info['igenotyper_registry']): sequences and features added during import must be added to it as well.
+# It holds ORM instances across the commit made after each sample, so the import session should not expire them on
+# commit (see create_dataset in genomic_maint.py).
+
+class ImportRegistry():
+    def __init__(self, session):
+        self.by_name = {}
+        self.by_sequence = {}
+        self.features = {}
+        self.feature_count = session.query(Feature).count()
+
+        for seq, gene_name in session.query(Sequence, Gene.name).join(Gene, Gene.id == Sequence.gene_id).all():
+            self.add_sequence(seq, gene_name)
+
+        for feature in session.query(Feature).filter(Feature.feature_level == 'allele').all():
+            add_to_index(self.features, (feature.feature_type, feature.name, feature.refseq_id), feature)
+
+    def add_sequence(self, seq, gene_name):
+        add_to_index(self.by_name, seq.name, seq)
+        add_to_index(self.by_sequence, (seq.type, gene_name, seq.sequence), seq)
+
+    # As with the queries they replace, lookups raise MultipleResultsFound if more than one record matches
+
+    def find_allele(self, name):
+        return one_or_none(self.by_name.get(name, []), 'sequences named %s' % name)
+
+    def find_sequence(self, sequence_type, gene_name, sequence):
+        return one_or_none(self.by_sequence.get((sequence_type, gene_name, sequence), []), '%s sequences of gene %s with the same sequence' % (sequence_type, gene_name))
+
+    def find_feature(self, feature_type, name, ref_seq):
+        return one_or_none(self.features.get((feature_type, name, ref_seq.id), []), '%s features named %s' % (feature_type, name))
+
+    # The id to give the next feature: the number of features in the database
+    def next_feature_id(self):
+        return self.feature_count
+
+    # Record a feature added with add_feature_to_ref
+    def add_feature(self, feature, ref_seq):
+        self.feature_count += 1
+        if feature.feature_level == 'allele':
+            add_to_index(self.features, (feature.feature_type, feature.name, ref_seq.id), feature)
+
+
+def add_to_index(index, key, record):
+    if key not in index:
+        index[key] = []
+    index[key].append(record)
+
+
+def one_or_none(records, description):
+    if len(records) > 1:
+        raise MultipleResultsFound('Multiple %s' % description)
+    return records[0] if records else None
+
+
+def get_import_registry(session):
+    return session.info['igenotyper_registry']
+
+
 # TODO - Simplify the schema by merging Feature and Sequence. See ../../notes on genomic schema.txt
 
 
@@ -55,9 +173,11 @@ def process_igenotyper_record(session, dataset_dir, sample, annotation_file, ref
     print(f"Importing sample {sample.sample_name}")
 
     if annotation_file not in annotation_records:
-        annotation_records[annotation_file] = read_csv(annotation_file)
+        annotation_records[annotation_file] = AnnotationFile(annotation_file)
 
-    rows = [x for x in annotation_records[annotation_file] if str(x['sample_name']) == str(sample.sample_id) and str(x['subject']) == str(sample.patient.subject_id) and x['project'] == sample.patient.study.study_id]
+    annotations = annotation_records[annotation_file]
+    sample_key = (sample.patient.study.study_id, sample.patient.subject_id, sample.sample_id)
+    rows = annotations.sample_rows(*sample_key)
 
     if not os.path.isdir(os.path.join(dataset_dir, 'samples')):
         os.mkdir(os.path.join(dataset_dir, 'samples'))
@@ -87,10 +207,7 @@ def process_igenotyper_record(session, dataset_dir, sample, annotation_file, ref
 
     sample_af_name = f"{sample.sample_name}.csv"
 
-    if len(rows) < len(annotation_records[annotation_file]):
-        write_csv(os.path.join(sample_path, sample_af_name), rows)
-    else:
-        shutil.copy(annotation_file, os.path.join(sample_path, sample_af_name))
+    annotations.write_sample_file(*sample_key, os.path.join(sample_path, sample_af_name))
     
     sample.annotation_path = '/'.join((study_name, sample.sample_name, sample_af_name))
 
@@ -124,6 +241,7 @@ def process_igenotyper_record(session, dataset_dir, sample, annotation_file, ref
 
     sense = '+'     # by + sense we mean 5' to 3'
     feature_id = 1
+    registry = get_import_registry(session)
 
     for row in rows:
         if 'sense' in row:
@@ -145,7 +263,7 @@ def process_igenotyper_record(session, dataset_dir, sample, annotation_file, ref
         #    continue
 
         if gene_type in ['V', 'D', 'J', 'C']:
-            seq = find_allele_by_name(session, row['vdjbase_allele'])
+            seq = registry.find_allele(row['vdjbase_allele'])
 
             if not seq:
                 if gene_type == 'V':
@@ -154,16 +272,18 @@ def process_igenotyper_record(session, dataset_dir, sample, annotation_file, ref
                     gapped_seq = ''
 
                 seq = save_novel_allele(session, row['gene'], row['vdjbase_allele'], row['notes'].replace('\\n', '\r\n'), row[f'{gene_type}-REGION'], gapped_seq)
+                if seq:
+                    registry.add_sequence(seq, row['gene'])
 
             update_sample_sequence_link(session, int(row['haplotype'].replace('h=', '')), sample, seq)
-            feature = find_feature_by_name(session, f'{gene_type}-REGION', seq.name, sample.ref_seq)
+            feature = registry.find_feature(f'{gene_type}-REGION', seq.name, sample.ref_seq)
 
             if feature and seq.sequence.replace('.', '') != feature.feature_seq.replace('.', ''):
                 print(f'Error: feature {feature.name} sequence does not match that of sequence {seq.name} in sample {sample.sample_name} subject {sample.patient.patient_name}')
 
             if gene_type == 'V':
                 if not feature:
-                    feature_id = session.query(Feature).count()
+                    feature_id = registry.next_feature_id()
 
                     if 'REGION' in reference_features[sample.ref_seq.name][seq.gene.name]:
                         start = reference_features[sample.ref_seq.name][seq.gene.name]['REGION']['start']
@@ -183,6 +303,7 @@ def process_igenotyper_record(session, dataset_dir, sample, annotation_file, ref
 
                     feature = add_feature_to_ref(seq.name, 'allele', 'V-REGION', feature_seq, row['V-REGION_CIGAR'], 'CDS', start, end, sense,
                                                  f"Name={seq.name}_V-REGION;ID={feature_id}", feature_id, sample.ref_seq)
+                    registry.add_feature(feature, sample.ref_seq)
 
                 link_sequence_to_feature(seq, feature)
                 add_feature('V-NONAMER', 'NONAMER', reference_features, row, seq, session, sample, sense)
@@ -195,11 +316,12 @@ def process_igenotyper_record(session, dataset_dir, sample, annotation_file, ref
 
             elif gene_type == 'D':
                 if not feature:
-                    feature_id = session.query(Feature).count()
+                    feature_id = registry.next_feature_id()
                     start = reference_features[sample.ref_seq.name][seq.gene.name]['EXON_1']['start']
                     end = reference_features[sample.ref_seq.name][seq.gene.name]['EXON_1']['end']
                     feature = add_feature_to_ref(seq.name, 'allele', 'D-REGION', seq.sequence, row['D-REGION_CIGAR'], 'CDS', start, end, sense,
                                                  f"Name={seq.name}_D-REGION;ID={feature_id}", feature_id, sample.ref_seq)
+                    registry.add_feature(feature, sample.ref_seq)
 
                 link_sequence_to_feature(seq, feature)
                 add_feature('D-3_NONAMER', '3_NONAMER', reference_features, row, seq, session, sample, sense)
@@ -211,11 +333,12 @@ def process_igenotyper_record(session, dataset_dir, sample, annotation_file, ref
 
             elif gene_type == 'J':
                 if not feature:
-                    feature_id = session.query(Feature).count()
+                    feature_id = registry.next_feature_id()
                     start = reference_features[sample.ref_seq.name][seq.gene.name]['EXON_1']['start']
                     end = reference_features[sample.ref_seq.name][seq.gene.name]['EXON_1']['end']
                     feature = add_feature_to_ref(seq.name, 'allele', 'J-REGION', seq.sequence, row['J-REGION_CIGAR'], 'CDS', start, end, sense,
                                                  f"Name={seq.name}_J-REGION;ID={feature_id}", feature_id, sample.ref_seq)
+                    registry.add_feature(feature, sample.ref_seq)
 
                 link_sequence_to_feature(seq, feature)
                 add_feature('J-NONAMER', 'NONAMER', reference_features, row, seq, session, sample, sense)
@@ -224,11 +347,12 @@ def process_igenotyper_record(session, dataset_dir, sample, annotation_file, ref
 
             elif gene_type == 'C':
                 if not feature:
-                    feature_id = session.query(Feature).count()
+                    feature_id = registry.next_feature_id()
                     start = reference_features[sample.ref_seq.name][seq.gene.name]['GENE']['start']
                     end = reference_features[sample.ref_seq.name][seq.gene.name]['GENE']['end']
                     feature = add_feature_to_ref(seq.name, 'allele', 'C-REGION', seq.sequence, row['C-REGION_CIGAR'], 'CDS', start, end, sense,
                                                  f"Name={seq.name}_C-REGION;ID={feature_id}", feature_id, sample.ref_seq)
+                    registry.add_feature(feature, sample.ref_seq)
                     link_sequence_to_feature(seq, feature)
 
                     for feature_name, rec in reference_features[sample.ref_seq.name][seq.gene.name].items():
@@ -258,7 +382,8 @@ def add_feature(feature, bed_name, reference_features, row, seq, session, sample
     if feature not in row or not row[feature]:
         return
 
-    feature_seq = find_sequence_by_sequence(session, feature, seq.gene.name, row[feature])
+    registry = get_import_registry(session)
+    feature_seq = registry.find_sequence(feature, seq.gene.name, row[feature])
 
     if not feature_seq:
         if feature == 'gene_sequence':
@@ -266,13 +391,15 @@ def add_feature(feature, bed_name, reference_features, row, seq, session, sample
         else:
             feature_name = f"{seq.gene.name}*{sha256(row[feature].encode('utf-8')).hexdigest()[-4:]}"
         feature_seq = save_genomic_sequence(session, feature_name, seq.gene.name, feature, False, False, '', row[feature], '')
+        if feature_seq:
+            registry.add_sequence(feature_seq, seq.gene.name)
 
     update_sample_sequence_link(session, int(row['haplotype'].replace('h=', '')), sample, feature_seq)
 
-    feature_rec = find_feature_by_name(session, feature, feature_seq.name, sample.ref_seq)
+    feature_rec = registry.find_feature(feature, feature_seq.name, sample.ref_seq)
 
     if not feature_rec:
-        feature_id = session.query(Feature).count()
+        feature_id = registry.next_feature_id()
 
         #if bed_name == 'gene':
         #    breakpoint()
@@ -282,6 +409,7 @@ def add_feature(feature, bed_name, reference_features, row, seq, session, sample
 
         feature_rec = add_feature_to_ref(feature_seq.name, 'allele', feature, feature_seq.sequence,  row[feature + '_CIGAR'], 'UTR', start, end, strand,
                                      f"Name={feature_seq.name};ID={feature_id}", feature_id, sample.ref_seq)
+        registry.add_feature(feature_rec, sample.ref_seq)
 
     link_sequence_to_feature(feature_seq, feature_rec)
 
@@ -0,0 +1,61 @@
+# Inverted index from k-mers to the sequences that contain them
+#
+# Used to shortlist the sequences of a dataset that share enough k-mers with a query to be worth aligning. K-mers
+# are encoded as integers (two bits per base, case-insensitive). K-mers containing anything other than a, c, g or t
+# are not indexed. The index is held as arrays: the ids of the sequences containing each k-mer, in order of k-mer,
+# and the offset of each k-mer's ids, so that the ids of sequences containing k-mer c are ids[offsets[c]:offsets[c + 1]]
+
+import numpy as np
+
+KMER_LENGTH = 8
+
+BASE_CODES = np.full(256, -1, dtype=np.int64)
+for i, base in enumerate('acgt'):
+    BASE_CODES[ord(base)] = i
+    BASE_CODES[ord(base.upper())] = i
+
+KMER_WEIGHTS = 4 ** np.arange(KMER_LENGTH - 1, -1, -1, dtype=np.int64)
+
+
+class KmerIndex():
+    def __init__(self, sequences):
+        self.sequences = list(sequences)
+        self.lengths = np.array([len(seq) for seq in self.sequences], dtype=np.int64)
+
+        codes = []
+        ids = []
+        for i, seq in enumerate(self.sequences):
+            seq_codes = np.unique(kmer_codes(seq))
+            seq_codes = seq_codes[seq_codes >= 0]
+            codes.append(seq_codes)
+            ids.append(np.full(len(seq_codes), i, dtype=np.int32))
+
+        codes = np.concatenate(codes) if codes else np.zeros(0, dtype=np.int64)
+        ids = np.concatenate(ids) if ids else np.zeros(0, dtype=np.int32)
+        order = np.argsort(codes, kind='stable')
+
+        self.ids = ids[order]
+        self.offsets = np.zeros(4 ** KMER_LENGTH + 1, dtype=np.int64)
+        self.offsets[1:] = np.cumsum(np.bincount(codes, minlength=4 ** KMER_LENGTH))
+
+    # For each sequence, the number of the query's k-mer positions whose k-mer the sequence contains
+    # query_codes is as returned by kmer_codes()
+
+    def shared_kmer_counts(self, query_codes):
+        query_codes = query_codes[query_codes >= 0]
+        hits = [self.ids[self.offsets[code]:self.offsets[code + 1]] for code in query_codes]
+        hits = np.concatenate(hits) if hits else np.zeros(0, dtype=np.int32)
+        return np.bincount(hits, minlength=len(self.sequences))
+
+
+# The code of the k-mer at each position of a sequence, or -1 if the k-mer contains anything other than a, c, g or t
+
+def kmer_codes(seq):
+    if len(seq) < KMER_LENGTH:
+        return np.zeros(0, dtype=np.int64)
+
+    bases = BASE_CODES[np.frombuffer(seq.encode('ascii', 'replace'), dtype=np.uint8)]
+    windows = np.lib.stride_tricks.sliding_window_view(bases, KMER_LENGTH)
+    codes = windows @ KMER_WEIGHTS
+    codes[(windows < 0).any(axis=1)] = -1
+    return codes
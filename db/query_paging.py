@@ -0,0 +1,127 @@
+# Sorting and pagination of API queries in SQL, merged across one or more datasets
+#
+# Each dataset's query is ordered in SQL using expressions that mirror the sort keys previously
+# used in Python (plain, 'numeric' and 'underscore'). The sort key values are selected alongside the
+# row, so that pages from several datasets can be combined with a k-way merge without re-sorting.
+
+import heapq
+from itertools import islice
+
+from sqlalchemy import case, cast, func, or_, Float
+
+
+UNDERSCORE_SEPARATOR = '\x01'       # sorts below any printable character, so that shorter names sort first
+
+
+# Sort key for names such as P1_I12_S1: each field is stripped of its prefix letter and zero-padded
+# Registered with SQLite as underscore_sort_key() so that it can be used in ORDER BY
+
+def underscore_sort_key(name):
+    if name is None:
+        name = ''
+    return UNDERSCORE_SEPARATOR.join([el[1:].zfill(4) for el in name.split('_')])
+
+
+def register_sort_functions(dbapi_connection):
+    dbapi_connection.create_function('underscore_sort_key', 1, underscore_sort_key, deterministic=True)
+
+
+def is_blank(col):
+    return or_(col.is_(None), col == '')
+
+
+# Return the SQL sort key expressions for a column, given its sort mode
+
+def sort_expressions(col, sort_mode):
+    if sort_mode == 'underscore':
+        return [func.underscore_sort_key(col)]
+    elif sort_mode == 'numeric':
+        return [case([(is_blank(col), -1.0)], else_=cast(col, Float))]
+    else:
+        return [case([(is_blank(col), 1)], else_=0), col]
+
+
+# Compare rows on their selected sort keys, honouring the direction of each key
+# None sorts first, as in SQLite
+
+class MergeKey:
+    __slots__ = ('values', 'descending')
+
+    def __init__(self, values, descending):
+        self.values = values
+        self.descending = descending
+
+    def __lt__(self, other):
+        for v, o, desc in zip(self.values, other.values, self.descending):
+            if v == o:
+                continue
+            if v is None or o is None:
+                lt = v is None
+            else:
+                lt = v < o
+            return not lt if desc else lt
+        return False
+
+
+# queries: list of (dataset, query) in dataset order
+# sort_specs: list of (dataset -> list of sort expressions, descending), primary key first
+# tie_breaker: column that orders rows within a dataset when the sort keys are equal
+# returns the requested page of rows, as dicts, each with 'dataset' set, and the total row count
+
+def paged_query(queries, sort_specs, tie_breaker, page_number=None, page_size=None):
+    total = 0
+    for dset, query in queries:
+        total += query.order_by(None).count()
+
+    if page_size:
+        first = page_number * page_size if page_number else 0
+        if first >= total:
+            return [], total
+    else:
+        first = 0
+
+    streams = []
+    for ds_index, (dset, query) in enumerate(queries):
+        exprs = []
+        key_descending = []
+        for (make_exprs, desc) in sort_specs:
+            for expr in make_exprs(dset):
+                exprs.append(expr)
+                key_descending.append(desc)
+
+        exprs.append(tie_breaker)
+        key_descending.append(False)
+
+        labels = ['sort_key_%d' % i for i in range(len(exprs))]
+        q = query.add_columns(*[expr.label(label) for expr, label in zip(exprs, labels)])
+        q = q.order_by(*[expr.desc() if desc else expr.asc() for expr, desc in zip(exprs, key_descending)])
+
+        # rows with equal keys are taken in dataset order, as if the datasets' rows had been concatenated
+        key_descending.insert(-1, False)
+
+        if page_size:
+            if len(queries) == 1:
+                q = q.limit(page_size).offset(first)
+            else:
+                q = q.limit(first + page_size)
+
+        streams.append(_keyed_rows(q, dset, ds_index, labels, key_descending))
+
+    if len(streams) == 1:
+        rows = streams[0]
+    else:
+        rows = heapq.merge(*streams, key=lambda x: x[0])
+        if page_size:
+            rows = islice(rows, first, first + page_size)
+
+    return [row for _, row in rows], total
+
+
+def _keyed_rows(query, dset, ds_index, labels, key_descending):
+    for r in query:
+        row = r._asdict()
+        values = [row.pop(label) for label in labels]
+        values.insert(-1, ds_index)
+        key = MergeKey(tuple(values), key_descending)
+        row['dataset'] = dset
+        yield key, row
@@ -0,0 +1,106 @@
+# Storage of reference and assembly sequences outside the genomic database
+#
+# Sequences of many megabases are written to a FASTA file alongside the dataset's db.sqlite3, one file per table
+# (ref_seq.fasta, assembly.fasta), with fixed-length lines and a samtools-style .fai index. A slice is then read
+# from a memory map of the file, without the rest of the sequence being loaded. The files can be used directly by
+# samtools and genome browsers. When a dataset is deployed, the sequence files and their .fai indexes must be copied
+# along with db.sqlite3: SEQUENCE_FILES lists them.
+
+import mmap
+import os
+import threading
+
+LINE_LENGTH = 60
+SEQUENCE_TABLES = ['ref_seq', 'assembly']
+SEQUENCE_FILES = [table + ext for table in SEQUENCE_TABLES for ext in ('.fasta', '.fasta.fai')]
+
+readers = {}
+readers_lock = threading.Lock()
+
+
+# Return the directory holding the database that a session is bound to
+
+def dataset_dir(session):
+    database = session.get_bind().engine.url.database
+
+    # read-only providers open the database by URI (file:<path>)
+    if database.startswith('file:'):
+        database = database[len('file:'):]
+
+    return os.path.dirname(os.path.abspath(database))
+
+
+def sequence_file_path(session, table):
+    return os.path.join(dataset_dir(session), table + '.fasta')
+
+
+# Remove the sequence files of a dataset, when its database is rebuilt
+
+def remove_sequence_files(dir_path):
+    for filename in SEQUENCE_FILES:
+        if os.path.isfile(os.path.join(dir_path, filename)):
+            os.remove(os.path.join(dir_path, filename))
+
+
+# Append a sequence to a sequence file, and to its index
+
+def add_sequence(path, name, sequence):
+    with open(path, 'ab') as fo:
+        fo.write(b'>%s\n' % name.encode('utf-8'))
+        offset = fo.tell()
+        for i in range(0, len(sequence), LINE_LENGTH):
+            fo.write(sequence[i:i + LINE_LENGTH].encode('ascii') + b'\n')
+
+    with open(path + '.fai', 'a') as fo:
+        fo.write('%s\t%d\t%d\t%d\t%d\n' % (name, len(sequence), offset, LINE_LENGTH, LINE_LENGTH + 1))
+
+
+class IndexedFasta():
+    def __init__(self, path):
+        self.index = {}
+
+        with open(path + '.fai', 'r') as fi:
+            for line in fi:
+                name, length, offset, line_bases, line_width = line.rstrip('\n').split('\t')[:5]
+                self.index[name] = (int(length), int(offset), int(line_bases), int(line_width))
+
+        with open(path, 'rb') as fi:
+            self.map = mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(path) else b''
+
+    # Return bases start..end (1-based, inclusive) of the named sequence, or None if it is not in the file
+
+    def fetch(self, name, start, end):
+        if name not in self.index:
+            return None
+
+        length, offset, line_bases, line_width = self.index[name]
+        start = max(start, 1) - 1
+        end = min(end, length)
+
+        if end <= start:
+            return ''
+
+        first = offset + (start // line_bases) * line_width + start % line_bases
+        last = offset + ((end - 1) // line_bases) * line_width + (end - 1) % line_bases
+        return self.map[first:last + 1].replace(b'\n', b'').decode('ascii')
+
+
+# Return the IndexedFasta for a sequence file, or None if the file has not been written
+# Readers are shared between threads, and are re-opened if the file is rewritten
+
+def get_indexed_fasta(path):
+    try:
+        version = (os.path.getmtime(path), os.path.getmtime(path + '.fai'))
+    except OSError:
+        return None
+
+    with readers_lock:
+        if path in readers and readers[path][0] == version:
+            return readers[path][1]
+
+    reader = IndexedFasta(path)
+
+    with readers_lock:
+        readers[path] = (version, reader)
+
+    return reader
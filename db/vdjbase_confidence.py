@@ -15,12 +15,13 @@ from Bio.Seq import Seq
 from Bio.Data.CodonTable import TranslationError
 from sqlalchemy import not_, distinct, or_
 
-from db.vdjbase_genotypes import find_allele_or_similar
+from db.vdjbase_genotypes import find_allele_or_similar, AlleleIndex
 from db.vdjbase_model import Allele, AllelesSample, Gene, GenesDistribution, AllelesPattern, AlleleConfidenceReport, SNP, HaplotypeEvidence, SamplesHaplotype
 from db.vdjbase_airr_model import SeqProtocol, Sample
 
 import re
 import csv
+import pandas as pd
 
 
 
@@ -29,7 +30,15 @@ def check_novel_confidence(ds_dir, session):
     result = ['Running confidence checks']
     novels = session.query(Allele).filter(Allele.novel == True).all()
 
-    gather_haplo_data(novels, ds_dir, session)
+    # read the haplotype files once, for all of the haplotype-based checks
+    haplo_data = read_haplotype_files(ds_dir, session)
+
+    # resolve allele names from memory rather than with a query per name
+    session.info['allele_index'] = AlleleIndex(session)
+    try:
+        gather_haplo_data(novels, haplo_data, session)
+    finally:
+        del session.info['allele_index']
 
     # write novel alleles and sequences to a reference file so that it can be compared with other releases
 
@@ -40,7 +49,7 @@ def check_novel_confidence(ds_dir, session):
     check_ogrdbstats_for_novels(novels, ds_dir)
 
     #   Check for deletion on other chromosome, or novel allele present on both chromosomes
-    check_for_singleton_infs(novels, ds_dir, session)
+    check_for_singleton_infs(novels, haplo_data, session)
 
     # Mark an allele as low confidence only if the only sightings we have are on both chromosomes
     # Important this runs before we look at any other low-confidence markers
@@ -127,9 +136,40 @@ def allele_copy_stats():
 """
 
 
+# Read each haplotype file referenced in SamplesHaplotype, once, into a DataFrame holding the columns used by the
+# confidence checks. Returns a list of (SamplesHaplotype, DataFrame)
+
+HAPLO_COLUMNS = {1: 'gene', 2: 'h1', 3: 'h2', 4: 'alleles', 7: 'count1', 9: 'count2', 11: 'count3', 13: 'count4'}
+
+
+def read_haplotype_files(ds_dir, session):
+    haplo_data = []
+
+    for sample_haplotype in session.query(SamplesHaplotype).all():
+        print(sample_haplotype.haplotypes_file.file)
+        with open(os.path.join(ds_dir, sample_haplotype.haplotypes_file.file), 'r', newline='') as fi:
+            rows = [row for row in csv.reader(fi, dialect='excel-tab') if row]
+
+        if len(rows) < 2:
+            continue        # no haplotypes, or only a header
+
+        # check whether or not rows have an R style index number
+        try:
+            row_index = float(rows[0][0])
+        except:
+            row_index = False
+
+        offset = 1 if row_index else 0
+        haplos = pd.DataFrame(rows[1:], dtype=object)
+        haplos = haplos.reindex(columns=[col + offset for col in HAPLO_COLUMNS.keys()]).fillna('')
+        haplos.columns = list(HAPLO_COLUMNS.values())
+        haplo_data.append((sample_haplotype, haplos))
+
+    return haplo_data
+
+
 # Collect haplotyping info on novel alleles, store in HaplotypeEvidence
-def gather_haplo_data(novels, ds_dir, session):
-    sample_haplotypes = session.query(SamplesHaplotype).all()
+def gather_haplo_data(novels, haplo_data, session):
     alleles = session.query(Allele.name, Allele.pipeline_name).all()
 
     vdjbase_allele = {}
@@ -140,82 +180,69 @@ def gather_haplo_data(novels, ds_dir, session):
                 pa = pa.split('*')[0] + '*' + pa.split('*')[1].lower()
                 vdjbase_allele[pa] = allele.name
 
-    for sample_haplotype in sample_haplotypes:
-        print(sample_haplotype.haplotypes_file.file)
-        with open(os.path.join(ds_dir, sample_haplotype.haplotypes_file.file), 'r', newline='') as fi:
-            reader = csv.reader(fi, dialect='excel-tab')
-            header = True
-            row_index = True
-
-            for row in reader:
-                if header:
-                    header = False
-                    # check whether or not rows have an R style index number
-                    try:
-                        row_index = float(row[0])
-                    except:
-                        row_index = False
-                    continue
-
-                if row_index:
-                    row = row[1:]
-
-                haplotyped = set(row[2].split(',')) ^ set(row[3].split(','))
-                for allele in haplotyped:
-                    if '_' in allele:
-                        name = row[1] + '*' + allele.lower()
-
-                        if name in vdjbase_allele:
-                            name = vdjbase_allele[name]
-
-                        n = find_allele_or_similar(name, session)
-
-                        if n:
-                            allele_names = row[4].split(',')
-                            allele_counts = [row[7], row[9], row[11], row[13]]
-                            counts = []
-
-                            for i in range(len(allele_names)):
-                                counts.append('%s (%s)' % (allele_names[i], allele_counts[i]))
-
-                            he = HaplotypeEvidence(
-                                hap_gene=sample_haplotype.haplotypes_file.by_gene,
-                                sample_id=sample_haplotype.samples_id,
-                                allele=n,
-                                counts=', '.join(counts)
-                            )
-                            session.add(he)
-                        else:
-                            # check for 'either this or that' format, which is not an error but we will ignore.
-                            # the format consists of two allele numbers separated by underscores and possibly with nucleotide variants
-                            # .. the key is two int'gers, representing allele numbers, with no dots, therefore not the ambiguous gene format
-
-                            if '.' not in allele:
-                                allele_count = 0
-
-                                for frag in allele.split('_'):
-                                    try:
-                                        x = int(frag)
-                                        allele_count += 1
-                                    except:
-                                        pass
-
-                                if allele_count > 1:
-                                    print('either/or format in %s ignored' % name)
-                                    continue
-
-                            print('Allele %s is present in haplotype file %s but is not in the Alleles table' % (name, sample_haplotype.haplotypes_file.file))
+    evidence = []
+    evidence_samples = {}       # allele id -> ids of samples with evidence, in the order found
+    sample_evidence = {}        # sample id -> evidence found in that sample
 
-    for novel in novels:
-        if session.query(HaplotypeEvidence).filter(HaplotypeEvidence.allele_id == novel.id).count():
-            detects = []
-            for sample_id in set([h.sample_id for h in session.query(HaplotypeEvidence).filter(HaplotypeEvidence.allele_id == novel.id).all()]):
+    for sample_haplotype, haplos in haplo_data:
+        hap_gene = sample_haplotype.haplotypes_file.by_gene
+        sample_id = sample_haplotype.samples_id
+
+        # only novel alleles (which contain an underscore) are of interest
+        haplos = haplos[haplos.h1.str.contains('_', regex=False) | haplos.h2.str.contains('_', regex=False)]
 
-                hap_genes = []
-                for h in session.query(HaplotypeEvidence).filter(HaplotypeEvidence.sample_id == sample_id).all():
-                    hap_genes.append('%s (%s)' % (h.hap_gene, h.counts))
+        for gene, h1, h2, allele_names, *allele_counts in haplos.itertuples(index=False, name=None):
+            haplotyped = set(h1.split(',')) ^ set(h2.split(','))
+            for allele in haplotyped:
+                if '_' in allele:
+                    name = gene + '*' + allele.lower()
 
-                detects.append('%s(%s)' % (session.query(Sample).filter(Sample.id == sample_id).one_or_none().sample_name, ', '.join(hap_genes)))
+                    if name in vdjbase_allele:
+                        name = vdjbase_allele[name]
+
+                    n = find_allele_or_similar(name, session)
+
+                    if n:
+                        counts = ', '.join(['%s (%s)' % (a, c) for a, c in zip(allele_names.split(','), allele_counts)])
+                        evidence.append({'hap_gene': hap_gene, 'sample_id': sample_id, 'allele_id': n.id, 'counts': counts})
+
+                        if n.id not in evidence_samples:
+                            evidence_samples[n.id] = {}
+                        evidence_samples[n.id][sample_id] = True
+
+                        if sample_id not in sample_evidence:
+                            sample_evidence[sample_id] = []
+                        sample_evidence[sample_id].append('%s (%s)' % (hap_gene, counts))
+                    else:
+                        # check for 'either this or that' format, which is not an error but we will ignore.
+                        # the format consists of two allele numbers separated by underscores and possibly with nucleotide variants
+                        # .. the key is two int'gers, representing allele numbers, with no dots, therefore not the ambiguous gene format
+
+                        if '.' not in allele:
+                            allele_count = 0
+
+                            for frag in allele.split('_'):
+                                try:
+                                    x = int(frag)
+                                    allele_count += 1
+                                except:
+                                    pass
+
+                            if allele_count > 1:
+                                print('either/or format in %s ignored' % name)
+                                continue
+
+                        print('Allele %s is present in haplotype file %s but is not in the Alleles table' % (name, sample_haplotype.haplotypes_file.file))
+
+    session.bulk_insert_mappings(HaplotypeEvidence, evidence)
+
+    sample_names = {sample_haplotype.samples_id: sample_haplotype.samples.sample_name for sample_haplotype, _ in haplo_data}
+
+    for novel in novels:
+        if novel.id in evidence_samples:
+            detects = []
+            for sample_id in evidence_samples[novel.id]:
+                detects.append('%s(%s)' % (sample_names[sample_id], ', '.join(sample_evidence[sample_id])))
 
             report_issue(novel, 'Confirmation from Haplotype', 'Inferred allele on one chromosome only in sample(s) %s.' % (', '.join(detects)), session, low_confidence=False)
 
@@ -338,71 +365,47 @@ def check_shared_snp(novels, session):
 
 
 # Report if an allele is present on both chromosomes, or if there is a deletion
-def check_for_singleton_infs(novels, ds_dir, session):
-    sample_haplotypes = session.query(SamplesHaplotype).all()
-    novel_set = frozenset([n.name for n in novels])
-    reported_duplicates = {}
-    reported_deletions = {}
-
-    for sample_haplotype in sample_haplotypes:
-        with open(os.path.join(ds_dir, sample_haplotype.haplotypes_file.file), 'r', newline='') as fi:
-            reader = csv.reader(fi, dialect='excel-tab')
-            header = True
-            row_index = True
-
-            for row in reader:
-                if header:
-                    header = False
-                    # check whether or not rows have an R style index number
-                    try:
-                        row_index = float(row[0])
-                    except:
-                        row_index = False
-                    continue
-
-                if row_index:
-                    row = row[1:]
-
-                h1 = set([row[1] + '*' + a.lower() for a in row[2].split(',')])
-                h2 = set([row[1] + '*' + a.lower() for a in row[3].split(',')])
-
-                haplotyped = h1 | h2
-                novel_haplotyped = haplotyped & novel_set
-                if len(novel_haplotyped):
-                    deleted = False
-
-                    for hap in haplotyped:
-                        if 'del' in hap:
-                            deleted = True
-                            break
-
-                    if deleted:
-                        for n in novel_haplotyped:
-                            novel = session.query(Allele).filter(Allele.name == n).one_or_none()
-                            if novel:
-                                novel_nondels = []
-                                for a in haplotyped:
-                                    if 'del' not in a and 'unk' not in a:
-                                        novel_nondels.append(a)
-
-                                if novel.name not in reported_deletions:
-                                    reported_deletions[novel.name] = []
-                                if sample_haplotype.samples.sample_name not in reported_deletions[novel.name]:
-                                    report_issue(novel, 'Deletion on other chromosome', 'In sample %s, allele(s) %s present on one chromosome, deletion on other (%s)'
-                                                 % (sample_haplotype.samples.sample_name, ', '.join(novel_nondels), sample_haplotype.haplotypes_file.by_gene), session, low_confidence=False)
-                                    reported_deletions[novel.name].append(sample_haplotype.samples.sample_name)
+def check_for_singleton_infs(novels, haplo_data, session):
+    novels_by_name = {n.name: n for n in novels}
+    novel_set = frozenset(novels_by_name.keys())
+    novel_genes = frozenset([name[:i] for name in novel_set for i, c in enumerate(name) if c == '*'])
+    reported_duplicates = set()
+    reported_deletions = set()
+
+    for sample_haplotype, haplos in haplo_data:
+        sample_name = sample_haplotype.samples.sample_name
+        hap_gene = sample_haplotype.haplotypes_file.by_gene
+
+        for gene, h1, h2 in haplos[haplos.gene.isin(novel_genes)][['gene', 'h1', 'h2']].itertuples(index=False, name=None):
+            h1 = set([gene + '*' + a.lower() for a in h1.split(',')])
+            h2 = set([gene + '*' + a.lower() for a in h2.split(',')])
+
+            haplotyped = h1 | h2
+            novel_haplotyped = haplotyped & novel_set
+            if len(novel_haplotyped):
+                deleted = False
+
+                for hap in haplotyped:
+                    if 'del' in hap:
+                        deleted = True
+                        break
 
-                    else:
-                        for n in novel_haplotyped:
-                            if n in h1 and n in h2:
-                                novel = session.query(Allele).filter(Allele.name == n).one_or_none()
-                                if novel:
-                                    if novel.name not in reported_duplicates:
-                                        reported_duplicates[novel.name] = []
-                                    if sample_haplotype.samples.sample_name not in reported_duplicates[novel.name]:
-                                        report_issue(novel, 'Inferred allele on both chromosomes', 'In sample %s, allele %s is present on both chromosomes (%s).'
-                                                     % (sample_haplotype.samples.sample_name, n, sample_haplotype.haplotypes_file.by_gene), session, low_confidence=True)
-                                        reported_duplicates[novel.name].append(sample_haplotype.samples.sample_name)
+                if deleted:
+                    novel_nondels = [a for a in haplotyped if 'del' not in a and 'unk' not in a]
+
+                    for n in novel_haplotyped:
+                        if (n, sample_name) not in reported_deletions:
+                            report_issue(novels_by_name[n], 'Deletion on other chromosome', 'In sample %s, allele(s) %s present on one chromosome, deletion on other (%s)'
+                                         % (sample_name, ', '.join(novel_nondels), hap_gene), session, low_confidence=False)
+                            reported_deletions.add((n, sample_name))
+
+                else:
+                    for n in novel_haplotyped:
+                        if n in h1 and n in h2:
+                            if (n, sample_name) not in reported_duplicates:
+                                report_issue(novels_by_name[n], 'Inferred allele on both chromosomes', 'In sample %s, allele %s is present on both chromosomes (%s).'
+                                             % (sample_name, n, hap_gene), session, low_confidence=True)
+                                reported_duplicates.add((n, sample_name))
 
 # An allele should be low_confidence if it is exclusively found on both chromosomes
 # If there are some cases in which it's only found on one, we allow it through
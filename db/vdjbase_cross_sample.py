@@ -3,6 +3,7 @@
 #
 import sqlite3
 
+import numpy as np
 import pandas as pd
 import os, math
 
@@ -18,29 +19,62 @@ from db.vdjbase_projects import compound_genes
 def update_alleles_appearance(session):
     """
     This function update the appearances count according to the number of patients.
+    The appearance count of an allele is the number of patients in which it is genotyped, plus, for each name in
+    its similar list, the number of patients in which an allele of that name is genotyped.
     """
     result = ['Updating allele appearance counts']
-    alleles = session.query(Allele)
 
-    for allele in alleles:
-        max_kdiff = session.query(func.max(AllelesSample.kdiff)).filter(AllelesSample.allele_id == allele.id).one_or_none()[0]
-        allele.max_kdiff = max_kdiff if max_kdiff is not None else 0
+    max_kdiffs = dict(session.query(AllelesSample.allele_id, func.max(AllelesSample.kdiff)).group_by(AllelesSample.allele_id).all())
+
+    patients_by_allele = {}
+    for allele_id, patient_id in session.query(AllelesSample.allele_id, AllelesSample.patient_id).filter(AllelesSample.hap == 'geno').distinct():
+        if allele_id not in patients_by_allele:
+            patients_by_allele[allele_id] = set()
+        patients_by_allele[allele_id].add(patient_id)
+
+    alleles = session.query(Allele.id, Allele.name, Allele.similar).all()
+
+    # patients by lower-case allele name, for case-insensitive matching of similar names
+
+    patients_by_name = {}
+    for allele_id, name, _ in alleles:
+        if name.lower() not in patients_by_name:
+            patients_by_name[name.lower()] = set()
+        if allele_id in patients_by_allele:
+            patients_by_name[name.lower()] |= patients_by_allele[allele_id]
+
+    similar_counts = {}
+
+    def similar_count(sim):
+        if sim not in similar_counts:
+            if '%' in sim or '_' in sim:
+                # names containing like wildcards are matched as the original ilike query would have done
+                pattern = re.compile('^' + re.escape(sim.lower()).replace('%', '.*').replace('_', '.') + '$', re.DOTALL)
+                patients = set()
+                for name, name_patients in patients_by_name.items():
+                    if pattern.match(name):
+                        patients |= name_patients
+                similar_counts[sim] = len(patients)
+            else:
+                similar_counts[sim] = len(patients_by_name.get(sim.lower(), ()))
+        return similar_counts[sim]
 
+    updates = []
+    for allele_id, name, similar in alleles:
+        max_kdiff = max_kdiffs.get(allele_id)
+        appears = len(patients_by_allele.get(allele_id, ()))
 
-        allele.appears = session.query(AllelesSample.patient_id).filter(AllelesSample.hap == 'geno').filter(AllelesSample.allele_id == allele.id).distinct().count()
-        if allele.similar is not None and allele.similar != '':
-            sims = allele.similar.split(', ')
-            for sim in sims:
-                sim = sim.replace('|', '')
-                allele.appears += session.query(AllelesSample.patient_id)\
-                    .join(Allele)\
-                    .filter(AllelesSample.hap == 'geno')\
-                    .filter(Allele.name.ilike(sim))\
-                    .distinct().count()
+        if similar is not None and similar != '':
+            for sim in similar.split(', '):
+                appears += similar_count(sim.replace('|', ''))
 
+        updates.append({'id': allele_id, 'appears': appears, 'max_kdiff': max_kdiff if max_kdiff is not None else 0})
+
+    session.bulk_update_mappings(Allele, updates)
     session.commit()
     return result
 
+
 def calculate_gene_frequencies(ds_dir, session):
     # upload the gene frequencies of the samples by calculating them from the genotype file.
 
@@ -120,33 +154,87 @@ def calculate_gene_frequencies(ds_dir, session):
     return result
 
 
+# Nucleotide codes used by the pattern matcher. Each character in an allele sequence is encoded as a single bit,
+# and each position in a pattern as the set of bits it matches. A pattern matches an allele if every position of
+# the pattern shares a bit with the corresponding position of the allele. Positions beyond the end of an allele are
+# encoded as 0, so that they match nothing.
+
+NUCLEOTIDE_BITS = {'a': 1, 'c': 2, 'g': 4, 't': 8, 'n': 16, '.': 32}
+OTHER_BIT = 64
+N_BITS = 1 | 2 | 4 | 8 | 16         # an n in a pattern matches any nucleotide, or n
+ANY_BITS = 127                      # a . in a pattern matches anything
+
+
+class PatternMatcher:
+    """
+    Matches ambiguous ('pattern') alleles against all alleles of a gene in a single vectorised operation.
+    The matching rule is that previously implemented with a regex: the pattern must match the start of the allele,
+    an 'n' in the pattern matches any nucleotide or 'n', and a '.' in the pattern matches any character.
+    """
+    def __init__(self, allele_seqs):
+        max_len = max([len(seq) for seq in allele_seqs]) if allele_seqs else 0
+        self.codes = np.zeros((len(allele_seqs), max_len), dtype=np.uint8)
+
+        for i, seq in enumerate(allele_seqs):
+            self.codes[i, :len(seq)] = [NUCLEOTIDE_BITS.get(c, OTHER_BIT) for c in seq]
+
+        self.allele_seqs = allele_seqs
+
+    def matches(self, pattern_seq):
+        """
+        Return a boolean array indicating which alleles match the pattern
+        """
+        if len(pattern_seq) > self.codes.shape[1]:
+            return np.zeros(len(self.allele_seqs), dtype=bool)
+
+        if any([c not in NUCLEOTIDE_BITS for c in pattern_seq]):
+            # characters outside the encoding can't be compared bitwise, so fall back to the regex
+            regex = re.compile(pattern_seq.replace("n", "[a,g,c,t,n]"))
+            return np.array([regex.match(seq) is not None for seq in self.allele_seqs], dtype=bool)
+
+        mask = np.array([ANY_BITS if c == '.' else N_BITS if c == 'n' else NUCLEOTIDE_BITS[c] for c in pattern_seq], dtype=np.uint8)
+
+        return np.all((self.codes[:, :len(pattern_seq)] & mask) != 0, axis=1)
+
+
 def calculate_patterns(session):
     # This function calculate the alleles that meets condition of pattern.
     result = ['Calculating patterns']
 
+    existing_patterns = set(session.query(AllelesPattern.allele_in_p_id, AllelesPattern.pattern_id).all())
+    new_patterns = []
+
     # take all V genes
-    genes = session.query(Gene).filter(Gene.name.like('%V%')).all()
 
-    for gene in genes:
-        alleles = session.query(Allele).filter(Allele.gene_id == gene.id).filter(Allele.name.notlike('%Del')).all()
-        patterns = session.query(Allele).filter(Allele.gene_id == gene.id).filter(Allele.name.notlike('%Del')).filter(Allele.is_single_allele == 0).all()
+    alleles_by_gene = {}
+    alleles = session.query(Allele.id, Allele.seq, Allele.gene_id, Allele.is_single_allele)\
+        .join(Gene, Gene.id == Allele.gene_id)\
+        .filter(Gene.name.like('%V%'))\
+        .filter(Allele.name.notlike('%Del'))\
+        .order_by(Allele.id)\
+        .all()
+
+    for allele in alleles:
+        if allele.gene_id not in alleles_by_gene:
+            alleles_by_gene[allele.gene_id] = []
+        alleles_by_gene[allele.gene_id].append(allele)
+
+    for gene_alleles in alleles_by_gene.values():
+        patterns = [allele for allele in gene_alleles if not allele.is_single_allele]
+
+        if not patterns:
+            continue
+
+        matcher = PatternMatcher([allele.seq for allele in gene_alleles])
+        allele_ids = np.array([allele.id for allele in gene_alleles])
 
         for pattern in patterns:
-            pattern_seq = pattern.seq.replace("n","[a,g,c,t,n]")
-
-            for allele in alleles:
-
-                if (pattern.id != allele.id):
-                    if (re.match(pattern_seq, allele.seq)):
-                        # check if pattern already exists
-                        if not session.query(AllelesPattern)\
-                                .filter(AllelesPattern.allele_in_p_id == allele.id)\
-                                .filter(AllelesPattern.pattern_id == pattern.id)\
-                                .count():
-                            ap = AllelesPattern(
-                                allele_in_p_id=allele.id,
-                                pattern_id=pattern.id
-                            )
-                            session.add(ap)
+            for allele_id in allele_ids[matcher.matches(pattern.seq)]:
+                allele_id = int(allele_id)
+                if allele_id != pattern.id and (allele_id, pattern.id) not in existing_patterns:
+                    existing_patterns.add((allele_id, pattern.id))
+                    new_patterns.append({'allele_in_p_id': allele_id, 'pattern_id': pattern.id})
+
+    session.bulk_insert_mappings(AllelesPattern, new_patterns)
     session.commit()
     return result
@@ -5,8 +5,9 @@ from os.path import join, isdir, isfile
 from os import listdir
 from time import sleep
 from flask import render_template, request, redirect, url_for, Markup
-from sqlalchemy import create_engine, inspect, text
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, inspect, text, event
+from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.pool import QueuePool
 from flask_table import Table, Col
 from flask_wtf import FlaskForm
 from werkzeug.exceptions import BadRequest
@@ -18,12 +19,20 @@ from werkzeug.utils import secure_filename
 from db.vdjbase_exceptions import DbCreationError
 from db.vdjbase_maint import create_single_database
 from db.vdjbase_model import Details
+from db.query_paging import register_sort_functions
 from extensions import celery
 import traceback
 
 Session = sessionmaker()
 
 
+# Size of the connection pool used by read-only providers. Each gunicorn thread or celery worker
+# checks out its own connection, so this should be at least the number of threads per process
+
+READ_ONLY_POOL_SIZE = 8
+READ_ONLY_POOL_OVERFLOW = 16
+
+
 class ContentProvider():
     db = None
     connection = None
@@ -32,18 +41,66 @@ class ContentProvider():
     binomial = None
     taxid = None
     created = None
+    read_only = False
 
-    def __init__(self, path, description):
-        self.db = create_engine('sqlite:///' + path + '?check_same_thread=false', echo=False)
-        self.connection = self.db.connect()
-        self.session = Session(bind=self.connection)
+    # If read_only is set, the database is opened via a pool of read-only connections, and session is a
+    # scoped_session, giving each thread (and hence each request or celery task) its own session.
+    # release_sessions() should be called at the end of each request/task to return connections to the pool.
+    # Otherwise a single read-write connection and session is used, as required by the database build scripts.
+
+    def __init__(self, path, description='', read_only=False):
         self.description = description
+        self.read_only = read_only
+
+        if read_only:
+            self.db = create_engine('sqlite:///file:' + path + '?mode=ro&immutable=1&uri=true',
+                                    connect_args={'check_same_thread': False},
+                                    poolclass=QueuePool,
+                                    pool_size=READ_ONLY_POOL_SIZE,
+                                    max_overflow=READ_ONLY_POOL_OVERFLOW,
+                                    echo=False)
+            event.listen(self.db, 'connect', _set_read_only_pragmas)
+            event.listen(self.db, 'connect', _register_functions)
+            self.session = scoped_session(sessionmaker(bind=self.db, autoflush=False))
+        else:
+            self.db = create_engine('sqlite:///' + path + '?check_same_thread=false', echo=False)
+            event.listen(self.db, 'connect', _register_functions)
+            self.connection = self.db.connect()
+            self.session = Session(bind=self.connection)
+
+    def release_session(self):
+        if self.read_only:
+            self.session.remove()
 
     def close(self):
-        self.connection.close()
+        if self.read_only:
+            self.session.remove()
+        else:
+            self.connection.close()
         self.db.dispose()
 
 
+def _set_read_only_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA query_only = ON')
+    cursor.execute('PRAGMA temp_store = MEMORY')
+    cursor.close()
+
+
+def _register_functions(dbapi_connection, connection_record):
+    register_sort_functions(dbapi_connection)
+
+
+# Return the connections used by the current thread's sessions to their pools.
+# Called on app context teardown, which covers both flask requests and celery tasks
+
+def release_sessions(*sqlite_dbs_list):
+    for sqlite_dbs in sqlite_dbs_list:
+        for species in sqlite_dbs.values():
+            for provider in species.values():
+                provider.release_session()
+
+
 # TODO: when we change to biomial species names, update this lookup and corresponding code
 species_lookup = {
     'Human': ('Homo sapiens', 'NCBITAXON: 9606'),
@@ -66,13 +123,23 @@ def study_data_db_init(vdjbase_db_path):
                             description = ' '.join(fi.readlines())
                     if species not in sqlite_dbs:
                         sqlite_dbs[species] = {}
-                    sqlite_dbs[species][name] = ContentProvider(join(p, name, 'db.sqlite3'), description)
+                    db_path = join(p, name, 'db.sqlite3')
+
+                    # temp fix: add asc_genotype column to sample table if not there already
+                    # This has to be done on a writeable connection, before the read-only provider is opened
+
+                    if 'genomic' not in vdjbase_db_path.lower():
+                        add_asc_genotype_column(db_path)
+
+                    sqlite_dbs[species][name] = ContentProvider(db_path, description, read_only=True)
 
                     session = sqlite_dbs[species][name].session
                     try:
                         sqlite_dbs[species][name].created = session.query(Details.created_on).one_or_none()[0]
                     except Exception as e:
                         print('Error querying Details table for %s/%s: %s' % (species, name, e))
+                    finally:
+                        sqlite_dbs[species][name].release_session()
 
                     if species in species_lookup:
                         sqlite_dbs[species][name].binomial = species_lookup[species][0]
@@ -82,19 +149,6 @@ def study_data_db_init(vdjbase_db_path):
                         sqlite_dbs[species][name].taxid = ''
                         print('Species %s not found in species lookup' % species)
 
-    # temp fix: add asc_genotype column to sample table if not there already
-
-    if 'genomic' not in vdjbase_db_path.lower():
-        for species in sqlite_dbs:
-            for locus in sqlite_dbs[species]:
-                inspector = inspect(sqlite_dbs[species][locus].db)
-                cols = inspector.get_columns('Sample')
-                if 'asc_genotype' not in [col['name'] for col in cols]:
-                    with sqlite_dbs[species][locus].connection as con:
-                        con.execute('ALTER TABLE Sample ADD COLUMN asc_genotype text')
-                        sqlite_dbs[species][locus].session.commit()
-
-
     # sort datasets of each species
 
     for species in sqlite_dbs:
@@ -106,3 +160,15 @@ def study_data_db_init(vdjbase_db_path):
     return sqlite_dbs
 
 
+def add_asc_genotype_column(db_path):
+    engine = create_engine('sqlite:///' + db_path, echo=False)
+    try:
+        inspector = inspect(engine)
+        cols = inspector.get_columns('Sample')
+        if 'asc_genotype' not in [col['name'] for col in cols]:
+            with engine.connect() as con:
+                con.execute('ALTER TABLE Sample ADD COLUMN asc_genotype text')
+    except Exception as e:
+        print('Error checking Sample table in %s: %s' % (db_path, e))
+    finally:
+        engine.dispose()
@@ -3,30 +3,37 @@
 # - read from the genotype - is parsed into its components and other attributes (eg the
 # 'ambiguous' alleles/genes it cites - are assembled.
 import csv
+import json
 import math
 import os
 import re
 import pandas as pd
 from sqlalchemy import func
+from sqlalchemy.orm.exc import MultipleResultsFound
 import glob
 from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 
 from db.vdjbase_airr_model import Sample
 from db.vdjbase_exceptions import DbCreationError
-from db.vdjbase_model import Allele, AllelesSample, Gene, SNP, HaplotypesFile, SamplesHaplotype
+from db.vdjbase_model import Allele, AllelesSample, Gene, SNP, HaplotypesFile, SamplesHaplotype, Details
 from db.vdjbase_projects import compound_genes
 
 # transaction log of alleles created
 new_alleles = {}
 
 
-def process_genotypes(ds_dir, species, dataset, session):
+def process_genotypes(ds_dir, species, dataset, session, workers=1):
     """
     Process genotype files for samples in the given directory.
 
     This function reads genotype files for each sample in the given directory, finds the assigned ambiguous alleles,
     and parses the genotypes.
 
+    The genotype files are parsed into plain records by parse_sample_genotype, in a pool of worker processes if
+    workers > 1. The records are applied to the database in sample order by this (the only writing) process.
+
     It logs allele audit information and returns a list of log messages.
 
     :param ds_dir: The directory containing the genotype files.
@@ -37,6 +44,8 @@ def process_genotypes(ds_dir, species, dataset, session):
     :type dataset: str
     :param session: The database session to use.
     :type session: sqlalchemy.orm.session.Session
+    :param workers: The number of processes to use for parsing genotype files.
+    :type workers: int
     :return: A list of log messages.
     :rtype: list of str
     """
@@ -49,21 +58,48 @@ def process_genotypes(ds_dir, species, dataset, session):
 
     allele_names, pipeline_names = read_ambiguous_alleles_file(ds_dir, result, session)
 
+    genotyped_samples = []
+
     for sample in list(samples):
         sample.genotype, sample.asc_genotype = find_genotype_files(ds_dir, sample, result)
 
         if sample.asc_genotype or sample.genotype:
-            sample_genotype(sample, pipeline_names, session)
+            genotyped_samples.append(sample)
         else:
             result.append('Error: no genotype file for sample %s - removing from sample list' % sample.sample_name)
             session.delete(sample)
 
-        # fix up filenames for the live database
+    # Allele lookups and AllelesSample inserts are served from memory for the duration of the import
+
+    session.info['allele_index'] = AlleleIndex(session)
+    session.info['alleles_sample_buffer'] = AllelesSampleBuffer(session)
+
+    try:
+        asc_files = [sample.asc_genotype for sample in genotyped_samples]
+        tigger_files = [sample.genotype for sample in genotyped_samples]
+
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                sample_records = executor.map(parse_sample_genotype, asc_files, tigger_files, repeat(pipeline_names), chunksize=4)
+                for sample, records in zip(genotyped_samples, sample_records):
+                    apply_genotype_records(sample, records, pipeline_names, session)
+        else:
+            for sample, asc_file, tigger_file in zip(genotyped_samples, asc_files, tigger_files):
+                apply_genotype_records(sample, parse_sample_genotype(asc_file, tigger_file, pipeline_names), pipeline_names, session)
+
+        session.info['alleles_sample_buffer'].flush()
+    finally:
+        del session.info['allele_index']
+        del session.info['alleles_sample_buffer']
+
+    # fix up filenames for the live database
+
+    for sample in genotyped_samples:
         if sample.genotype:
             sample.genotype = sample.genotype.replace(ds_dir + '\\', '').replace('\\', '/')
         if sample.asc_genotype:
             sample.asc_genotype = sample.asc_genotype.replace(ds_dir + '\\', '').replace('\\', '/')
-            
+
     session.commit()
 
     # dump audit log
@@ -283,37 +319,82 @@ def parse_ambiguous_allele(allele, gene, pipeline_names):
 
 
 # Read a genotype. Add the contents of each row to the database
-def sample_genotype(sample, pipeline_names, session):
+def parse_sample_genotype(asc_genotype, genotype, pipeline_names):
     """
-    Read a genotype file for the given sample and add the contents of each row to the database.
+    Read the genotype files for a sample and return the genotype as a list of plain records, one per allele.
+    This does not touch the database, so can be run in a worker process.
 
-    :param sample: The sample object for which to process the genotype.
-    :type sample: Sample
+    Each record is a dict with keys names (the tuple returned by parse_ambiguous_allele), allele_calls, kdiff,
+    freq_by_clone, freq_by_seq, count and total_count. ASC calls that list several alleles can only be named
+    with reference to the database: for these, names is None and allele_calls holds the calls.
 
+    :param asc_genotype: The path to the ASC genotype file, or None.
+    :type asc_genotype: str
+    :param genotype: The path to the TIgGER genotype file.
+    :type genotype: str
     :param pipeline_names: A dictionary of ambiguous allele names and their pipeline-assigned names.
     :type pipeline_names: dict
+    :return: The records.
+    :rtype: list of dict
+    """
+    records = []
+    processed_gene_types = []
+
+    if asc_genotype:
+        processed_gene_types = parse_asc_genotype(asc_genotype, processed_gene_types, pipeline_names, records)
 
+    parse_tigger_genotype(genotype, processed_gene_types, pipeline_names, records)
+    return records
+
+
+def apply_genotype_records(sample, records, pipeline_names, session):
+    """
+    Add the genotype records produced by parse_sample_genotype for a sample to the database.
+
+    :param sample: The sample to which the records belong.
+    :type sample: Sample
+    :param records: The records.
+    :type records: list of dict
+    :param pipeline_names: A dictionary of ambiguous allele names and their pipeline-assigned names.
+    :type pipeline_names: dict
     :param session: The database session object to use for database operations.
     :type session: sqlalchemy.orm.session.Session
-
-    :return: A list of strings containing information about the processing of the genotype file.
-    :rtype: list
     """
-    processed_gene_types = []
+    for rec in records:
+        if rec['names'] is None:
+            allele = asc_name_to_vdjbase(rec['allele_calls'], session)
+            allele_part = '*'.join(allele.split('*')[1:])
+            gene_part = allele.split('*')[0]
+            rec['names'] = parse_ambiguous_allele(allele_part, gene_part, pipeline_names)
+
+        allele_snps, base_allele_name, pipeline_name, this_allele_name = rec['names']
+
+        try:
+            add2sample(this_allele_name, base_allele_name, sample.id, sample.patient.id, rec['kdiff'], pipeline_name, allele_snps, rec['freq_by_clone'],
+                       rec['freq_by_seq'], rec['count'], rec['total_count'], session)
+        except DbCreationError as e:
+            print(e)
 
-    if sample.asc_genotype:
-        processed_gene_types = process_asc_genotype(sample, processed_gene_types, pipeline_names, session)
 
-    process_tigger_genotype(sample, processed_gene_types, pipeline_names, session)
+def genotype_record(names, allele_calls, kdiff, freq_by_clone, freq_by_seq, count, total_count):
+    return {
+        'names': names,
+        'allele_calls': allele_calls,
+        'kdiff': kdiff,
+        'freq_by_clone': freq_by_clone,
+        'freq_by_seq': freq_by_seq,
+        'count': count,
+        'total_count': total_count,
+    }
 
 
-def process_asc_genotype(sample, processed_gene_types, pipeline_names, session):
+def parse_asc_genotype(asc_genotype, processed_gene_types, pipeline_names, records):
     """
-    Processes an ASC genotype file for a sample, adds the resulting data to the database, and returns a list of
+    Parses an ASC genotype file for a sample, appends the resulting records to records, and returns a list of
     processed gene types.
 
-    :param sample: A `Sample` object representing the sample to process.
-    :type sample: Sample
+    :param asc_genotype: The path to the ASC genotype file.
+    :type asc_genotype: str
 
     :param processed_gene_types: A list of gene types that have already been processed.
     :type processed_gene_types: list
@@ -321,15 +402,15 @@ def process_asc_genotype(sample, processed_gene_types, pipeline_names, session):
     :param pipeline_names: A list of pipeline names to use when parsing ambiguous allele names.
     :type pipeline_names: list
 
-    :param session: The database session to use for adding the processed data.
-    :type session: Session
+    :param records: The list to which records are appended.
+    :type records: list
 
     :return: The updated list of processed gene types, including any new gene types processed during this function call.
     :rtype: list
     """
     my_processed_types = []
-    print(sample.asc_genotype)
-    genotype = pd.read_csv(sample.asc_genotype, sep='\t')
+    print(asc_genotype)
+    genotype = pd.read_csv(asc_genotype, sep='\t')
     for index, row in genotype.iterrows():
         gene = row["gene"]
         gene_type = gene[3]
@@ -367,6 +448,7 @@ def process_asc_genotype(sample, processed_gene_types, pipeline_names, session):
 
             # check for multiple (ambiguous) allele names in the call and convert format to VDJbase if found
             # a bit of a weird split, as / can be in the name, as well as the separators between names
+            # the conversion needs the database, so is left to apply_genotype_records
 
             cell_type = allele[:2]
             allele_calls = allele.split('/' + cell_type)
@@ -375,18 +457,14 @@ def process_asc_genotype(sample, processed_gene_types, pipeline_names, session):
                 for i in range(1, len(allele_calls)):
                     allele_calls[i] = cell_type + allele_calls[i]
 
-                allele = asc_name_to_vdjbase(allele_calls, session)
+                records.append(genotype_record(None, allele_calls, kdiff, freq_by_clone, freq_by_seq, count, total_count))
+                continue
 
             allele_part = '*'.join(allele.split('*')[1:])
             gene_part = allele.split('*')[0]
-            allele_snps, base_allele_name, pipeline_name, this_allele_name = parse_ambiguous_allele(allele_part, gene_part, pipeline_names)
-
-            try:
-                add2sample(this_allele_name, base_allele_name, sample.id, sample.patient.id, kdiff, pipeline_name, allele_snps, freq_by_clone, freq_by_seq, count,
-                    total_count, session)
-            except DbCreationError as e:
-                print(e)
-                
+            names = parse_ambiguous_allele(allele_part, gene_part, pipeline_names)
+            records.append(genotype_record(names, None, kdiff, freq_by_clone, freq_by_seq, count, total_count))
+
     processed_gene_types.extend(my_processed_types)
     return processed_gene_types
 
@@ -463,23 +541,23 @@ def asc_name_to_vdjbase(allele_calls, session):
     return vdjbase_name
 
 
-def process_tigger_genotype(sample, processed_gene_types, pipeline_names, session):
+def parse_tigger_genotype(tigger_genotype, processed_gene_types, pipeline_names, records):
     """
-    Process the TIGGER genotype data for a given sample.
+    Parse the TIGGER genotype data for a given sample, appending the resulting records to records.
     ignore any rows whose gene type is listed in processed_gene_types.
     this lets us, for example, take Vs from asc, and Ds and Js from tigger
 
-    :param sample: the sample object
-    :type sample: obj
+    :param tigger_genotype: the path to the tigger genotype file
+    :type tigger_genotype: str
     :param processed_gene_types: a list of processed gene types
     :type processed_gene_types: list
     :param pipeline_names: a list of pipeline names
     :type pipeline_names: list
-    :param session: the database session
-    :type session: obj
+    :param records: the list to which records are appended
+    :type records: list
     """
-    print(sample.genotype)
-    genotype = pd.read_csv(sample.genotype, sep='\t')
+    print(tigger_genotype)
+    genotype = pd.read_csv(tigger_genotype, sep='\t')
     for index, row in genotype.iterrows():
         gene = row["gene"]
         gene_type = gene[3]
@@ -526,14 +604,144 @@ def process_tigger_genotype(sample, processed_gene_types, pipeline_names, sessio
                 freq_by_seq = int(float(str(row["Freq_by_Seq"]).split(";")[index]))
                 count = int(allele_counts[allele]) if allele in allele_counts else 0
 
-            allele_snps, base_allele_name, pipeline_name, this_allele_name = parse_ambiguous_allele(allele, gene, pipeline_names)
+            names = parse_ambiguous_allele(allele, gene, pipeline_names)
+            records.append(genotype_record(names, None, kdiff, freq_by_clone, freq_by_seq, count, total_count))
+
+
+
+class AlleleIndex:
+    """
+    In-memory index of the Allele table, by allele name and by the names listed in each allele's similar field.
+    While an index is attached to the session (as session.info['allele_index']), find_allele_or_similar uses it
+    instead of querying the database. Any change to an allele's name or similar field must be followed by a
+    call to update().
+
+    :param session: The database session.
+    :type session: sqlalchemy.orm.session.Session
+    """
+    def __init__(self, session):
+        self.by_name = {}
+        self.by_similar = {}
+        self.keys = {}
+
+        for allele in session.query(Allele).all():
+            self.update(allele)
+
+    def update(self, allele):
+        """
+        Add an allele to the index, or re-index it following a change to its name or similar field.
+
+        :param allele: The allele.
+        :type allele: Allele
+        """
+        if id(allele) in self.keys:
+            name, similar = self.keys[id(allele)]
+            self.by_name[name].remove(allele)
+            for sim in similar:
+                self.by_similar[sim].remove(allele)
+
+        name = allele.name
+        similar = similar_names(allele.similar)
+
+        if name not in self.by_name:
+            self.by_name[name] = []
+        self.by_name[name].append(allele)
+
+        for sim in similar:
+            if sim not in self.by_similar:
+                self.by_similar[sim] = []
+            self.by_similar[sim].append(allele)
+
+        self.keys[id(allele)] = (name, similar)
+
+    def find(self, allele_name):
+        """
+        Return the allele with the given name, or the allele listing it as similar (case-insensitive).
+
+        :param allele_name: The allele name.
+        :type allele_name: str
+        :return: The allele, or None if it is not found.
+        :rtype: Allele
+        :raises MultipleResultsFound: if more than one allele lists the name as similar
+        """
+        alleles = self.by_name.get(allele_name, [])
+
+        if len(alleles) > 1:
+            print('Multiple rows found for allele %s: check fasta files in reference directory.' % allele_name)
+        elif alleles:
+            return alleles[0]
+
+        alleles = self.by_similar.get(allele_name.lower(), [])
+
+        if len(alleles) > 1:
+            raise MultipleResultsFound('Multiple alleles list %s as similar' % allele_name)
+
+        return alleles[0] if alleles else None
+
+
+def similar_names(similar):
+    """
+    Parse the similar field of an Allele (e.g. '|IGHV1-2*02|, |IGHV1-2*03|') into a list of lower-case names.
+
+    :param similar: The contents of the similar field.
+    :type similar: str
+    :return: The names.
+    :rtype: list[str]
+    """
+    if not similar:
+        return []
+
+    names = []
+    for name in similar.split('|'):
+        name = name.strip(', ').lower()
+        if name and name not in names:
+            names.append(name)
+
+    return names
+
+
+class AllelesSampleBuffer:
+    """
+    Staging buffer for the AllelesSample rows created by a genotype import. Rows are deduplicated on
+    (allele_id, sample_id) and written with bulk_insert_mappings, batch_size rows at a time.
+
+    :param session: The database session.
+    :type session: sqlalchemy.orm.session.Session
+    :param batch_size: The number of rows to accumulate before writing.
+    :type batch_size: int
+    """
+    def __init__(self, session, batch_size=10000):
+        self.session = session
+        self.batch_size = batch_size
+        self.rows = []
+        self.seen = set(session.query(AllelesSample.allele_id, AllelesSample.sample_id).filter(AllelesSample.hap == 'geno').all())
+
+    def add(self, row):
+        """
+        Add a row, unless a genotype row for the same allele and sample has already been added.
+
+        :param row: The column values of the row.
+        :type row: dict
+        """
+        key = (row['allele_id'], row['sample_id'])
+
+        if key in self.seen:
+            return
+
+        self.seen.add(key)
+        self.rows.append(row)
+
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write any buffered rows to the database.
+        """
+        if self.rows:
+            self.session.bulk_insert_mappings(AllelesSample, self.rows)
+            self.rows = []
 
-            try:
-                add2sample(this_allele_name, base_allele_name, sample.id, sample.patient.id, kdiff, pipeline_name, allele_snps, freq_by_clone, freq_by_seq, count,
-                       total_count, session)
-            except DbCreationError as e:
-                print(e)
-            
 
 def find_allele_or_similar(allele_name, session):
     """
@@ -548,6 +756,9 @@ def find_allele_or_similar(allele_name, session):
     :return:
     :rtype:
     """
+    if 'allele_index' in session.info:
+        return session.info['allele_index'].find(allele_name)
+
     try:
         allele = session.query(Allele).filter(Allele.name == allele_name).one_or_none()
     except Exception as e:
@@ -620,7 +831,7 @@ def add2sample (allele_name, base_allele_name, sample_id, pid, kdiff, pipeline_n
         if pipeline_name not in new_alleles[allele_name]['pipeline_names']:
             new_alleles[allele_name]['pipeline_names'].append(pipeline_name)
 
-    alleles_sample = AllelesSample(
+    alleles_sample = dict(
         hap='geno',
         kdiff=kdiff,
         freq_by_clone=freq_by_clone,
@@ -632,13 +843,17 @@ def add2sample (allele_name, base_allele_name, sample_id, pid, kdiff, pipeline_n
         allele_id=allele.id
     )
 
+    if 'alleles_sample_buffer' in session.info:
+        session.info['alleles_sample_buffer'].add(alleles_sample)
+        return
+
     asc = session.query(AllelesSample)\
-        .filter(AllelesSample.allele_id == alleles_sample.allele_id)\
-        .filter(AllelesSample.sample_id == alleles_sample.sample_id)\
+        .filter(AllelesSample.allele_id == alleles_sample['allele_id'])\
+        .filter(AllelesSample.sample_id == alleles_sample['sample_id'])\
         .filter(AllelesSample.hap == 'geno').count()
 
     if asc == 0:
-        session.add(alleles_sample)
+        session.add(AllelesSample(**alleles_sample))
 
 
 
@@ -738,10 +953,17 @@ def new_allele(allele_name, base_allele_name, pipeline_name, allele_snps, sessio
             else:
                 new_alleles[temp]['similar'].append(final_allele_name)
 
-            stmt = allele_table.update().where(allele_table.c.seq == seq).values(similar=sim, name=temp)
-            session.execute(stmt)
-            session.commit()
-            allele = session.query(Allele).filter(Allele.seq == seq).one_or_none()
+            if 'allele_index' in session.info:
+                # update the row through the ORM, so that the index can follow the change
+                same_seq_allele.similar = sim
+                same_seq_allele.name = temp
+                session.info['allele_index'].update(same_seq_allele)
+                allele = same_seq_allele
+            else:
+                stmt = allele_table.update().where(allele_table.c.seq == seq).values(similar=sim, name=temp)
+                session.execute(stmt)
+                session.commit()
+                allele = session.query(Allele).filter(Allele.seq == seq).one_or_none()
 
     else:
         ambig = 'ambiguous' if len(ambiguous_alleles) > 1 else ''
@@ -773,6 +995,9 @@ def new_allele(allele_name, base_allele_name, pipeline_name, allele_snps, sessio
         session.flush()
         session.refresh(allele)
 
+        if 'allele_index' in session.info:
+            session.info['allele_index'].update(allele)
+
         # add the snps
 
         for snp in allele_snps:
@@ -1020,6 +1245,31 @@ def process_haplotypes_and_stats(ds_dir, species, dataset, session):
     return result
 
 
+# Name of the file, in the dataset's samples directory, listing the haplotype files that are present
+# This saves the API from checking the existence of each file on every request
+
+HAPLOTYPE_MANIFEST = 'haplotype_files.json'
+
+
+def write_haplotype_manifest(ds_dir, session):
+    result = ['Writing haplotype file manifest']
+    created = session.query(Details.created_on).one_or_none()
+    created = created[0].isoformat() if created and created[0] else ''
+
+    files = []
+    for (filename,) in session.query(HaplotypesFile.file).all():
+        if filename and os.path.isfile(os.path.join(ds_dir, filename)):
+            files.append(filename.replace('samples/', ''))
+
+    if os.path.isdir(os.path.join(ds_dir, 'samples')):
+        with open(os.path.join(ds_dir, 'samples', HAPLOTYPE_MANIFEST), 'w') as fo:
+            json.dump({'created_on': created, 'files': sorted(files)}, fo)
+    else:
+        result.append('No samples directory: haplotype file manifest not written')
+
+    return result
+
+
 def process_haplotype(filename, sample, haplo_gene, session):
     gene = "-".join(haplo_gene.split("-")[:-1])
     alleles = haplo_gene.split("-")[-1]
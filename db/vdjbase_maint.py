@@ -7,6 +7,7 @@ import sys
 import traceback
 import zipfile
 import datetime
+import time
 
 from sqlalchemy import create_engine
 from sqlalchemy.pool import NullPool
@@ -18,18 +19,27 @@ from db.vdjbase_cross_sample import update_alleles_appearance, calculate_gene_fr
 from db.vdjbase_model import *
 from db.vdjbase_reference import import_reference_alleles
 from db.vdjbase_projects import import_studies
-from db.vdjbase_genotypes import process_genotypes, add_deleted_alleles, process_haplotypes_and_stats
+from db.vdjbase_genotypes import process_genotypes, add_deleted_alleles, process_haplotypes_and_stats, write_haplotype_manifest
 from db.vdjbase_exceptions import *
 from db.source_details import db_source_details
 
 
 Session = sessionmaker()
 
-def create_single_database(job, species, dataset, upload_path, in_situ=False):
+BUILD_PRAGMAS = [
+    'PRAGMA journal_mode = OFF',
+    'PRAGMA synchronous = OFF',
+    'PRAGMA cache_size = -262144',      # 256MB
+    'PRAGMA temp_store = MEMORY',
+]
+
+def create_single_database(job, species, dataset, upload_path, in_situ=False, workers=1):
     result = []
 
     # if called from UI, create/unpack in uploads directory
     # if called from command line, create in situ from files without unpacking
+    # workers is the number of processes used to parse sample files. Leave at 1 when called from a celery worker,
+    # as its daemon processes can't start a process pool
 
     if not in_situ:
         ds_dir = os.path.join(upload_path, species, dataset)
@@ -51,6 +61,13 @@ def create_single_database(job, species, dataset, upload_path, in_situ=False):
     engine = create_engine('sqlite:///' + db_file, echo=False, poolclass=NullPool)
     Base.metadata.create_all(engine)
     db_connection = engine.connect()
+
+    # The database is built from scratch and discarded on failure, so durability can be traded for speed.
+    # These settings apply to this connection only, not to the database as opened by the API.
+
+    for pragma in BUILD_PRAGMAS:
+        db_connection.execute(pragma)
+
     engine.session = Session(bind=db_connection)
     session = engine.session
 
@@ -70,26 +87,27 @@ def create_single_database(job, species, dataset, upload_path, in_situ=False):
 
     success = True
 
+    stage_timings = []
+
+    # run a build stage, recording the time it takes
+
+    def run_stage(description, stage, *args):
+        job.update_state(state='PENDING', meta={'value': description})
+        start = time.perf_counter()
+        result.extend(stage(*args))
+        stage_timings.append((description, time.perf_counter() - start))
+
     try:
-        job.update_state(state='PENDING', meta={'value': 'Importing reference alleles'})
-        result.extend(import_reference_alleles(os.path.join(ds_dir, 'reference'), session, species))
-        job.update_state(state='PENDING', meta={'value': 'Importing studies'})
-        result.extend(import_studies(ds_dir, species, dataset, session))
-        job.update_state(state='PENDING', meta={'value': 'Processing deleted alleles'})
-        result.extend(add_deleted_alleles(session))
-        job.update_state(state='PENDING', meta={'value': 'Processing genotypes'})
-        result.extend(process_genotypes(ds_dir, species, dataset, session))
-        job.update_state(state='PENDING', meta={'value': 'Processing haplotypes'})
-        result.extend(process_haplotypes_and_stats(ds_dir, species, dataset, session))
-        job.update_state(state='PENDING', meta={'value': 'Analyzing allele appearances'})
-        result.extend(update_alleles_appearance(session))
-        job.update_state(state='PENDING', meta={'value': 'Calculating gene frequencies'})
-        result.extend(calculate_gene_frequencies(ds_dir, session))
-        job.update_state(state='PENDING', meta={'value': 'Calculating patterns'})
-        result.extend(calculate_patterns(session))
-
-        job.update_state(state='PENDING', meta={'value': 'Creating confidence reports'})
-        result.extend(check_novel_confidence(ds_dir, session))
+        run_stage('Importing reference alleles', import_reference_alleles, os.path.join(ds_dir, 'reference'), session, species)
+        run_stage('Importing studies', import_studies, ds_dir, species, dataset, session)
+        run_stage('Processing deleted alleles', add_deleted_alleles, session)
+        run_stage('Processing genotypes', process_genotypes, ds_dir, species, dataset, session, workers)
+        run_stage('Processing haplotypes', process_haplotypes_and_stats, ds_dir, species, dataset, session)
+        run_stage('Writing haplotype file manifest', write_haplotype_manifest, ds_dir, session)
+        run_stage('Analyzing allele appearances', update_alleles_appearance, session)
+        run_stage('Calculating gene frequencies', calculate_gene_frequencies, ds_dir, session)
+        run_stage('Calculating patterns', calculate_patterns, session)
+        run_stage('Creating confidence reports', check_novel_confidence, ds_dir, session)
     except Exception as e:
         result.append(e.args[0])
         traceback.print_exc(limit=2, file=sys.stdout)
@@ -98,9 +116,19 @@ def create_single_database(job, species, dataset, upload_path, in_situ=False):
         db_connection.close()
         engine.dispose()
 
+    result.extend(timing_report(stage_timings))
+
     return success, result
 
 
+def timing_report(stage_timings):
+    report = ['Build timings:']
+    for description, elapsed in stage_timings:
+        report.append('    %-40s %8.1fs' % (description, elapsed))
+    report.append('    %-40s %8.1fs' % ('Total', sum([elapsed for _, elapsed in stage_timings])))
+    return report
+
+
 def extract_files(job, ds_dir, species, dataset):
     result = []
 
@@ -46,17 +46,27 @@ celery = FlaskCelery('tasks', broker='pyamqp://guest@localhost//', backend='redi
 
 
 @celery.task(bind=True, time_limit=600)
-def run_report(self, report_name, format, species, genomic_datasets, genomic_samples, rep_datasets, rep_samples, params):
+def run_report(self, report_name, format, species, genomic_datasets, genomic_samples, rep_datasets, rep_samples, params, cache_key=None):
     runner = importlib.import_module('api.reports.' + report_name)
 
     try:
         self.update_state(state='PENDING', meta={'stage': 'preparing data'})
-        return runner.run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_samples, params)
+        result = runner.run(format, species, genomic_datasets, genomic_samples, rep_datasets, rep_samples, params)
+
+        if cache_key is not None:
+            from api.reports.report_cache import save_report_result
+            save_report_result(cache_key, result)
+
+        return result
     except BadRequest as bad:
         print('BadRequest raised during report processing: %s' % bad.description)
         return {'status': 'error', 'description': bad.description}
     except Exception as e:
         print('Exception raised during report processing: %s' % traceback.format_exc())
         return {'status': 'error', 'description': 'Unexpected error when running report: %s' % traceback.format_exc()}
+    finally:
+        if cache_key is not None:
+            from api.reports.report_cache import finish_report_job
+            finish_report_job(cache_key, self.request.id)
 
 
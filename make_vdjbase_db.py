@@ -7,11 +7,19 @@ import os
 parser = argparse.ArgumentParser(description='Make a VDJbase sqlite database from files in current directory')
 parser.add_argument('species', help='species')
 parser.add_argument('dataset_name', help='data set name')
-args = parser.parse_args()
+parser.add_argument('--workers', type=int, default=1, help='number of processes to use for parsing sample files (default 1)')
+
 
 class Job:
     def update_state(self, meta=None, state=None):
         print('status: %s' % meta['value'])
 
 
-create_single_database(Job(), args.species, args.dataset_name, os.getcwd(), True)
+# The guard is needed so that worker processes, which re-import this module on platforms that spawn them, don't rerun the build
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    success, result = create_single_database(Job(), args.species, args.dataset_name, os.getcwd(), True, args.workers)
+
+    for line in result:
+        print(line)